@@ -0,0 +1,112 @@
+"""
+Startup benchmark for the management CLIs
+
+The CLIs are run from cron jobs and shell loops, so the time they take to start adds up. This runs every
+subcommand's --help in a fresh interpreter under python -X importtime and reports how long importing the cli took,
+the wall time of the whole run and which of the heavy dependencies got imported. It exits non zero if importing a
+cli goes over the budget or pulls in one of them, since parsing arguments never needs them. The budget is on the
+cli's own import, interpreter startup and site packages vary too much from one machine to the next.
+
+    python cli_startup.py --runs 5 --budget_ms 75
+"""
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+import click
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+# module directory, module and console script name of each cli
+CLIS = (
+    ('csv_manager', 'csv_manager', 'wm-csv-man'),
+    ('sms_sender', 'sms_sender', 'wm-sms-send'),
+)
+# only needed once a command does its work
+HEAVY_MODULES = ('twilio', 'jinja2', 'requests', 'tqdm')
+
+# runs the cli the way its console script does, the arguments follow the script
+RUN_SCRIPT = "import sys; sys.path.insert(0, {path!r}); import {module}; {module}.cli(prog_name={prog!r})"
+
+
+def _subcommands(directory: str, module: str):
+    """
+    Returns the names of a cli's subcommands
+
+    Args:
+        directory (str): directory the cli's module is in
+        module (str): the cli's module
+
+    Returns:
+        list
+    """
+    sys.path.insert(0, os.path.join(ROOT, directory))
+    try:
+        return sorted(__import__(module).cli.commands)
+    finally:
+        sys.path.pop(0)
+
+
+def _run(directory: str, module: str, prog: str, args: list):
+    """
+    Runs a cli once under -X importtime
+
+    Args:
+        directory (str): directory the cli's module is in
+        module (str): the cli's module
+        prog (str): console script name
+        args (list): arguments to run it with
+
+    Returns:
+        dict - import_ms, how long importing the cli module took with everything it imported, wall_ms and the
+        heavy modules imported
+    """
+    command = [sys.executable, "-X", "importtime", "-c",
+               RUN_SCRIPT.format(path=os.path.join(ROOT, directory), module=module, prog=prog)] + args
+    start = time.perf_counter()
+    result = subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, universal_newlines=True)
+    wall_ms = (time.perf_counter() - start) * 1000
+    if result.returncode != 0:
+        raise click.ClickException("{} {} failed:\n{}".format(prog, " ".join(args), result.stderr))
+
+    import_us = 0
+    heavy = set()
+    # import time:  self [us] | cumulative | imported package
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "imported package" in line:
+            continue
+        _, cumulative_us, name = line[len("import time:"):].split("|")
+        name = name.strip()
+        if name == module:
+            import_us = int(cumulative_us)
+        if name.split(".")[0] in HEAVY_MODULES:
+            heavy.add(name.split(".")[0])
+    return {'import_ms': import_us / 1000, 'wall_ms': wall_ms, 'heavy': sorted(heavy)}
+
+
+@click.command()
+@click.option('--runs', default=5, type=int, help="Runs per subcommand, we report the median")
+@click.option('--budget_ms', default=75.0, type=float, help="Most time importing a cli may take")
+def main(runs: int, budget_ms: float):
+    over_budget = []
+    for directory, module, prog in CLIS:
+        for subcommand in [None] + _subcommands(directory, module):
+            args = ([subcommand] if subcommand else []) + ["--help"]
+            name = " ".join([prog] + args)
+            samples = [_run(directory, module, prog, args) for _ in range(runs)]
+            import_ms = statistics.median(sample['import_ms'] for sample in samples)
+            wall_ms = statistics.median(sample['wall_ms'] for sample in samples)
+            heavy = samples[-1]['heavy']
+            click.echo("{:<40} imports {:>7.1f}ms, wall {:>7.1f}ms{}".format(
+                name, import_ms, wall_ms, ", imported {}".format(", ".join(heavy)) if heavy else ""))
+            if import_ms > budget_ms or heavy:
+                over_budget.append(name)
+
+    if over_budget:
+        raise click.ClickException("Over the {}ms budget or importing heavy modules: {}".format(
+            budget_ms, ", ".join(over_budget)))
+
+
+if __name__ == '__main__':
+    main()
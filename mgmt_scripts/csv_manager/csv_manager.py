@@ -3,8 +3,8 @@ import json
 from datetime import datetime
 
 import click
-import requests
-from tqdm import tqdm
+
+# requests and tqdm are imported where they're used, so --help doesn't wait on them
 
 
 def _add_guest(
@@ -40,6 +40,7 @@ def _add_guest(
         'physical_address': physical_address
     }
     # ToDo: Handle auth
+    import requests
     guest_url = "{}/guest".format(wedding_manager_url)
     response = requests.post(url=guest_url, json=data)
 
@@ -74,22 +75,46 @@ def _get_guest_list_from_wm(wedding_manager_url: str,
     Returns:
         list or bool
     """
+    import requests
     guests_url = "{}/guests".format(wedding_manager_url)
     response = requests.get(url=guests_url)
     return response.json() if response.status_code == 200 else False
 
 
+def _get_duplicates_from_wm(wedding_manager_admin_url: str,
+                            wedding_manager_username: str,
+                            wedding_manager_pass: str):
+    """
+    Retrieves the CSV of guests that look like duplicates from wedding manager's admin
+    Args:
+        wedding_manager_admin_url (str): URL of wedding manager's admin
+        wedding_manager_username (str): username for wedding manager
+        wedding_manager_pass (str): password for wedding manager
+
+    Returns:
+        str or bool
+    """
+    # ToDo: Handle auth
+    import requests
+    duplicates_url = "{}/duplicates/".format(wedding_manager_admin_url)
+    response = requests.get(url=duplicates_url)
+    return response.text if response.status_code == 200 else False
+
+
 @click.group()
 @click.option('--wm_api_url', default="http://wm-api:5000/api", envvar="WM_API_URL")
+@click.option('--wm_admin_url', default="http://wm-api:5000/admin", envvar="WM_ADMIN_URL")
 @click.option('--wm_api_user', default="admin", envvar="WM_API_USER")
 @click.option('--wm_api_pass', default="pass", envvar="WM_API_PASS")
 @click.pass_context
 def cli(ctx,
         wm_api_url: str,
+        wm_admin_url: str,
         wm_api_user: str,
         wm_api_pass: str):
     ctx.obj = dict()
     ctx.obj['WM_API_URL'] = wm_api_url
+    ctx.obj['WM_ADMIN_URL'] = wm_admin_url
     ctx.obj['WM_API_USER'] = wm_api_user
     ctx.obj['WM_API_PASS'] = wm_api_pass
     pass
@@ -106,6 +131,8 @@ def _import(ctx,
     Import imports a CSV file into our wedding manager
 
     """
+    from tqdm import tqdm
+
     # get our guest list
     guest_list = _get_guest_list_from_file(csv_file, skip_lines)
 
@@ -160,3 +187,34 @@ def export(ctx,
         writer.writerows(guest_list)
 
     click.echo("Dumped Wedding Manager Guest list to {}".format(csv_file_name))
+
+
+@cli.command()
+@click.argument('csv_file_name', type=str,
+                default="./wm-duplicates-{}.csv".format(datetime.now().strftime("%Y-%m-%d-%H-%M")))
+@click.pass_context
+def dedupe(ctx,
+           csv_file_name: str):
+    """
+    Writes guests that look like duplicates to a CSV file to review. Each row is a pair of guests, the one to keep
+    and its likely duplicate, with a score and what matched. Nothing is merged, fill in the merge column and make the
+    changes in wedding manager
+
+    Args:
+        ctx: Context from cli
+        csv_file_name (str): Path to a Writeable file that we're going to write to
+
+    """
+    duplicates = _get_duplicates_from_wm(ctx.obj['WM_ADMIN_URL'],
+                                         ctx.obj['WM_API_USER'],
+                                         ctx.obj['WM_API_PASS'])
+    if duplicates is False:
+        raise click.ClickException("Couldn't get duplicates from {}".format(ctx.obj['WM_ADMIN_URL']))
+
+    # the CSV already has its line endings
+    with open(csv_file_name, 'w', newline='') as file_handler:
+        file_handler.write(duplicates)
+
+    # less the header
+    pairs = max(len(list(csv.reader(duplicates.splitlines()))) - 1, 0)
+    click.echo("Wrote {pairs} likely duplicates to {filename}".format(pairs=pairs, filename=csv_file_name))
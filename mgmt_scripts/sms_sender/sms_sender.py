@@ -1,8 +1,15 @@
+import csv
+import heapq
+import itertools
+import json
+import os
+import random
+import time
+from datetime import datetime
+
 import click
-import requests
-from tqdm import tqdm
-from twilio.rest import Client
-from jinja2 import Environment
+
+# requests, tqdm, twilio and jinja2 are imported where they're used, so --help and dry runs don't wait on them
 
 
 def _get_all_contact_users(url: str,
@@ -18,6 +25,7 @@ def _get_all_contact_users(url: str,
     Returns:
         list[dict]
     """
+    import requests
     response = requests.get(url="{}/guests?guest_filter=all_contacts".format(url))
     return response.json()
 
@@ -35,6 +43,7 @@ def _get_rsvp_users(url: str,
     Returns:
         list[dict]
     """
+    import requests
     first_query = requests.get("{}/guests?guest_filter=savethedate&guest_value=None".format(url))
     second_query = requests.get("{}/guests?guest_filter=savethedate&guest_value=True".format(url))
     return first_query.json() + second_query.json()
@@ -53,28 +62,148 @@ def _get_not_yet_rsvp_users(url: str,
     Returns:
         list[dict]
     """
+    import requests
     first_query = requests.get("{}/guests?guest_filter=savethedate&guest_value=False".format(url))
     second_query = requests.get("{}/guests?guest_filter=rsvp&guest_value=None".format(url))
     return [user for user in second_query.json() if user not in first_query.json()]
 
 
-def _render_template(template: str, user: dict):
+# The GSM 03.38 alphabet. Messages written only in it are sent as 7 bit GSM, anything else as UCS-2
+GSM7_BASIC = frozenset("@£$¥èéùìòÇ\nØø\rÅåΔ_ΦΓΛΩΠΨΣΘΞÆæßÉ !\"#¤%&'()*+,-./0123456789:;<=>?"
+                       "¡ABCDEFGHIJKLMNOPQRSTUVWXYZÄÖÑÜ§¿abcdefghijklmnopqrstuvwxyzäöñüà")
+# characters from the extension table take an escape character as well
+GSM7_EXTENDED = frozenset("^{}\\[~]|€\f")
+GSM7 = GSM7_BASIC | GSM7_EXTENDED
+# (characters in a single segment, characters per segment of a longer message), longer messages lose some of each
+# segment to the header that joins them back up
+SEGMENT_SIZES = {'GSM-7': (160, 153), 'UCS-2': (70, 67)}
+# lists shorter than this are rendered in process, starting the pool would take longer
+PARALLEL_RENDER_THRESHOLD = 1000
+
+
+def _sms_cost(message: str):
     """
-    Renders a jinja template (template) using a dict (user)
+    Works out how a message will be encoded and how many segments it will be billed as. The characters are checked
+    as a set against the GSM alphabet rather than one at a time
+
+    Args:
+        message (str): Rendered message
+
+    Returns:
+        tuple(str, int, int) - encoding (GSM-7 or UCS-2), length in that encoding's characters and segments
+    """
+    characters = set(message)
+    if characters <= GSM7:
+        encoding = 'GSM-7'
+        length = len(message) + sum(message.count(character) for character in characters & GSM7_EXTENDED)
+    else:
+        encoding = 'UCS-2'
+        # characters outside the basic multilingual plane, i.e. emoji, take two
+        length = len(message.encode('utf-16-le')) // 2
+    single, multipart = SEGMENT_SIZES[encoding]
+    segments = 1 if length <= single else -(-length // multipart)
+    return encoding, length, segments
+
+
+# the template a render worker renders with, see _init_render_worker
+_worker_template = None
+
 
+def _init_render_worker(template: str):
+    """
+    Compiles the template once per render worker, compiled templates can't be sent to the workers
     Args:
         template (str): String Jinja template
+    """
+    from jinja2 import Environment
+    global _worker_template
+    _worker_template = Environment().from_string(template)
+
+
+def _render_and_cost(user: dict):
+    """
+    Renders the worker's template for a user and works out what it will cost to send
+    Args:
         user (dict): Dictionary of a user
 
     Returns:
-        str
+        tuple(dict, str, str, int, int, str) - the user, their message, its encoding, length and segments, or None
+        for all of those and the error if it wouldn't render
+    """
+    try:
+        message = _worker_template.render(**user)
+    except Exception as exc:
+        return user, None, None, None, None, "{}: {}".format(type(exc).__name__, exc)
+    return (user, message) + _sms_cost(message) + (None,)
+
+
+def _dry_run(user_list: list, template: str, output_path: str, processes: int = None, worst: int = 5):
+    """
+    Renders the template for every user, in parallel for long lists, and streams the messages to a CSV as they are
+    rendered. Reports what the campaign would cost in segments, the most expensive messages and the users it
+    couldn't be rendered for
+
+    Args:
+        user_list (list): List of users we would send to
+        template (str): String Jinja template
+        output_path (str): CSV file to write the rendered messages to
+        processes (int): render workers, defaults to one per cpu
+        worst (int): how many of the most expensive messages to show
     """
-    return Environment().from_string(template).render(**user)
+    totals = {'GSM-7': [0, 0], 'UCS-2': [0, 0]}
+    most_segments = []
+    failures = []
+    pool = None
+    if len(user_list) >= PARALLEL_RENDER_THRESHOLD and processes != 1:
+        import multiprocessing
+        pool = multiprocessing.Pool(processes, initializer=_init_render_worker, initargs=(template,))
+        results = pool.imap(_render_and_cost, user_list, chunksize=256)
+    else:
+        _init_render_worker(template)
+        results = map(_render_and_cost, user_list)
+    try:
+        with open(output_path, 'w', newline='') as output:
+            writer = csv.writer(output)
+            writer.writerow(['id', 'name', 'phone_number', 'encoding', 'length', 'segments', 'message', 'error'])
+            for user, message, encoding, length, segments, error in results:
+                writer.writerow([user.get('id'), user.get('name'), user.get('phone_number'), encoding, length,
+                                 segments, message, error])
+                if error is not None:
+                    failures.append((user, error))
+                    continue
+                totals[encoding][0] += 1
+                totals[encoding][1] += segments
+                # a min-heap of the most segments so far, so we never sort the whole list
+                entry = (segments, length, user.get('id') or 0, user.get('name'), encoding)
+                if len(most_segments) < worst:
+                    heapq.heappush(most_segments, entry)
+                else:
+                    heapq.heappushpop(most_segments, entry)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    rendered = totals['GSM-7'][0] + totals['UCS-2'][0]
+    click.echo("Rendered {} of {} messages to {}".format(rendered, len(user_list), output_path))
+    click.echo("Would send {} segments".format(totals['GSM-7'][1] + totals['UCS-2'][1]))
+    for encoding, (messages, segments) in sorted(totals.items()):
+        if messages:
+            click.echo("  {}: {} messages, {} segments".format(encoding, messages, segments))
+    if most_segments:
+        click.echo("Most expensive messages:")
+        for segments, length, _, name, encoding in sorted(most_segments, reverse=True):
+            click.echo("  {} - {} segments ({} {} characters)".format(name, segments, length, encoding))
+    if failures:
+        click.echo("Couldn't render the template for {} users:".format(len(failures)))
+        for user, error in failures:
+            click.echo("  {} ({}) - {}".format(user.get('name'), user.get('phone_number'), error))
 
 
 def _send_messages(ctx, user_list: list, template: str):
     """
-    Loops through our user list and sends them message, if not in test mode
+    Loops through our user list and sends them message, if not in test mode. In test mode every message is rendered
+    and costed instead, see _dry_run
     Args:
         ctx: CLick context object
         user_list (list): List of users to send to
@@ -84,21 +213,331 @@ def _send_messages(ctx, user_list: list, template: str):
         click.echo("About to send SMS template to {} users".format(len(user_list)))
         click.echo("Template:\n {}".format(template))
         click.confirm('Do you want to continue?', abort=True)
-        for user in tqdm(user_list):
-            message = _render_template(template, user)
-            _send_message(ctx.obj['TW_CLIENT'], user['phone_number'], ctx.obj['TW_FROM_NUMBER'], message)
-            tqdm.write("Sent template to {name} at {number}".format(name=user['name'], number=user['phone_number']))
+        from jinja2 import Environment
+        compiled = Environment().from_string(template)
+        _send_all(ctx, [(user, compiled.render(**user)) for user in user_list])
     else:
         click.echo("We would send messages to {} users".format(len(user_list)))
         click.echo("Template:\n {}".format(template))
-        click.echo("User List:\n {}".format(user_list))
-        click.echo("Rendered template with first user: {}".format(_render_template(template, user_list[0])))
+        _dry_run(user_list, template, ctx.obj['RENDER_FILE'], ctx.obj['RENDER_PROCESSES'])
+
+
+def _is_retryable(exc: Exception):
+    """
+    Returns whether a failed send is worth trying again. Throttling, Twilio's own errors and the network pass, a bad
+    number or a guest that unsubscribed won't
+    Args:
+        exc (Exception): what the send raised
+
+    Returns:
+        bool
+    """
+    import requests
+    from twilio.base.exceptions import TwilioRestException
+    if isinstance(exc, TwilioRestException):
+        return exc.status == 429 or exc.status >= 500
+    return isinstance(exc, (requests.exceptions.ConnectionError, requests.exceptions.Timeout))
+
+
+class RetryScheduler(object):
+    """
+    Sends messages in batches through a backend, retrying the ones that fail for a reason that may pass with jittered
+    exponential backoff. Retries wait on a min-heap keyed by when they're next due and fresh messages are sent in the
+    meantime, so a retry never holds up the rest of the list. Retries that are due go out in the next batch
+    """
+
+    def __init__(self, backend, on_sent, on_failed, max_attempts: int = 5, base_delay: float = 1.0,
+                 max_delay: float = 60.0, batch_size: int = None, clock=time.monotonic, sleep=time.sleep):
+        """
+        Args:
+            backend (MessagesBackend, NotifyBackend or LocalBulkBackend): what sends the messages
+            on_sent (callable): on_sent(user, sid), called for every message sent
+            on_failed (callable): on_failed(user, message, exc, attempts), called for every message we gave up on
+            max_attempts (int): most times to try a message
+            base_delay (float): seconds before the first retry, doubled for every retry after it
+            max_delay (float): longest to wait between tries
+            batch_size (int): most messages per batch, defaults to and is capped at the backend's max_batch_size
+            clock (callable): monotonic clock, seconds
+            sleep (callable): sleeps for a number of seconds
+        """
+        self.backend = backend
+        self.on_sent = on_sent
+        self.on_failed = on_failed
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.batch_size = min(batch_size or backend.max_batch_size, backend.max_batch_size)
+        self.clock = clock
+        self.sleep = sleep
+
+    def backoff(self, attempt: int):
+        """
+        Returns how long to wait before trying a message again, half of the exponential delay plus up to half again
+        at random, so messages that failed together don't all come back together
+        Args:
+            attempt (int): the try that just failed, 1 for the first
+
+        Returns:
+            float
+        """
+        delay = min(self.max_delay, self.base_delay * 2 ** (attempt - 1))
+        return delay / 2 + random.uniform(0, delay / 2)
+
+    def run(self, jobs):
+        """
+        Sends every message, returning once each has been sent or given up on
+        Args:
+            jobs (iterable): (user, message) tuples
+        """
+        jobs = iter(jobs)
+        # (due, tiebreak, attempt, user, message), the tiebreak keeps the heap from comparing users
+        retries = []
+        tiebreak = itertools.count()
+        fresh = True
+        while True:
+            batch = []
+            now = self.clock()
+            while retries and retries[0][0] <= now and len(batch) < self.batch_size:
+                _, _, attempt, user, message = heapq.heappop(retries)
+                batch.append((attempt, user, message))
+            while fresh and len(batch) < self.batch_size:
+                job = next(jobs, None)
+                if job is None:
+                    fresh = False
+                    break
+                batch.append((1, job[0], job[1]))
+            if not batch:
+                if not retries:
+                    return
+                self.sleep(max(0.0, retries[0][0] - self.clock()))
+                continue
+
+            results = self.backend.send_batch([(user, message) for _, user, message in batch])
+            for (attempt, user, message), (sid, exc) in zip(batch, results):
+                if exc is None:
+                    self.on_sent(user, sid)
+                elif attempt < self.max_attempts and _is_retryable(exc):
+                    heapq.heappush(retries, (self.clock() + self.backoff(attempt), next(tiebreak), attempt + 1,
+                                             user, message))
+                else:
+                    self.on_failed(user, message, exc, attempt)
+
+
+class MessagesBackend(object):
+    """Sends each message with its own messages.create call"""
+
+    max_batch_size = 1
+
+    def __init__(self, client, from_number: str, status_callback: str = None):
+        """
+        Args:
+            client (twilio.rest.Client): Client to send the messages with
+            from_number (str): Number to send from
+            status_callback (str): Url Twilio reports delivery statuses to
+        """
+        self.client = client
+        self.from_number = from_number
+        self.status_callback = status_callback
+
+    def send_batch(self, jobs: list):
+        """
+        Sends a batch of messages
+        Args:
+            jobs (list): (user, message) tuples
+
+        Returns:
+            list - a (sid, exception) tuple per job, in order, the exception is None if the message was sent
+        """
+        results = []
+        for user, message in jobs:
+            try:
+                results.append((_send_message(self.client, user['phone_number'], self.from_number, message,
+                                              self.status_callback), None))
+            except Exception as exc:
+                results.append((None, exc))
+        return results
+
+
+class NotifyBackend(object):
+    """
+    Sends messages in bulk through a Twilio Notify service, one notification for up to max_batch_size recipients.
+    Each recipient goes in as an sms binding. A notification has one body, so recipients are grouped by their
+    rendered message and templates that render the same for everyone go out in the fewest calls. A notification is
+    accepted or rejected whole, when one is rejected for good the batch is split in half and each half tried again,
+    so a bad number only fails its own recipient
+    """
+
+    # Twilio takes up to 10,000 bindings per notification
+    max_batch_size = 10000
+
+    def __init__(self, client, service_sid: str):
+        """
+        Args:
+            client (twilio.rest.Client): Client to send the messages with
+            service_sid (str): sid of the Notify service, set up with our messaging service
+        """
+        self.service = client.notify.v1.services(service_sid)
+
+    def send_batch(self, jobs: list):
+        """
+        Sends a batch of messages
+        Args:
+            jobs (list): (user, message) tuples
+
+        Returns:
+            list - a (sid, exception) tuple per job, in order. Recipients of the same notification share its sid
+        """
+        results = [None] * len(jobs)
+        recipients = {}
+        for index, (user, message) in enumerate(jobs):
+            recipients.setdefault(message, []).append(index)
+        for message, indexes in recipients.items():
+            self._notify(message, [(index, jobs[index][0]) for index in indexes], results)
+        return results
+
+    def _notify(self, message: str, recipients: list, results: list):
+        """
+        Sends one message to recipients, splitting them up to find the ones a rejected notification was rejected for
+        Args:
+            message (str): message to send
+            recipients (list): (index, user) tuples
+            results (list): where each recipient's (sid, exception) goes, by index
+        """
+        try:
+            notification = self.service.notifications.create(
+                body=message,
+                to_binding=[json.dumps({'binding_type': "sms", 'address': user['phone_number']})
+                            for _, user in recipients])
+        except Exception as exc:
+            if len(recipients) == 1 or _is_retryable(exc):
+                for index, _ in recipients:
+                    results[index] = (None, exc)
+                return
+            middle = len(recipients) // 2
+            self._notify(message, recipients[:middle], results)
+            self._notify(message, recipients[middle:], results)
+            return
+        for index, _ in recipients:
+            results[index] = (notification.sid, None)
+
+
+class LocalSendError(Exception):
+    """A recipient the local backend was told to fail"""
+    pass
+
+
+class LocalBulkBackend(object):
+    """
+    Stand-in for a bulk api, for trying out batching offline. Remembers the batches it was sent and fails the
+    recipients whose numbers are in fail_numbers, the way a provider reports failures per recipient
+    """
+
+    def __init__(self, max_batch_size: int = None, fail_numbers=()):
+        """
+        Args:
+            max_batch_size (int): most recipients per batch, defaults to 100
+            fail_numbers (iterable): numbers to fail
+        """
+        self.max_batch_size = max_batch_size or 100
+        self.fail_numbers = set(fail_numbers)
+        self.batches = []
+
+    def send_batch(self, jobs: list):
+        self.batches.append(list(jobs))
+        return [(None, LocalSendError("Local failure sending to {}".format(user['phone_number'])))
+                if user['phone_number'] in self.fail_numbers else
+                ("SMLOCAL{:06d}{:06d}".format(len(self.batches), index), None)
+                for index, (user, _) in enumerate(jobs)]
+
+
+def _twilio_client(ctx):
+    """
+    Returns the Twilio client, it's only built once we're about to send so --help, --test and the local backend
+    need neither credentials nor twilio itself
+    Args:
+        ctx: CLick context object
+
+    Returns:
+        twilio.rest.Client
+    """
+    if ctx.obj['TW_CLIENT'] is None:
+        if not (ctx.obj['TW_ACCOUNT_SID'] and ctx.obj['TW_AUTH_TOKEN']):
+            raise click.UsageError("--account_sid and --auth_token (TW_ACCNT_SID and TW_AUTH_TOKEN) are needed to "
+                                   "send through Twilio")
+        from twilio.rest import Client
+        ctx.obj['TW_CLIENT'] = Client(ctx.obj['TW_ACCOUNT_SID'], ctx.obj['TW_AUTH_TOKEN'])
+    return ctx.obj['TW_CLIENT']
+
+
+# what --backend picks from
+BACKENDS = ('messages', 'notify', 'local')
+
+
+def _make_backend(ctx):
+    """
+    Creates the send backend picked with --backend
+    Args:
+        ctx: CLick context object
+
+    Returns:
+        MessagesBackend, NotifyBackend or LocalBulkBackend
+    """
+    backend = ctx.obj['BACKEND']
+    if backend == 'notify':
+        if not ctx.obj['NOTIFY_SERVICE_SID']:
+            raise click.UsageError("--notify_service_sid is needed to send through notify")
+        return NotifyBackend(_twilio_client(ctx), ctx.obj['NOTIFY_SERVICE_SID'])
+    if backend == 'local':
+        return LocalBulkBackend(ctx.obj['BATCH_SIZE'])
+    return MessagesBackend(_twilio_client(ctx), ctx.obj['TW_FROM_NUMBER'], ctx.obj['TW_STATUS_CALLBACK'])
+
+
+def _send_all(ctx, jobs: list, dead_letter_mode: str = 'a'):
+    """
+    Sends rendered messages through the backend picked with --backend, retrying the ones that fail for a reason
+    that may pass. Messages we give up on are written to the dead letter file, see the resend command
+    Args:
+        ctx: CLick context object
+        jobs (list): (user, message) tuples
+        dead_letter_mode (str): mode to open the dead letter file with, w to start it over
+    """
+    from tqdm import tqdm
+
+    backend = _make_backend(ctx)
+    with open(ctx.obj['SENT_LOG'], 'a', newline='') as sent_log, \
+            open(ctx.obj['DEAD_LETTER'], dead_letter_mode) as dead_letter, \
+            tqdm(total=len(jobs)) as progress:
+        sent_writer = csv.writer(sent_log)
+        failures = []
+
+        def on_sent(user, sid):
+            # the sid is how the delivery status Twilio reports to the api is matched up with the guest
+            sent_writer.writerow([sid, user['id'], user['phone_number'], datetime.utcnow().isoformat()])
+            sent_log.flush()
+            progress.update()
+            tqdm.write("Sent template to {name} at {number}".format(name=user['name'], number=user['phone_number']))
+
+        def on_failed(user, message, exc, attempts):
+            dead_letter.write(json.dumps({'user': user, 'message': message, 'error': str(exc),
+                                          'code': getattr(exc, 'code', None), 'attempts': attempts}) + "\n")
+            dead_letter.flush()
+            failures.append(user)
+            progress.update()
+            tqdm.write("Gave up on {name} at {number} after {attempts} tries: {error}".format(
+                name=user['name'], number=user['phone_number'], attempts=attempts, error=exc))
+
+        RetryScheduler(backend, on_sent, on_failed, max_attempts=ctx.obj['MAX_ATTEMPTS'],
+                       batch_size=ctx.obj['BATCH_SIZE']).run(jobs)
+    if failures:
+        click.echo("{} messages couldn't be sent, they're in {}. Send them again with the resend command".format(
+            len(failures), ctx.obj['DEAD_LETTER']))
 
 
 def _send_message(client,
                   to_num: str,
                   from_num: str,
                   message: str,
+                  status_callback: str = None,
                   ):
     """
     Sends a message via twilio
@@ -107,11 +546,18 @@ def _send_message(client,
         to_num (str): Number to send to
         from_num (str): Number to send from
         message (str): Message to send
+        status_callback (str): Url Twilio reports the message's delivery status to, i.e. the api's /sms/status
 
+    Returns:
+        str - Twilio's id for the message
     """
-    client.api.account.messages.create(to=to_num,
-                                      from_=from_num,
-                                      body=message)
+    kwargs = {}
+    if status_callback:
+        kwargs['status_callback'] = status_callback
+    return client.api.account.messages.create(to=to_num,
+                                             from_=from_num,
+                                             body=message,
+                                             **kwargs).sid
 
 
 @click.group()
@@ -121,6 +567,22 @@ def _send_message(client,
 @click.option('--account_sid', envvar="TW_ACCNT_SID")
 @click.option('--auth_token',  envvar="TW_AUTH_TOKEN")
 @click.option('--from_number',  envvar="TW_FROM_NUMBER")
+@click.option('--status_callback', envvar="TW_STATUS_CALLBACK",
+              help="Public url of the api's /sms/status, for Twilio to report delivery statuses to")
+@click.option('--sent_log', default="sent_messages.csv", envvar="WM_SENT_LOG",
+              help="CSV file the sid of every message sent is appended to")
+@click.option('--dead_letter', default="dead_letter.jsonl", envvar="WM_DEAD_LETTER",
+              help="File messages that couldn't be sent are appended to, see the resend command")
+@click.option('--max_attempts', default=5, type=int, help="Most times to try sending a message")
+@click.option('--backend', type=click.Choice(BACKENDS), default='messages',
+              help="How to send: a messages call per recipient, in bulk through a Notify service, or a local "
+                   "stand-in that sends nothing")
+@click.option('--notify_service_sid', envvar="TW_NOTIFY_SERVICE_SID", help="Notify service to send in bulk through")
+@click.option('--batch_size', type=int, default=None, help="Most recipients per bulk call, capped at the backend's")
+@click.option('--render_file', default="rendered_messages.csv",
+              help="CSV file --test writes every rendered message and its cost to")
+@click.option('--render_processes', type=int, default=None,
+              help="Processes --test renders with, defaults to one per cpu")
 @click.option('--test', help="Test, dont actually send the SMS", is_flag=True, default=False)
 @click.pass_context
 def cli(ctx,
@@ -130,13 +592,33 @@ def cli(ctx,
         account_sid: str,
         auth_token: str,
         from_number: str,
+        status_callback: str,
+        sent_log: str,
+        dead_letter: str,
+        max_attempts: int,
+        backend: str,
+        notify_service_sid: str,
+        batch_size: int,
+        render_file: str,
+        render_processes: int,
         test: bool):
     ctx.obj = dict()
     ctx.obj['WM_API_URL'] = wm_api_url
     ctx.obj['WM_API_USER'] = wm_api_user
     ctx.obj['WM_API_PASS'] = wm_api_pass
-    ctx.obj['TW_CLIENT'] = Client(account_sid, auth_token)
+    ctx.obj['TW_ACCOUNT_SID'] = account_sid
+    ctx.obj['TW_AUTH_TOKEN'] = auth_token
+    ctx.obj['TW_CLIENT'] = None
     ctx.obj['TW_FROM_NUMBER'] = from_number
+    ctx.obj['TW_STATUS_CALLBACK'] = status_callback
+    ctx.obj['SENT_LOG'] = sent_log
+    ctx.obj['DEAD_LETTER'] = dead_letter
+    ctx.obj['MAX_ATTEMPTS'] = max_attempts
+    ctx.obj['BACKEND'] = backend
+    ctx.obj['NOTIFY_SERVICE_SID'] = notify_service_sid
+    ctx.obj['BATCH_SIZE'] = batch_size
+    ctx.obj['RENDER_FILE'] = render_file
+    ctx.obj['RENDER_PROCESSES'] = render_processes
     ctx.obj['TEST_MODE'] = test
     pass
 
@@ -178,4 +660,23 @@ def update(ctx,
            template_file: click.File):
     user_list = _get_all_contact_users(ctx.obj['WM_API_URL'], ctx.obj['WM_API_USER'], ctx.obj['WM_API_PASS'])
     message = template_file.read()
-    _send_messages(ctx, user_list, message)
\ No newline at end of file
+    _send_messages(ctx, user_list, message)
+
+
+@cli.command()
+@click.argument('dead_letter_file', type=click.File('r'))
+@click.pass_context
+def resend(ctx,
+           dead_letter_file: click.File):
+    """Sends the messages in a dead letter file again, as they were rendered the first time"""
+    entries = [json.loads(line) for line in dead_letter_file if line.strip()]
+    jobs = [(entry['user'], entry['message']) for entry in entries]
+    if ctx.obj['TEST_MODE']:
+        click.echo("We would resend {} messages".format(len(jobs)))
+        return
+    click.echo("About to resend {} messages".format(len(jobs)))
+    click.confirm('Do you want to continue?', abort=True)
+    # resending from the dead letter file itself starts it over, so only what fails again is left in it
+    same_file = os.path.abspath(dead_letter_file.name) == os.path.abspath(ctx.obj['DEAD_LETTER'])
+    dead_letter_file.close()
+    _send_all(ctx, jobs, dead_letter_mode='w' if same_file else 'a')
@@ -1,35 +1,87 @@
 from flask import Flask
-from flask_restful import Api
-from flask_sqlalchemy import SQLAlchemy
-from flask_admin import Admin
-from flask_admin.contrib.sqla import ModelView
 
 # local import
+from app.routing import RoutingSQLAlchemy
 from instance.config import Config
 
 
-# initialize sql-alchemy
-db = SQLAlchemy()
+# initialize sql-alchemy, our session class can route reads to a read replica
+db = RoutingSQLAlchemy()
 
+# what each worker role serves. The public hostname only needs the api, so those workers skip admin setup
+APP_ROLES = ('api', 'admin', 'all')
 
-def create_app():
+
+def create_app(role: str = None):
     """
     Creates our flask app
 
+    Args:
+        role (str): What this app serves, one of APP_ROLES. Defaults to the APP_ROLE setting
+
     Returns:
         Flask
     """
-    from app.models import Guest
-    from app.resources import GuestsList, GuestsAPI, TwilioResponseAPI
+    from app.cache import init_guest_cache
+    from app.changes import init_change_feed
+    from app.logs import init_logging
+    from app.metrics import init_metrics
+    from app.query_tracking import init_query_tracking
+    from app.routing import init_read_replica
 
     app = Flask(__name__, instance_relative_config=True)
     config = Config()
     app.config.from_object(config)
-    app.logger.debug("Config loaded {}".format(config))
+    role = (role or app.config['APP_ROLE']).lower()
+    if role not in APP_ROLES:
+        raise ValueError("Unknown app role {}, must be one of {}".format(role, ", ".join(APP_ROLES)))
+    app.config['APP_ROLE'] = role
+    init_logging(app)
+    app.logger.debug("Config loaded %s", config)
+    init_read_replica(app)
     db.init_app(app)
+    init_query_tracking(app)
+    init_metrics(app)
+    init_change_feed(app)
+    # every role writes guests, so every role has to invalidate the cache the api serves the guest list from
+    init_guest_cache(app)
+
+    if role in ('api', 'all'):
+        init_api(app)
+
+    if role in ('admin', 'all'):
+        from app.admin import init_admin
+        init_admin(app)
+
+    return app
+
+
+def init_api(app):
+    """
+    Registers our flask-restful resources
+    Args:
+        app (Flask): app to add the api to
+
+    Returns:
+        flask_restful.Api
+    """
+    from flask_restful import Api
+    from app.cache import init_sms_reply_cache
+    from app.encoding import ModelJSONProvider, output_json
+    from app.models import Guest
+    from app.message_status import init_message_status
+    from app.resources import CampaignsAPI, GuestChanges, GuestsList, GuestsAPI, GuestsSearch, MessageStatusAPI, \
+        TwilioResponseAPI
+    from app.sms_queue import init_sms_queue
+
+    app.json = ModelJSONProvider(app)
+    init_sms_reply_cache(app)
+    init_sms_queue(app)
+    init_message_status(app)
 
     # flask-restful
     api = Api(app)
+    api.representations['application/json'] = output_json
 
     api.add_resource(GuestsAPI,
                      '/api/guest',
@@ -40,16 +92,23 @@ def create_app():
                      '/api/guests',
                      resource_class_kwargs={'guest_object': Guest},
                      endpoint="guest-list")
+    api.add_resource(GuestsSearch,
+                     '/api/guests/search',
+                     resource_class_kwargs={'guest_object': Guest},
+                     endpoint="guest-search")
+    api.add_resource(GuestChanges,
+                     '/api/guests/changes',
+                     resource_class_kwargs={'guest_object': Guest},
+                     endpoint="guest-changes")
     api.add_resource(TwilioResponseAPI,
                      '/api/sms',
                      resource_class_kwargs={'guest_object': Guest},
                      endpoint="sms")
-
-
-    # Create admin
-    admin = Admin(app, name='Wedding Reply Site', template_mode='bootstrap3')
-
-    # Add views
-    admin.add_view(ModelView(Guest, db.session))
-
-    return app
+    api.add_resource(MessageStatusAPI,
+                     '/api/sms/status',
+                     endpoint="sms-status")
+    api.add_resource(CampaignsAPI,
+                     '/api/campaigns',
+                     '/api/campaigns/<int:campaign_id>',
+                     endpoint="campaigns")
+    return api
@@ -0,0 +1,125 @@
+import io
+
+from flask import Response, current_app, flash, g
+from flask_admin import Admin, BaseView, expose
+from flask_admin.contrib.sqla import ModelView
+from sqlalchemy import literal, text
+from sqlalchemy.orm import defer
+from sqlalchemy.orm.exc import StaleDataError
+from wtforms import HiddenField
+
+from app import db
+from app.dedupe import DEDUPE_FIELDS, find_duplicates, write_review_csv
+from app.models import Guest
+
+# cheap row estimates per dialect, used instead of COUNT(*) for the admin pager on big tables
+ESTIMATED_COUNT_QUERIES = {
+    'postgresql': "SELECT reltuples::bigint FROM pg_class WHERE relname = :table",
+    # rowids only grow, so max(id) is an index lookup that over counts by the number of deleted guests
+    'sqlite': "SELECT MAX(id) FROM {table}",
+}
+
+
+def estimated_count(table_name: str):
+    """
+    Returns a cheap estimate of the number of rows in a table, or None if our database can't estimate
+    Args:
+        table_name (str): table to estimate
+
+    Returns:
+        int or None
+    """
+    sql = ESTIMATED_COUNT_QUERIES.get(db.session.get_bind().dialect.name)
+    if sql is None:
+        return None
+    estimate = db.session.execute(text(sql.format(table=table_name)), {'table': table_name}).scalar()
+    return int(estimate) if estimate is not None else None
+
+
+class GuestAdminView(ModelView):
+    """
+    Guest list view that stays fast on a big guest list. Sorting and filtering only use indexed columns, the page
+    size is fixed, rsvp_notes is never loaded for the list and big tables get an estimated count instead of a COUNT(*)
+    """
+    page_size = 50
+    can_set_page_size = False
+    column_list = ('name', 'total_attendees', 'phone_number', 'email_address', 'date_saved', 'rsvp',
+                   'stop_notifications', 'last_notified', 'date_modified')
+    # all of these are indexed, see migration 5c1f0e7b9a2d
+    column_sortable_list = ('name', 'phone_number', 'date_saved', 'rsvp', 'date_modified')
+    column_filters = ('date_saved', 'rsvp')
+    column_default_sort = 'id'
+    # the edit form carries the version it was rendered from instead, so saving a form someone else has changed
+    # since is refused rather than overwriting their change
+    form_excluded_columns = ('version',)
+    form_extra_fields = {'expected_version': HiddenField()}
+
+    def get_query(self):
+        return super(GuestAdminView, self).get_query().options(defer(Guest.rsvp_notes))
+
+    def get_list(self, page, sort_column, sort_desc, search, filters, execute=True, page_size=None):
+        # an estimate is only good enough for the unfiltered list
+        g.admin_estimate_count = not (search or filters)
+        return super(GuestAdminView, self).get_list(page, sort_column, sort_desc, search, filters,
+                                                    execute=execute, page_size=page_size)
+
+    def get_count_query(self):
+        if g.get('admin_estimate_count', False):
+            estimate = estimated_count(self.model.__tablename__)
+            if estimate is not None and estimate >= current_app.config['ADMIN_ESTIMATED_COUNT_THRESHOLD']:
+                return self.session.query(literal(estimate))
+        return super(GuestAdminView, self).get_count_query()
+
+    def edit_form(self, obj=None):
+        form = super(GuestAdminView, self).edit_form(obj)
+        if obj is not None and not form.expected_version.data:
+            form.expected_version.data = obj.version
+        return form
+
+    def on_model_change(self, form, model, is_created):
+        expected_version = getattr(form, 'expected_version', None)
+        if not is_created and expected_version is not None and expected_version.data:
+            if int(expected_version.data) != model.version:
+                raise StaleDataError("Guest {} has version {}, the form was for version {}".format(
+                    model.id, model.version, expected_version.data))
+
+    def handle_view_exception(self, exc):
+        if isinstance(exc, StaleDataError):
+            flash("Someone else changed this guest while you were editing it. Reload it and make your changes "
+                  "again.", 'error')
+            return True
+        return super(GuestAdminView, self).handle_view_exception(exc)
+
+
+class DuplicatesView(BaseView):
+    """
+    Downloads guests that look like duplicates as a CSV to review, see app.dedupe. The guest list is read in one query
+    as records, so this stays quick on a big list. Nothing is merged, the reviewer does that from the CSV
+    """
+
+    @expose('/')
+    def index(self):
+        guests = Guest.select_records(fields=DEDUPE_FIELDS, order_by=Guest.id)
+        suggestions, stats = find_duplicates(guests)
+        current_app.logger.info("Found %d likely duplicates in %d guests, skipped %d blocks", len(suggestions),
+                                stats['guests'], stats['skipped_blocks'])
+        output = io.StringIO()
+        write_review_csv(suggestions, output)
+        return Response(output.getvalue(), mimetype='text/csv',
+                        headers={'Content-Disposition': 'attachment; filename=duplicate_guests.csv'})
+
+
+def init_admin(app):
+    """
+    Sets up flask-admin and our model views. create_app only imports this module for admin workers, so workers that
+    only serve the api never load flask-admin and its templates
+    Args:
+        app (Flask): app to add the admin to
+    """
+    # Create admin
+    admin = Admin(app, name='Wedding Reply Site', template_mode='bootstrap3')
+
+    # Add views
+    admin.add_view(GuestAdminView(Guest, db.session))
+    admin.add_view(DuplicatesView(name='Duplicates', endpoint='duplicates'))
+    return admin
@@ -0,0 +1,252 @@
+"""
+Async entry point for the sms webhook. After a campaign goes out the replies come in faster than sync gunicorn
+workers can take them, each one holds a worker thread while it waits on the database. This serves the same webhook
+as app.resources.TwilioResponseAPI as a bare ASGI app on an async database driver, so one process can hold
+thousands of webhook requests open while they wait their turn at the connection pool.
+
+Commands, replies and MessageSid idempotency are shared with the flask resource, see app.sms. Writes go through the
+same models, so guest versioning and the change feed work the same as they do for the flask app. With the redis
+guest cache backend our writes clear the shared cache like any other worker's. With the memory backend the flask
+workers' caches are their own, like a second gunicorn worker's writes they catch up within GUEST_CACHE_TTL.
+
+See asgi.py for serving it.
+"""
+import logging
+from urllib.parse import parse_qsl
+
+from sqlalchemy import select
+from sqlalchemy.engine import make_url
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.orm import Session, sessionmaker
+
+from app.cache import InProcessCache, create_guest_cache, track_guest_cache_writes
+from app.changes import track_guest_changes
+from app.models import Guest, InboundMessage, retry_on_conflict
+from app.sms import UNKNOWN_NUMBER_REPLY, interpret, parse_webhook, render_reply
+
+logger = logging.getLogger(__name__)
+
+# the async driver we use for each database
+ASYNC_DRIVERS = {
+    'postgresql': 'postgresql+asyncpg',
+    'postgres': 'postgresql+asyncpg',
+    'sqlite': 'sqlite+aiosqlite',
+}
+# Twilio's webhook bodies are a few hundred bytes, anything this big isn't from them
+MAX_BODY_SIZE = 64 * 1024
+
+
+def async_database_uri(uri: str):
+    """
+    Swaps the sync driver in one of our database uris for the async driver of the same database
+    Args:
+        uri (str): database uri, i.e. DATABASE_URI
+
+    Returns:
+        str
+
+    Raises:
+        ValueError: if we don't have an async driver for the database
+    """
+    url = make_url(uri)
+    backend = url.get_backend_name()
+    if backend not in ASYNC_DRIVERS:
+        raise ValueError("No async driver for {} databases".format(backend))
+    return str(url.set(drivername=ASYNC_DRIVERS[backend]))
+
+
+class WebhookSession(Session):
+    """The sync session behind our AsyncSessions, it records guest changes for the change feed like RoutingSession"""
+    pass
+
+
+class SmsWebhookApp(object):
+    """ASGI app that answers Twilio's sms webhook at POST /api/sms"""
+
+    path = "/api/sms"
+
+    def __init__(self, config):
+        """
+        Args:
+            config (Mapping): our settings, see create_asgi_app
+        """
+        uri = async_database_uri(config['SQLALCHEMY_DATABASE_URI'])
+        engine_options = {}
+        if not uri.startswith("sqlite"):
+            # sqlite gets a connection per session from aiosqlite, only real databases are pooled
+            engine_options = {'pool_size': config['ASGI_DB_POOL_SIZE'],
+                              'max_overflow': config['ASGI_DB_MAX_OVERFLOW']}
+        self.engine = create_async_engine(uri, **engine_options)
+        # only a shared cache is worth clearing, this process doesn't serve the guest list
+        guest_cache = create_guest_cache(config) if config['GUEST_CACHE_BACKEND'].lower() == 'redis' else None
+        self.sessions = sessionmaker(self.engine, class_=AsyncSession, sync_session_class=WebhookSession,
+                                     expire_on_commit=False, info={'guest_cache': guest_cache})
+        size = config['SMS_REPLY_CACHE_SIZE']
+        self.replies = InProcessCache(config['SMS_REPLY_CACHE_TTL'], size) if size else None
+        self.validator = None
+        if not (config['TESTING'] or config['DEBUG']):
+            # twilio is imported on first use so it doesn't weigh down worker boot
+            from twilio.request_validator import RequestValidator
+            self.validator = RequestValidator(config['TWILIO_AUTH_TOKEN'])
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self._lifespan(receive, send)
+        elif scope['type'] == 'http':
+            await self._http(scope, receive, send)
+
+    async def _lifespan(self, receive, send):
+        """Handles server startup and shutdown, the connection pool is closed on shutdown"""
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await self.engine.dispose()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def _http(self, scope, receive, send):
+        """Routes a request, we only answer the webhook"""
+        if scope['path'].rstrip("/") != self.path:
+            await self._respond(send, 404, b"Not Found", b"text/plain")
+            return
+        if scope['method'] != "POST":
+            await self._respond(send, 405, b"Method Not Allowed", b"text/plain", [(b"allow", b"POST")])
+            return
+
+        body = await self._read_body(receive)
+        if body is None:
+            await self._respond(send, 413, b"Request Entity Too Large", b"text/plain")
+            return
+        form = dict(parse_qsl(body.decode()))
+        if not self._valid_signature(scope, form):
+            await self._respond(send, 403, b"Forbidden", b"text/plain")
+            return
+        # the same values flask's request.values has, the form over the query string
+        values = dict(parse_qsl(scope.get('query_string', b"").decode("latin-1")))
+        values.update(form)
+        twiml = await self.answer(values)
+        await self._respond(send, 200, twiml.encode(), b"application/xml")
+
+    def _valid_signature(self, scope, form: dict):
+        """
+        Checks that a request really came from Twilio, see app.resources.validate_twilio_request. Twilio signs the
+        url it called, so behind a proxy the scheme and host come from the forwarded headers
+        Args:
+            scope (dict): ASGI connection scope
+            form (dict): posted form values
+
+        Returns:
+            bool
+        """
+        if self.validator is None:
+            return True
+        headers = {name.decode("latin-1").lower(): value.decode("latin-1") for name, value in scope['headers']}
+        url = "{}://{}{}".format(headers.get('x-forwarded-proto', scope.get('scheme', "http")),
+                                 headers.get('x-forwarded-host', headers.get('host', "")),
+                                 scope.get('root_path', "") + scope['path'])
+        if scope.get('query_string'):
+            url += "?" + scope['query_string'].decode("latin-1")
+        return self.validator.validate(url, form, headers.get('x-twilio-signature', ""))
+
+    @staticmethod
+    async def _read_body(receive):
+        """
+        Reads the request body
+        Returns:
+            bytes or None - None if the body is over MAX_BODY_SIZE
+        """
+        chunks = []
+        size = 0
+        while True:
+            message = await receive()
+            chunk = message.get('body', b"")
+            size += len(chunk)
+            if size > MAX_BODY_SIZE:
+                return None
+            chunks.append(chunk)
+            if not message.get('more_body', False):
+                return b"".join(chunks)
+
+    @staticmethod
+    async def _respond(send, status: int, body: bytes, content_type: bytes, headers: list = None):
+        await send({'type': 'http.response.start',
+                    'status': status,
+                    'headers': [(b"content-type", content_type),
+                                (b"content-length", str(len(body)).encode())] + (headers or [])})
+        await send({'type': 'http.response.body', 'body': body})
+
+    async def answer(self, values):
+        """
+        Acts on a text and returns the TwiML to answer it with, see TwilioResponseAPI.post
+        Args:
+            values (dict): what Twilio posted
+
+        Returns:
+            str
+        """
+        message_sid, from_number, body = parse_webhook(values)
+        if message_sid is not None and self.replies is not None:
+            twiml = self.replies.get(message_sid)
+            if twiml is not None:
+                return twiml
+
+        twiml = render_reply(await self._reply_to(from_number, body, message_sid))
+        if message_sid is not None and self.replies is not None:
+            self.replies.set(message_sid, twiml)
+        return twiml
+
+    @retry_on_conflict()
+    async def _reply_to(self, from_number: str, body: str, message_sid: str = None):
+        """
+        Acts on a text from a guest, exactly once per MessageSid, see TwilioResponseAPI._reply_to
+        Args:
+            from_number (str): phone number the text came from
+            body (str): lower cased text of the message
+            message_sid (str): Twilio's id for the message, if it sent one
+
+        Returns:
+            str or None - what to text back, if anything
+        """
+        # closing the session rolls back anything we didn't commit
+        async with self.sessions() as session:
+            guest = (await session.execute(
+                select(Guest).filter_by(phone_number=from_number).limit(1))).scalars().first()
+            if guest is None:
+                logger.debug("Invalid response number %s - body %s", from_number, body)
+                reply = UNKNOWN_NUMBER_REPLY
+            else:
+                reply = interpret(guest, body)
+
+            if message_sid is not None:
+                session.add(InboundMessage(message_sid, from_number, body, reply))
+            try:
+                await session.commit()
+            except IntegrityError:
+                await session.rollback()
+                duplicate = (await session.execute(
+                    select(InboundMessage.reply).filter_by(message_sid=message_sid))).first()
+                if duplicate is None:
+                    raise
+                return duplicate.reply
+            return reply
+
+
+def create_asgi_app(config=None):
+    """
+    Creates the async sms webhook app
+    Args:
+        config (Config): our settings, defaults to instance.config.Config
+
+    Returns:
+        SmsWebhookApp
+    """
+    from instance.config import Config
+
+    config = config or Config()
+    track_guest_changes(WebhookSession)
+    track_guest_cache_writes(WebhookSession)
+    # the upper case attributes, the same settings flask's config.from_object picks up
+    return SmsWebhookApp({key: getattr(config, key) for key in dir(config) if key.isupper()})
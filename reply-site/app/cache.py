@@ -0,0 +1,217 @@
+import threading
+import time
+from collections import OrderedDict
+
+from flask import current_app, has_app_context
+from sqlalchemy import event
+
+
+class InProcessCache(object):
+    """
+    LRU cache with a TTL that lives in the worker's memory. Each gunicorn worker has its own copy, so a write
+    handled by one worker only invalidates that worker's cache and the others can serve stale entries for up to the
+    TTL. Use RedisCache when that matters
+    """
+
+    def __init__(self, ttl: int, max_size: int):
+        """
+        Args:
+            ttl (int): seconds an entry is valid for
+            max_size (int): entries to keep before evicting the least recently used
+        """
+        self.ttl = ttl
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str):
+        """
+        Returns the cached value for key, or None if it is missing or expired
+        Args:
+            key (str): cache key
+
+        Returns:
+            bytes or None
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires, value = entry
+            if expires < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key: str, value: bytes):
+        """
+        Caches value under key, evicting the least recently used entry if we are full
+        Args:
+            key (str): cache key
+            value (bytes): value to cache
+        """
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        """Drops every entry"""
+        with self._lock:
+            self._entries.clear()
+
+
+class RedisCache(object):
+    """
+    Cache stored in a redis protocol server, so every worker shares one cache. Entries expire with the TTL and
+    eviction is left to the server's maxmemory-policy (use allkeys-lru). Invalidation bumps a generation counter
+    that is part of every key, so clearing is a single INCR no matter how many entries there are
+    """
+
+    def __init__(self, client, ttl: int, prefix: str = "wm:guest-list:"):
+        """
+        Args:
+            client: redis client, or anything with get, set(ex=) and incr
+            ttl (int): seconds an entry is valid for
+            prefix (str): prefix for all of our keys
+        """
+        self.client = client
+        self.ttl = ttl
+        self.prefix = prefix
+
+    def _key(self, key: str):
+        generation = self.client.get(self.prefix + "generation") or b"0"
+        if isinstance(generation, bytes):
+            generation = generation.decode()
+        return "{}{}:{}".format(self.prefix, generation, key)
+
+    def get(self, key: str):
+        return self.client.get(self._key(key))
+
+    def set(self, key: str, value: bytes):
+        self.client.set(self._key(key), value, ex=self.ttl)
+
+    def clear(self):
+        self.client.incr(self.prefix + "generation")
+
+
+def get_guest_cache():
+    """
+    Returns the guest list cache for the current app, or None if caching is turned off
+
+    Returns:
+        InProcessCache or RedisCache or None
+    """
+    return current_app.extensions.get('guest_cache')
+
+
+def get_sms_reply_cache():
+    """
+    Returns the cache of the TwiML we answered recent text messages with, keyed on MessageSid
+
+    Returns:
+        InProcessCache or None
+    """
+    return current_app.extensions.get('sms_reply_cache')
+
+
+def init_sms_reply_cache(app):
+    """
+    Sets up the sms reply cache. It's always in process, it only has to catch Twilio retrying a webhook on the worker
+    that already answered it, inbound_messages catches the rest
+    Args:
+        app (Flask): app to add the cache to
+    """
+    size = app.config['SMS_REPLY_CACHE_SIZE']
+    app.extensions['sms_reply_cache'] = InProcessCache(app.config['SMS_REPLY_CACHE_TTL'], size) if size else None
+
+
+def _is_guest(obj):
+    from app.models import Guest
+    return isinstance(obj, Guest)
+
+
+def _track_guest_writes(session, flush_context):
+    if any(_is_guest(obj) for obj in list(session.new) + list(session.dirty) + list(session.deleted)):
+        session.info['guest_cache_dirty'] = True
+
+
+def _track_guest_bulk_writes(update_context):
+    from app.models import Guest
+    if update_context.mapper is not None and update_context.mapper.class_ is Guest:
+        update_context.session.info['guest_cache_dirty'] = True
+
+
+def _session_guest_cache(session):
+    """
+    Returns the guest list cache writes through session have to clear. Sessions made outside of flask, see app.asgi,
+    carry theirs in session.info
+    """
+    if 'guest_cache' in session.info:
+        return session.info['guest_cache']
+    return get_guest_cache() if has_app_context() else None
+
+
+def _invalidate_after_commit(session):
+    if session.info.pop('guest_cache_dirty', False):
+        cache = _session_guest_cache(session)
+        if cache is not None:
+            cache.clear()
+
+
+def _forget_after_rollback(session):
+    session.info.pop('guest_cache_dirty', None)
+
+
+def create_guest_cache(config):
+    """
+    Creates the guest list cache named by the GUEST_CACHE_BACKEND setting
+    Args:
+        config (Mapping): our settings, i.e. app.config
+
+    Returns:
+        InProcessCache or RedisCache or None - None when caching is turned off
+    """
+    backend = config['GUEST_CACHE_BACKEND'].lower()
+    if backend == 'memory':
+        return InProcessCache(config['GUEST_CACHE_TTL'], config['GUEST_CACHE_SIZE'])
+    if backend == 'redis':
+        import redis
+        return RedisCache(redis.Redis.from_url(config['GUEST_CACHE_REDIS_URL']), config['GUEST_CACHE_TTL'])
+    if backend == 'none':
+        return None
+    raise ValueError("Unknown guest cache backend {}".format(backend))
+
+
+def track_guest_cache_writes(session_class):
+    """
+    Registers the session events that clear the guest list cache whenever a guest is written through a session of
+    session_class
+    Args:
+        session_class (type): sqlalchemy Session subclass
+    """
+    listeners = (
+        ('after_flush', _track_guest_writes),
+        ('after_bulk_update', _track_guest_bulk_writes),
+        ('after_bulk_delete', _track_guest_bulk_writes),
+        ('after_commit', _invalidate_after_commit),
+        ('after_rollback', _forget_after_rollback),
+    )
+    for session_event, listener in listeners:
+        if not event.contains(session_class, session_event, listener):
+            event.listen(session_class, session_event, listener)
+
+
+def init_guest_cache(app):
+    """
+    Sets up the guest list cache for the app and the session events that invalidate it whenever a guest is written,
+    whether through the api, bulk updates or the admin
+    Args:
+        app (Flask): app to add the cache to
+    """
+    from app.routing import RoutingSession
+
+    app.extensions['guest_cache'] = create_guest_cache(app.config)
+    track_guest_cache_writes(RoutingSession)
@@ -0,0 +1,274 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+from flask import current_app
+from jinja2.sandbox import SandboxedEnvironment
+
+from app import db
+
+# campaign templates come in over the api, so they are rendered in jinja's sandbox
+_template_environment = SandboxedEnvironment()
+
+
+class TwilioSender(object):
+    """Sends text messages through Twilio"""
+
+    def __init__(self, account_sid: str, auth_token: str, from_number: str):
+        """
+        Args:
+            account_sid (str): Twilio account sid
+            auth_token (str): Twilio auth token
+            from_number (str): Number to send from
+        """
+        # twilio is imported on first use so it doesn't weigh down worker boot
+        from twilio.rest import Client
+        self.client = Client(account_sid, auth_token)
+        self.from_number = from_number
+
+    def send(self, to_number: str, body: str):
+        """
+        Sends a text message
+        Args:
+            to_number (str): Number to send to
+            body (str): Message to send
+
+        Returns:
+            str - Twilio's id for the message
+        """
+        return self.client.api.account.messages.create(to=to_number, from_=self.from_number, body=body).sid
+
+
+class FakeSender(object):
+    """
+    Sender that just remembers what it was asked to send, for tests and local development. Numbers in fail_numbers
+    raise instead
+    """
+
+    def __init__(self, fail_numbers=()):
+        self.fail_numbers = set(fail_numbers)
+        self.sent = []
+        self._lock = threading.Lock()
+
+    def send(self, to_number: str, body: str):
+        if to_number in self.fail_numbers:
+            raise RuntimeError("Fake failure sending to {}".format(to_number))
+        with self._lock:
+            self.sent.append((to_number, body))
+            return "SMFAKE{:026d}".format(len(self.sent))
+
+
+def init_sender(app):
+    """
+    Creates the sender named by the SMS_SENDER setting for the app, unless one was already set up (i.e. by a test)
+    Args:
+        app (Flask): app to add the sender to
+
+    Returns:
+        TwilioSender or FakeSender
+    """
+    if 'sms_sender' not in app.extensions:
+        backend = app.config['SMS_SENDER'].lower()
+        if backend == 'twilio':
+            app.extensions['sms_sender'] = TwilioSender(app.config['TWILIO_ACCOUNT_SID'],
+                                                        app.config['TWILIO_AUTH_TOKEN'],
+                                                        app.config['TWILIO_FROM_NUMBER'])
+        elif backend == 'fake':
+            app.extensions['sms_sender'] = FakeSender()
+        else:
+            raise ValueError("Unknown sms sender {}".format(backend))
+    return app.extensions['sms_sender']
+
+
+class RateLimiter(object):
+    """Spaces calls to wait() out so they happen at most rate times a second, across threads"""
+
+    def __init__(self, rate: float):
+        """
+        Args:
+            rate (float): calls per second, 0 for no limit
+        """
+        self.interval = 1.0 / rate if rate else 0
+        self._next = time.monotonic()
+        self._lock = threading.Lock()
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self._lock:
+            now = time.monotonic()
+            slot = max(self._next, now)
+            self._next = slot + self.interval
+        time.sleep(slot - now)
+
+
+def compile_template(template: str):
+    """
+    Compiles a campaign template
+    Args:
+        template (str): Jinja template
+
+    Returns:
+        jinja2.Template
+
+    Raises:
+        jinja2.TemplateSyntaxError: if the template is broken
+    """
+    return _template_environment.from_string(template)
+
+
+def _send_one(sender, limiter, recipient_id: int, to_number: str, body: str):
+    """
+    Sends one message, waiting for our turn under the rate limit
+    Returns:
+        tuple(int, str, str, str) - recipient id, status, message sid and error
+    """
+    limiter.wait()
+    try:
+        return recipient_id, 'sent', sender.send(to_number, body), None
+    except Exception as exc:
+        return recipient_id, 'failed', None, str(exc)
+
+
+def _guest_batches(criteria: list, batch_size: int):
+    """
+    Generator of the guests matching criteria a batch at a time, paging by id so we never hold the whole guest list
+    Args:
+        criteria (list): where clauses, see Campaign.recipient_criteria
+        batch_size (int): guests per batch
+
+    Yields:
+        list - GuestRecords, the guests are only read so they needn't be full models
+    """
+    from app.models import Guest
+
+    last_id = 0
+    while True:
+        batch = Guest.select_records([Guest.id > last_id] + list(criteria), order_by=Guest.id, limit=batch_size)
+        if not batch:
+            return
+        last_id = batch[-1].id
+        yield batch
+
+
+def send_campaign(campaign, sender, batch_size: int, pool_size: int, rate: float):
+    """
+    Sends a campaign to every guest in its segment. Recipients are recorded before their batch is sent and updated
+    with the outcome after, guests a campaign already reached are skipped, so a campaign that was interrupted can be
+    run again. A guest whose batch was interrupted mid send can get the message twice
+    Args:
+        campaign (Campaign): campaign to send
+        sender (TwilioSender or FakeSender): what sends the messages
+        batch_size (int): guests to load and send per batch
+        pool_size (int): messages to send in parallel
+        rate (float): most messages to send per second, 0 for no limit
+    """
+    from app.models import Campaign, CampaignRecipient
+
+    # read up front, the campaign expires every time we commit
+    campaign_id = campaign.id
+    criteria = campaign.recipient_criteria()
+    template = compile_template(campaign.template)
+    limiter = RateLimiter(rate)
+    with ThreadPoolExecutor(max_workers=pool_size) as pool:
+        for guests in _guest_batches(criteria, batch_size):
+            existing = {recipient.guest_id: recipient for recipient in CampaignRecipient.query.filter(
+                CampaignRecipient.campaign_id == campaign_id,
+                CampaignRecipient.guest_id.in_([guest.id for guest in guests]))}
+            guests = [guest for guest in guests
+                      if guest.id not in existing or existing[guest.id].status != 'sent']
+            if not guests:
+                continue
+
+            # render before we touch the recipients table, so a broken template fails without recording anything.
+            # The pool only gets plain values, the models expire when we commit
+            messages = [(guest.id, guest.phone_number, template.render(**guest.to_json())) for guest in guests]
+            recipients = []
+            for guest_id, phone_number, _ in messages:
+                recipient = existing.get(guest_id)
+                if recipient is None:
+                    recipient = CampaignRecipient(campaign_id=campaign_id, guest_id=guest_id,
+                                                  phone_number=phone_number)
+                    db.session.add(recipient)
+                recipient.status = 'pending'
+                recipient.error = None
+                recipients.append(recipient)
+            db.session.flush()
+            recipient_ids = [recipient.id for recipient in recipients]
+            db.session.commit()
+
+            results = pool.map(lambda args: _send_one(sender, limiter, *args),
+                               [(recipient_id, phone_number, body)
+                                for recipient_id, (_, phone_number, body) in zip(recipient_ids, messages)])
+            sent_at = datetime.utcnow()
+            db.session.bulk_update_mappings(CampaignRecipient, [
+                {'id': recipient_id, 'status': status, 'message_sid': sid, 'error': error,
+                 'date_sent': sent_at if status == 'sent' else None}
+                for recipient_id, status, sid, error in results])
+            # lets the other workers know we're still at it, see claim_next_campaign
+            Campaign.query.filter(Campaign.id == campaign_id).update({'date_heartbeat': sent_at},
+                                                                     synchronize_session=False)
+            db.session.commit()
+            current_app.logger.info("Campaign {} sent a batch of {}".format(campaign_id, len(messages)))
+
+
+def claim_next_campaign(stale_seconds: float = 0):
+    """
+    Marks the oldest pending campaign as running and returns it. The update only matches a campaign that is still
+    claimable, so when several workers race for one only one of them gets it. A running campaign whose worker hasn't
+    checked in for stale_seconds was left behind by a worker that died, it's claimed again and send_campaign picks up
+    where it stopped
+    Args:
+        stale_seconds (float): how long a running campaign can go without a heartbeat, 0 to never reclaim one
+
+    Returns:
+        Campaign or None
+    """
+    from app.models import Campaign
+
+    claimable = Campaign.status == 'pending'
+    if stale_seconds:
+        # a campaign that died before its first batch only has date_started
+        last_seen = db.func.coalesce(Campaign.date_heartbeat, Campaign.date_started)
+        claimable = db.or_(claimable, db.and_(Campaign.status == 'running',
+                                              last_seen < datetime.utcnow() - timedelta(seconds=stale_seconds)))
+    for campaign_id, in db.session.query(Campaign.id).filter(claimable).order_by(Campaign.id).all():
+        now = datetime.utcnow()
+        claimed = Campaign.query.filter(Campaign.id == campaign_id, claimable).update(
+            {'status': 'running', 'date_started': now, 'date_heartbeat': now}, synchronize_session=False)
+        db.session.commit()
+        if claimed:
+            return Campaign.query.get(campaign_id)
+    return None
+
+
+def run_worker(once: bool = False):
+    """
+    Sends pending campaigns, one at a time, until stopped. Run this in its own process with an app context, see
+    manage.py campaign_worker
+    Args:
+        once (bool): stop when there are no pending campaigns left, instead of polling for more
+    """
+    config = current_app.config
+    sender = init_sender(current_app)
+    while True:
+        campaign = claim_next_campaign(config['CAMPAIGN_STALE_SECONDS'])
+        if campaign is None:
+            if once:
+                return
+            time.sleep(config['CAMPAIGN_POLL_SECONDS'])
+            continue
+
+        current_app.logger.info("Sending campaign {}".format(campaign.id))
+        try:
+            send_campaign(campaign, sender, config['CAMPAIGN_BATCH_SIZE'], config['CAMPAIGN_POOL_SIZE'],
+                          config['CAMPAIGN_SEND_RATE'])
+            campaign.status = 'done'
+        except Exception as exc:
+            db.session.rollback()
+            current_app.logger.exception("Campaign {} failed".format(campaign.id))
+            campaign.status = 'failed'
+            campaign.error = str(exc)
+        campaign.date_finished = datetime.utcnow()
+        db.session.commit()
@@ -0,0 +1,201 @@
+import threading
+import time
+from datetime import datetime
+
+from sqlalchemy import event, func, inspect, literal, text
+
+from app import db
+from app.encoding import dumps
+
+# bookkeeping columns that are written on every change, events carry date_modified on their own
+IGNORED_FIELDS = ('version', 'date_created', 'date_modified')
+# idle streams send an SSE comment this often, so proxies don't time the connection out
+HEARTBEAT_SECONDS = 15
+# clients turned away because every stream slot is taken are asked to come back after this long
+STREAM_RETRY_AFTER_SECONDS = 5
+# key of the postgres advisory lock that orders change ids, see _lock_change_ids
+CHANGE_ID_LOCK = 0x6775657374
+
+
+def _written_fields(guest):
+    """
+    Returns the names of the fields of a guest that are being written by the current flush
+    Args:
+        guest (Guest): guest being flushed
+
+    Returns:
+        list
+    """
+    return [attr.key for attr in inspect(guest).attrs
+            if attr.key not in IGNORED_FIELDS and attr.history.has_changes()]
+
+
+def _lock_change_ids(session):
+    """
+    Makes change ids follow commit order, which is what lets streams use the last id they sent as their cursor.
+    Postgres hands out ids as rows are inserted, so two writers could commit out of id order and a stream that
+    already read the higher id would skip the lower one for good. Writers take this transaction level lock before
+    recording changes, so the next writer only gets ids once the last one has committed. sqlite only ever has one
+    writer at a time already
+    Args:
+        session (Session): session about to record changes
+    """
+    connection = session.connection()
+    if connection.dialect.name == 'postgresql':
+        connection.execute(text("SELECT pg_advisory_xact_lock(:key)"), {'key': CHANGE_ID_LOCK})
+
+
+def _record_guest_changes(session, flush_context):
+    """
+    Writes a guest_changes row for every guest in the flush. This runs in the flush's transaction, so a change is only
+    ever visible to the feed along with the write it describes
+    """
+    from app.models import Guest, GuestChange
+
+    changes = []
+    for operation, objs in (('insert', session.new), ('update', session.dirty), ('delete', session.deleted)):
+        for obj in objs:
+            if not isinstance(obj, Guest):
+                continue
+            if operation == 'update' and not session.is_modified(obj):
+                continue
+            fields = [] if operation == 'delete' else _written_fields(obj)
+            changes.append({'guest_id': obj.id, 'operation': operation, 'changed_fields': ",".join(fields)})
+    if changes:
+        _lock_change_ids(session)
+        session.execute(GuestChange.__table__.insert(), changes)
+
+
+def record_bulk_guest_changes(criteria: list, fields):
+    """
+    Records a change for every guest a bulk update is about to write, with a single INSERT ... SELECT. Bulk updates
+    don't go through the session's flush, so _record_guest_changes never sees them
+    Args:
+        criteria (list): where clauses of the bulk update
+        fields (iterable): names of the fields the update sets
+    """
+    from app.models import Guest, GuestChange
+
+    _lock_change_ids(db.session)
+    changed_fields = ",".join(sorted(field for field in fields if field not in IGNORED_FIELDS))
+    guests = db.session.query(Guest.id, literal('update'), literal(changed_fields), func.current_timestamp()).filter(
+        *criteria)
+    db.session.execute(GuestChange.__table__.insert().from_select(
+        ['guest_id', 'operation', 'changed_fields', 'date_modified'], guests.statement))
+
+
+def resolve_cursor(last_event_id: str = None, since: str = None):
+    """
+    Works out where a client's stream starts. Reconnecting clients send the id of the last event they saw, clients
+    that just loaded the guest list can pass the newest date_modified they have and get every change from then on.
+    Everyone else starts with the next change
+
+    Args:
+        last_event_id (str): Last-Event-ID of a reconnecting client
+        since (str): ISO 8601 timestamp
+
+    Returns:
+        int - id of the last change the client has seen
+
+    Raises:
+        ValueError: if last_event_id or since can't be parsed
+    """
+    from app.models import GuestChange
+
+    if last_event_id:
+        return int(last_event_id)
+    query = db.session.query(func.max(GuestChange.id))
+    if since:
+        # changes in the same second as since are sent again rather than risk missing one
+        query = query.filter(GuestChange.date_modified < datetime.fromisoformat(since))
+    cursor = query.scalar() or 0
+    db.session.close()
+    return cursor
+
+
+def _format_event(change):
+    """
+    Formats a guest_changes row as a server sent event
+    Args:
+        change: guest_changes row
+
+    Returns:
+        str
+    """
+    data = dumps({
+        'id': change.guest_id,
+        'op': change.operation,
+        'fields': change.changed_fields.split(",") if change.changed_fields else [],
+        'date_modified': change.date_modified,
+    })
+    return "id: {}\nevent: guest\ndata: {}\n\n".format(change.id, data.decode())
+
+
+def change_stream(cursor: int, poll_seconds: float, max_seconds: float, batch_size: int):
+    """
+    Generator of server sent events for every guest change after cursor. Changes are polled from the guest_changes
+    table, so every gunicorn worker sees every write no matter which worker made it. The stream ends after
+    max_seconds so it doesn't hold a worker forever, EventSource clients reconnect with the Last-Event-ID and pick up
+    where they left off
+
+    Args:
+        cursor (int): id of the last change the client has seen
+        poll_seconds (float): how long to wait between polls when there's nothing new
+        max_seconds (float): how long to keep the stream open
+        batch_size (int): most changes to read per poll
+
+    Yields:
+        str
+    """
+    from app.models import GuestChange
+
+    table = GuestChange.__table__
+    deadline = time.monotonic() + max_seconds
+    last_sent = time.monotonic()
+    yield "retry: {}\n\n".format(int(poll_seconds * 1000))
+    while True:
+        changes = db.session.execute(
+            table.select().where(table.c.id > cursor).order_by(table.c.id).limit(batch_size)).fetchall()
+        # hand the connection back to the pool between polls
+        db.session.close()
+        for change in changes:
+            cursor = change.id
+            yield _format_event(change)
+
+        now = time.monotonic()
+        if now >= deadline:
+            return
+        if changes:
+            last_sent = now
+            if len(changes) == batch_size:
+                # there's a backlog, keep reading
+                continue
+        elif now - last_sent >= HEARTBEAT_SECONDS:
+            yield ": keepalive\n\n"
+            last_sent = now
+        time.sleep(poll_seconds)
+
+
+def track_guest_changes(session_class):
+    """
+    Registers the session event that records guest changes for the change feed on a session class
+    Args:
+        session_class (type): sqlalchemy Session subclass
+    """
+    if not event.contains(session_class, 'after_flush', _record_guest_changes):
+        event.listen(session_class, 'after_flush', _record_guest_changes)
+
+
+def init_change_feed(app):
+    """
+    Sets up the session event that records guest changes for the change feed. Every app role registers it, so writes
+    through the api, the sms webhook and the admin are all recorded. Also sets up the slots that cap how many streams
+    a worker holds open, see CHANGE_FEED_MAX_STREAMS
+    Args:
+        app (Flask): app being set up
+    """
+    from app.routing import RoutingSession
+
+    track_guest_changes(RoutingSession)
+    limit = app.config['CHANGE_FEED_MAX_STREAMS']
+    app.extensions['change_feed_streams'] = threading.BoundedSemaphore(limit) if limit else None
@@ -0,0 +1,220 @@
+"""
+Finds guests that are likely the same household entered twice, i.e. "John & Jane Doe" and "Jane and John Doe", or the
+same phone number formatted two ways. Comparing every guest with every other guest doesn't scale, so guests are put
+in blocks by normalized phone number, email address and sorted name tokens, and only guests that share a block are
+compared. Blocks bigger than MAX_BLOCK_SIZE are skipped, a key that many guests share (a common name, a placeholder
+number) doesn't tell them apart, which keeps the work near linear in the number of guests.
+
+Pairs are scored on how alike their names are and whether their phone numbers and email addresses match, pairs
+scoring at least DUPLICATE_THRESHOLD are suggested for merging. Two households can share a name, so the same name
+alone isn't enough, it takes a phone number or email address in common too. Nothing is merged here, the suggestions
+go out as a CSV for someone to review, see write_review_csv and the admin's duplicates view.
+"""
+import csv
+import re
+from collections import namedtuple
+from difflib import SequenceMatcher
+from itertools import combinations
+
+# pairs scoring at least this are suggested, more than a matching name alone scores
+DUPLICATE_THRESHOLD = 0.7
+# blocks with more guests than this are skipped, see the module docs
+MAX_BLOCK_SIZE = 50
+# how much each kind of match counts towards a pair's score, they add up to 1
+NAME_WEIGHT = 0.6
+PHONE_WEIGHT = 0.25
+EMAIL_WEIGHT = 0.15
+# words that say nothing about who a household is
+NAME_STOPWORDS = frozenset(["and", "the", "family", "mr", "mrs", "ms", "miss", "dr", "jr", "sr"])
+# the fields a guest needs for deduping
+DEDUPE_FIELDS = ('id', 'name', 'phone_number', 'email_address', 'date_saved', 'rsvp')
+
+Suggestion = namedtuple('Suggestion', ['score', 'keep', 'duplicate', 'matched_on'])
+
+_non_digits = re.compile(r"\D")
+_name_separators = re.compile(r"[^\w]+")
+
+
+def normalize_phone(phone_number: str):
+    """
+    Returns a phone number as just its digits, without the US country code
+    Args:
+        phone_number (str): phone number in any format, i.e. (555) 555-5555 or +15555555555
+
+    Returns:
+        str - empty if the number is too short to be a phone number
+    """
+    digits = _non_digits.sub("", phone_number or "")
+    if len(digits) == 11 and digits[0] == "1":
+        digits = digits[1:]
+    return digits if len(digits) >= 7 else ""
+
+
+def normalize_email(email_address: str):
+    """
+    Returns an email address lower cased and trimmed
+    Args:
+        email_address (str): email address
+
+    Returns:
+        str - empty if there isn't one
+    """
+    email_address = (email_address or "").strip().lower()
+    return email_address if "@" in email_address else ""
+
+
+def name_tokens(name: str):
+    """
+    Returns the words of a guest's name that identify them, lower cased and sorted, so the order names are written in
+    doesn't matter
+    Args:
+        name (str): name of the guest group, i.e. John & Jane Doe
+
+    Returns:
+        tuple
+    """
+    return tuple(sorted(token for token in _name_separators.sub(" ", (name or "").lower()).split()
+                        if token not in NAME_STOPWORDS))
+
+
+class _Keys(object):
+    """The normalized values of a guest that blocking and scoring work from"""
+
+    __slots__ = ('guest', 'phone', 'email', 'tokens', 'name')
+
+    def __init__(self, guest):
+        self.guest = guest
+        self.phone = normalize_phone(guest.phone_number)
+        self.email = normalize_email(guest.email_address)
+        self.tokens = name_tokens(guest.name)
+        self.name = " ".join(self.tokens)
+
+    def blocks(self):
+        """
+        Returns the blocks the guest goes in
+        Returns:
+            list - (kind, key) tuples
+        """
+        blocks = []
+        if self.phone:
+            blocks.append(('phone', self.phone))
+        if self.email:
+            blocks.append(('email', self.email))
+        if self.tokens:
+            blocks.append(('name', self.name))
+        return blocks
+
+
+def name_similarity(tokens, other_tokens):
+    """
+    Returns how alike two names are, from 0 to 1. Takes the better of the share of words they have in common and how
+    alike their sorted words are as strings, so both a missing word and a typo count as close
+    Args:
+        tokens (tuple): see name_tokens
+        other_tokens (tuple): see name_tokens
+
+    Returns:
+        float
+    """
+    if not tokens or not other_tokens:
+        return 0.0
+    if tokens == other_tokens:
+        return 1.0
+    words, other_words = set(tokens), set(other_tokens)
+    overlap = len(words & other_words) / len(words | other_words)
+    return max(overlap, SequenceMatcher(None, " ".join(tokens), " ".join(other_tokens)).ratio())
+
+
+def _score(keys, other_keys):
+    """
+    Scores a pair of guests
+    Returns:
+        tuple(float, list) - the score and what matched
+    """
+    matched_on = []
+    similarity = name_similarity(keys.tokens, other_keys.tokens)
+    if similarity == 1.0:
+        matched_on.append('name')
+    score = NAME_WEIGHT * similarity
+    if keys.phone and keys.phone == other_keys.phone:
+        score += PHONE_WEIGHT
+        matched_on.append('phone')
+    if keys.email and keys.email == other_keys.email:
+        score += EMAIL_WEIGHT
+        matched_on.append('email')
+    return score, matched_on
+
+
+def _keeper(guest, other):
+    """
+    Picks which of two duplicates to keep, the one that has answered us, or else the one entered first
+    Returns:
+        tuple - the guest to keep and the duplicate
+    """
+    def answers(candidate):
+        return sum(getattr(candidate, field, None) is not None for field in ('date_saved', 'rsvp'))
+
+    if (-answers(other), other.id) < (-answers(guest), guest.id):
+        return other, guest
+    return guest, other
+
+
+def find_duplicates(guests, threshold: float = DUPLICATE_THRESHOLD, max_block_size: int = MAX_BLOCK_SIZE):
+    """
+    Finds pairs of guests that are likely duplicates
+    Args:
+        guests (iterable): guests or guest records, with at least DEDUPE_FIELDS
+        threshold (float): least score to suggest a pair
+        max_block_size (int): blocks with more guests than this are skipped
+
+    Returns:
+        tuple(list, dict) - Suggestions, best first, and stats: guests, blocks, skipped_blocks and the pairs compared
+    """
+    blocks = {}
+    for guest in guests:
+        keys = _Keys(guest)
+        for block in keys.blocks():
+            blocks.setdefault(block, []).append(keys)
+
+    stats = {'guests': 0, 'blocks': len(blocks), 'skipped_blocks': 0, 'compared': 0}
+    stats['guests'] = len({keys.guest.id for members in blocks.values() for keys in members})
+    compared = set()
+    suggestions = []
+    for members in blocks.values():
+        if len(members) > max_block_size:
+            stats['skipped_blocks'] += 1
+            continue
+        for keys, other_keys in combinations(members, 2):
+            pair = (keys.guest.id, other_keys.guest.id) if keys.guest.id < other_keys.guest.id else \
+                (other_keys.guest.id, keys.guest.id)
+            # guests that share a phone number and a name meet in two blocks, they are only scored once
+            if pair[0] == pair[1] or pair in compared:
+                continue
+            compared.add(pair)
+            score, matched_on = _score(keys, other_keys)
+            if score >= threshold:
+                keep, duplicate = _keeper(keys.guest, other_keys.guest)
+                suggestions.append(Suggestion(round(score, 3), keep, duplicate, matched_on))
+    stats['compared'] = len(compared)
+    suggestions.sort(key=lambda suggestion: (-suggestion.score, suggestion.keep.id, suggestion.duplicate.id))
+    return suggestions, stats
+
+
+REVIEW_CSV_HEADER = ['score', 'matched_on', 'keep_id', 'keep_name', 'keep_phone_number', 'keep_email_address',
+                     'duplicate_id', 'duplicate_name', 'duplicate_phone_number', 'duplicate_email_address', 'merge']
+
+
+def write_review_csv(suggestions: list, file_handler):
+    """
+    Writes merge suggestions as a CSV for someone to review, the merge column is left for them to fill in
+    Args:
+        suggestions (list): Suggestions, see find_duplicates
+        file_handler: writeable text file
+    """
+    writer = csv.writer(file_handler)
+    writer.writerow(REVIEW_CSV_HEADER)
+    for suggestion in suggestions:
+        keep, duplicate = suggestion.keep, suggestion.duplicate
+        writer.writerow([suggestion.score, " ".join(suggestion.matched_on),
+                         keep.id, keep.name, keep.phone_number, keep.email_address,
+                         duplicate.id, duplicate.name, duplicate.phone_number, duplicate.email_address, ""])
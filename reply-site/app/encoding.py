@@ -0,0 +1,115 @@
+import json
+from datetime import date, datetime
+
+from flask import Response, current_app, stream_with_context
+from flask.json.provider import DefaultJSONProvider
+
+# orjson is much faster than the stdlib encoder and understands datetimes natively. It's optional, without it we
+# fall back to the stdlib json module
+try:
+    import orjson
+except ImportError:  # pragma: no cover - depends on the environment
+    orjson = None
+
+
+def _default(obj):
+    """
+    Encodes the objects the json libraries don't know about. Anything with a json_values method (our models) is
+    encoded from its raw column values
+
+    Args:
+        obj (any): object to encode
+
+    Returns:
+        any - json serializable version of obj
+    """
+    json_values = getattr(obj, 'json_values', None)
+    if json_values is not None:
+        return json_values()
+    if isinstance(obj, (datetime, date)):
+        return obj.isoformat()
+    raise TypeError("Object of type {} is not JSON serializable".format(type(obj).__name__))
+
+
+class ModelJSONProvider(DefaultJSONProvider):
+    """flask's json, i.e. jsonify, with our models encoded the same way as the api encodes them"""
+
+    @staticmethod
+    def default(obj):
+        return _default(obj)
+
+
+def _records_to_dicts(obj):
+    """
+    The stdlib encoder writes tuples out as arrays without asking _default, so the namedtuple records of
+    app.models.ModelRecord have to be turned into dicts before they get to it. orjson asks _default about them
+
+    Args:
+        obj (any): object to encode
+
+    Returns:
+        any
+    """
+    if isinstance(obj, list):
+        return [_records_to_dicts(item) for item in obj]
+    if isinstance(obj, dict):
+        return {key: _records_to_dicts(value) for key, value in obj.items()}
+    if isinstance(obj, tuple) and hasattr(obj, 'json_values'):
+        return obj.json_values()
+    return obj
+
+
+def dumps(obj):
+    """
+    Encodes obj to json with the fastest encoder we have
+
+    Args:
+        obj (any): object to encode
+
+    Returns:
+        bytes
+    """
+    if orjson is not None:
+        return orjson.dumps(obj, default=_default)
+    return json.dumps(_records_to_dicts(obj), default=_default, separators=(',', ':')).encode()
+
+
+def _stream_array(items: list, chunk_size: int):
+    """
+    Generator that encodes a list as a json array a chunk at a time, so we never hold the whole payload in memory
+
+    Args:
+        items (list): items to encode
+        chunk_size (int): items to encode per chunk
+
+    Yields:
+        bytes
+    """
+    yield b"["
+    for start in range(0, len(items), chunk_size):
+        if start:
+            yield b","
+        # encode the chunk as an array and strip the brackets so it joins onto the previous chunk
+        yield dumps(items[start:start + chunk_size])[1:-1]
+    yield b"]"
+
+
+def output_json(data, code, headers=None):
+    """
+    flask-restful representation for application/json. Large lists are streamed
+
+    Args:
+        data (any): data returned by the resource
+        code (int): status code
+        headers (dict): extra headers
+
+    Returns:
+        Response
+    """
+    if isinstance(data, list) and len(data) > current_app.config['JSON_STREAM_THRESHOLD']:
+        body = stream_with_context(_stream_array(data, current_app.config['JSON_STREAM_CHUNK_SIZE']))
+    else:
+        body = dumps(data)
+    response = Response(body, status=code, mimetype="application/json")
+    response.headers.extend(headers or {})
+    return response
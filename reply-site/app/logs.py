@@ -0,0 +1,173 @@
+"""
+Logging for the app. Config.LOGGING_CONFIG is applied when the first app is created, but the handlers it sets up
+don't run on the threads serving requests. Each configured logger gets a QueueHandler in their place, and a
+QueueListener thread hands its records on to the real handlers, so writing to a slow stdout or log shipper never holds
+up a response. A logger's queue holds at most LOG_QUEUE_SIZE records, when it's full new records are dropped and
+counted rather than making the request wait.
+
+With REQUEST_LOG on, every request also gets one JSON line on the app.requests logger, with its endpoint, method,
+status, latency and the queries it ran and time it spent in the database. The request thread only collects numbers
+it already has, the line is encoded on the listener thread, see JsonFormatter.
+"""
+import json
+import logging
+import logging.config
+import os
+import queue
+import threading
+import time
+from logging.handlers import QueueHandler, QueueListener
+
+from flask import g, request
+
+from app.query_tracking import request_db_stats
+
+REQUEST_LOGGER = 'app.requests'
+
+request_logger = logging.getLogger(REQUEST_LOGGER)
+
+# logger name: BoundedQueueHandler, logging is set up once per process whichever app is created first
+_queue_handlers = {}
+
+
+class JsonFormatter(logging.Formatter):
+    """Formats a record as a JSON object on one line, with whatever was passed in its fields extra"""
+
+    def format(self, record):
+        line = {'time': self.formatTime(record), 'level': record.levelname, 'logger': record.name,
+                'message': record.getMessage()}
+        line.update(getattr(record, 'fields', {}))
+        return json.dumps(line, default=str)
+
+
+class BoundedQueueHandler(QueueHandler):
+    """
+    Queues a logger's records for a listener thread to hand on to its real handlers. Records are dropped when the
+    queue is full, and the listener is started again in a forked worker, threads don't survive a fork
+    """
+
+    def __init__(self, handlers: list, size: int):
+        """
+        Args:
+            handlers (list): handlers the listener hands records on to
+            size (int): most records to queue
+        """
+        super(BoundedQueueHandler, self).__init__(queue.Queue(size))
+        self.targets = handlers
+        self.size = size
+        self.dropped = 0
+        self.listener = None
+        self._pid = None
+        self._start_lock = threading.Lock()
+
+    def _start(self):
+        with self._start_lock:
+            if self._pid == os.getpid():
+                return
+            # a forked worker can't use its parent's queue, the listener that drained it is gone
+            if self._pid is not None:
+                self.queue = queue.Queue(self.size)
+            self.listener = QueueListener(self.queue, *self.targets, respect_handler_level=True)
+            self.listener.start()
+            self._pid = os.getpid()
+
+    def prepare(self, record):
+        # QueueHandler formats and copies records so they can be pickled onto another process's queue. Ours stays in
+        # this process, so the request thread leaves all the formatting to the listener
+        return record
+
+    def enqueue(self, record):
+        if self._pid != os.getpid():
+            self._start()
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def flush(self):
+        """Waits for the listener to hand on everything queued so far"""
+        if self._pid == os.getpid():
+            self.queue.join()
+
+    def close(self):
+        if self._pid == os.getpid():
+            # the listener writes what's queued before it stops
+            self.listener.stop()
+            self._pid = None
+        super(BoundedQueueHandler, self).close()
+
+
+def init_logging(app):
+    """
+    Applies LOGGING_CONFIG with each logger's handlers moved behind a queue, see the module docs, and registers the
+    request log. Logging is process wide, so only the first app created configures it
+    Args:
+        app (Flask): app to log for
+    """
+    if not _queue_handlers:
+        logging_config = app.config['LOGGING_CONFIG']
+        logging.config.dictConfig(logging_config)
+        for name in logging_config.get('loggers', {}):
+            logger = logging.getLogger(name)
+            if not logger.handlers:
+                continue
+            handler = BoundedQueueHandler(logger.handlers[:], app.config['LOG_QUEUE_SIZE'])
+            for target in handler.targets:
+                logger.removeHandler(target)
+            logger.addHandler(handler)
+            _queue_handlers[name] = handler
+
+    if app.config['REQUEST_LOG']:
+        app.before_request(_before_request)
+        app.after_request(_after_request)
+        app.teardown_request(_teardown_request)
+
+
+def get_queue_handler(name: str):
+    """
+    Returns the handler a logger's records are queued on
+    Args:
+        name (str): logger name, one of LOGGING_CONFIG's loggers
+
+    Returns:
+        BoundedQueueHandler or None
+    """
+    return _queue_handlers.get(name)
+
+
+def _before_request():
+    g.request_log_start = time.perf_counter()
+    g.request_logged = False
+
+
+def _log_request(status: int):
+    """
+    Logs the line for a finished request
+    Args:
+        status (int): status code we responded with
+    """
+    g.request_logged = True
+    if not request_logger.isEnabledFor(logging.INFO):
+        return
+    query_count, db_time = request_db_stats()
+    request_logger.info("%s %s %s", request.method, request.path, status, extra={'fields': {
+        'endpoint': request.endpoint or "unmatched",
+        'method': request.method,
+        'path': request.path,
+        'status': status,
+        'latency_ms': round((time.perf_counter() - g.request_log_start) * 1000, 3),
+        'db_queries': query_count,
+        'db_ms': round(db_time * 1000, 3),
+    }})
+
+
+def _after_request(response):
+    if 'request_log_start' in g:
+        _log_request(response.status_code)
+    return response
+
+
+def _teardown_request(exc):
+    # after_request is skipped for unhandled exceptions, so log those as 500s here
+    if 'request_log_start' in g and not g.request_logged:
+        _log_request(500)
@@ -0,0 +1,160 @@
+"""
+Delivery statuses of the texts we send. Twilio calls /api/sms/status as each message is queued, sent and delivered
+(or fails), so a campaign going out brings a burst of callbacks, several per message. Rather than a transaction per
+callback, each worker buffers them in memory and writes them in batches, one multi-row upsert into message_status
+per batch. A batch is written once it holds MESSAGE_STATUS_BATCH_SIZE messages, and whatever is buffered is written
+every MESSAGE_STATUS_FLUSH_SECONDS.
+
+Callbacks can arrive out of order, so a status only replaces one that isn't further along, see
+MessageStatus.STATUS_RANKS. A worker that dies loses the callbacks it hadn't written yet, at most
+MESSAGE_STATUS_FLUSH_SECONDS worth.
+"""
+import atexit
+import threading
+import time
+from datetime import datetime
+
+from flask import current_app
+
+from app import db
+from app.models import MessageStatus
+
+
+def upsert_statement(dialect: str, rows: list):
+    """
+    Builds the statement that writes a batch of statuses, inserting new messages and moving known ones along
+    Args:
+        dialect (str): database dialect name
+        rows (list): dicts of message_status columns, at most one per MessageSid
+
+    Returns:
+        sqlalchemy.sql.dml.Insert
+
+    Raises:
+        ValueError: if we don't know how to upsert on the database
+    """
+    if dialect == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert
+    elif dialect == 'sqlite':
+        from sqlalchemy.dialects.sqlite import insert
+    else:
+        raise ValueError("Can't upsert message statuses on {} databases".format(dialect))
+
+    table = MessageStatus.__table__
+    statement = insert(table).values(rows)
+    excluded = statement.excluded
+    return statement.on_conflict_do_update(
+        index_elements=[table.c.message_sid],
+        set_={'status': excluded.status,
+              'status_rank': excluded.status_rank,
+              'error_code': excluded.error_code,
+              'to_number': db.func.coalesce(excluded.to_number, table.c.to_number),
+              'date_updated': excluded.date_updated},
+        where=excluded.status_rank >= table.c.status_rank)
+
+
+class StatusBuffer(object):
+    """Buffers status callbacks and writes them in batches, see the module docs"""
+
+    def __init__(self, app, batch_size: int, flush_seconds: float):
+        """
+        Args:
+            app (Flask): app whose database we write to
+            batch_size (int): statuses to buffer before writing them
+            flush_seconds (float): longest a status waits in the buffer
+        """
+        self.app = app
+        self.batch_size = batch_size
+        self.flush_seconds = flush_seconds
+        # MessageSid: row, only the furthest along status of each message is kept
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._flusher = None
+        # a worker that is shutting down writes what it has left
+        atexit.register(self._flush_in_app_context)
+
+    def add(self, message_sid: str, status: str, error_code: str = None, to_number: str = None):
+        """
+        Buffers a status, writing the buffer if that fills it
+        Args:
+            message_sid (str): Twilio's id for the message
+            status (str): Twilio's MessageStatus, lower case
+            error_code (str): Twilio's ErrorCode, if the message failed
+            to_number (str): number the message was sent to
+        """
+        row = {'message_sid': message_sid, 'status': status, 'status_rank': MessageStatus.rank(status),
+               'error_code': error_code, 'to_number': to_number, 'date_updated': datetime.utcnow()}
+        with self._lock:
+            self._merge(row)
+            full = len(self._pending) >= self.batch_size
+            self._start_flusher()
+        if full:
+            self.flush()
+
+    def _merge(self, row: dict):
+        """Adds a row to the buffer, unless the buffer has a status further along for the message. Hold the lock"""
+        current = self._pending.get(row['message_sid'])
+        if current is None or row['status_rank'] >= current['status_rank']:
+            self._pending[row['message_sid']] = row
+
+    def _start_flusher(self):
+        """Starts the thread that writes statuses that have waited long enough. Hold the lock"""
+        # threads don't survive a fork, so a gunicorn worker starts its own
+        if self._flusher is not None and self._flusher.is_alive():
+            return
+        self._flusher = threading.Thread(target=self._flush_periodically, name="message-status-flusher",
+                                         daemon=True)
+        self._flusher.start()
+
+    def _flush_periodically(self):
+        while True:
+            time.sleep(self.flush_seconds)
+            self._flush_in_app_context()
+
+    def _flush_in_app_context(self):
+        with self.app.app_context():
+            self.flush()
+
+    def flush(self):
+        """
+        Writes everything in the buffer, in one statement. If the write fails the statuses go back in the buffer to
+        be tried again with the next batch
+        Returns:
+            int - statuses written
+        """
+        with self._lock:
+            rows, self._pending = list(self._pending.values()), {}
+        if not rows:
+            return 0
+        try:
+            with db.engine.begin() as connection:
+                connection.execute(upsert_statement(connection.dialect.name, rows))
+        except Exception:
+            current_app.logger.exception("Writing {} message statuses failed".format(len(rows)))
+            with self._lock:
+                for row in rows:
+                    self._merge(row)
+            return 0
+        return len(rows)
+
+    def __len__(self):
+        return len(self._pending)
+
+
+def init_message_status(app):
+    """
+    Sets up the buffer the status callbacks are written through
+    Args:
+        app (Flask): app to add the buffer to
+    """
+    app.extensions['message_status_buffer'] = StatusBuffer(app, app.config['MESSAGE_STATUS_BATCH_SIZE'],
+                                                           app.config['MESSAGE_STATUS_FLUSH_SECONDS'])
+
+
+def get_status_buffer():
+    """
+    Returns the current app's status buffer
+    Returns:
+        StatusBuffer
+    """
+    return current_app.extensions['message_status_buffer']
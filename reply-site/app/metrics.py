@@ -0,0 +1,102 @@
+import os
+import time
+
+from flask import Response, g, request
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Gauge, Histogram, \
+    generate_latest
+from prometheus_client import multiprocess
+
+from app.query_tracking import request_db_stats
+
+# When PROMETHEUS_MULTIPROC_DIR is set (see gunicorn.conf.py) prometheus_client backs these with mmap files so
+# every gunicorn worker writes to shared storage and /metrics aggregates them.
+REQUEST_LATENCY = Histogram('reply_site_request_latency_seconds',
+                            'Request latency in seconds',
+                            ['endpoint', 'method'])
+REQUEST_COUNT = Counter('reply_site_requests_total',
+                        'Responses served',
+                        ['endpoint', 'method', 'status'])
+REQUESTS_IN_FLIGHT = Gauge('reply_site_requests_in_flight',
+                           'Requests currently being served',
+                           multiprocess_mode='livesum')
+DB_QUERIES = Histogram('reply_site_db_queries_per_request',
+                       'SQL statements executed per request',
+                       ['endpoint'],
+                       buckets=(0, 1, 2, 3, 5, 10, 20, 50, 100, 250))
+DB_TIME = Histogram('reply_site_db_time_seconds',
+                    'Time spent in the database per request',
+                    ['endpoint'])
+
+
+def _endpoint_label():
+    """
+    Returns the label to use for the current request. Unmatched urls all share one label so 404 scans can't blow
+    up our label cardinality
+
+    Returns:
+        str
+    """
+    return request.endpoint or "unmatched"
+
+
+def _before_request():
+    g.metrics_start = time.perf_counter()
+    g.metrics_recorded = False
+    REQUESTS_IN_FLIGHT.inc()
+
+
+def _record(status):
+    """
+    Records a finished request
+    Args:
+        status (int): status code we responded with
+    """
+    endpoint = _endpoint_label()
+    REQUEST_LATENCY.labels(endpoint, request.method).observe(time.perf_counter() - g.metrics_start)
+    REQUEST_COUNT.labels(endpoint, request.method, str(status)).inc()
+    query_count, db_time = request_db_stats()
+    DB_QUERIES.labels(endpoint).observe(query_count)
+    DB_TIME.labels(endpoint).observe(db_time)
+    g.metrics_recorded = True
+
+
+def _after_request(response):
+    if 'metrics_start' in g:
+        _record(response.status_code)
+    return response
+
+
+def _teardown_request(exc):
+    if 'metrics_start' not in g:
+        return
+    # after_request is skipped for unhandled exceptions, so record those as 500s here
+    if not g.metrics_recorded:
+        _record(500)
+    REQUESTS_IN_FLIGHT.dec()
+
+
+def metrics_view():
+    """
+    Renders all of our metrics in the prometheus text format
+
+    Returns:
+        Response
+    """
+    if 'PROMETHEUS_MULTIPROC_DIR' in os.environ:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return Response(generate_latest(registry), status=200, content_type=CONTENT_TYPE_LATEST)
+
+
+def init_metrics(app):
+    """
+    Registers our request middleware and the /metrics endpoint
+    Args:
+        app (Flask): app to instrument
+    """
+    app.before_request(_before_request)
+    app.after_request(_after_request)
+    app.teardown_request(_teardown_request)
+    app.add_url_rule('/metrics', 'metrics', metrics_view)
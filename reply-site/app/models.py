@@ -1,34 +1,22 @@
+from collections import namedtuple
 from datetime import date
 from datetime import datetime
+from functools import wraps
+from inspect import iscoroutinefunction
 
 from app import db
-from flask.json import JSONEncoder as BaseJSONEncoder
-
-
-class JSONEncoder(BaseJSONEncoder):
-    """
-    Custom :class:`JSONEncoder` which respects objects that include the
-    :class:`JsonSerializer` mixin.
-    """
-    def default(self, obj):
-        """
-        the default json encoder
-        Args:
-            obj (any): obj we check is a json serializer
-        Returns:
-            flask.json.JSONEncoder
-        """
-        if isinstance(obj, ModelJsonSerializer):
-            return obj.to_json()
-        return super(JSONEncoder, self).default(obj)
+from app.search import install_search_ddl
+from sqlalchemy import select
+from sqlalchemy.orm.exc import StaleDataError
+from werkzeug.http import quote_etag
 
 
 class ModelJsonSerializer(object):
     """
     A mixin that can be used to mark a SQLAlchemy model class which implements
     a :func:`to_json` method.
-    The :func:`to_json` method is used in conjuction with the custom
-    :class:`JSONEncoder` class.
+    The :func:`to_json` method is used in conjuction with the encoder in
+    :mod:`app.encoding`.
     By default this mixin will assume all properties of the SQLAlchemy model are
     to be visible in the JSON output.
     Extend this class to customize which properties are hidden by setting
@@ -46,23 +34,167 @@ class ModelJsonSerializer(object):
         for p in self.__mapper__.iterate_properties:
             yield p.key
 
-    def to_json(self):
+    @classmethod
+    def json_field_names(cls):
+        """
+        Returns the names of the fields that are visible in the JSON output. Walking the mapper is slow, so this is
+        worked out once per class
+        Returns:
+            tuple
+        """
+        names = cls.__dict__.get('_json_field_names')
+        if names is None:
+            hidden = set(cls.__json_hidden__ or [])
+            names = tuple(p.key for p in cls.__mapper__.iterate_properties if p.key not in hidden)
+            cls._json_field_names = names
+        return names
+
+    @classmethod
+    def select_fields(cls, fields: str):
+        """
+        Parses a comma separated list of field names, i.e. from a ?fields= query arg, into the visible fields it
+        names. They come back in the model's field order so the same fields always give the same tuple
+        Args:
+            fields (str): comma separated field names, None or empty for every field
+
+        Returns:
+            tuple or None - None when fields is empty
+
+        Raises:
+            ValueError: if a field isn't one of ours
+        """
+        if not fields:
+            return None
+        requested = set(field.strip() for field in fields.split(",") if field.strip())
+        unknown = requested.difference(cls.json_field_names())
+        if unknown:
+            raise ValueError("Unknown fields: {}".format(", ".join(sorted(unknown))))
+        return tuple(name for name in cls.json_field_names() if name in requested) or None
+
+    def json_values(self, fields=None):
+        """
+        Returns a python dict of the visible fields with their raw values. Dates are left for the json encoder,
+        see app.encoding
+        Args:
+            fields (tuple): only include these fields, see select_fields
+
+        Returns:
+            dict
+        """
+        return {key: getattr(self, key) for key in fields or self.json_field_names()}
+
+    def to_json(self, fields=None):
         """
         Returns a python dict that represents a SQLAlchemy model class, hiding
         any hidden fields
+        Args:
+            fields (tuple): only include these fields, see select_fields
+
         Returns:
             dict - represents a SQLAlchemy model class
         """
-        hidden = self.__json_hidden__ or []
+        return _isoformat_dates(self.json_values(fields))
+
+    @classmethod
+    def record_class(cls, fields=None):
+        """
+        Returns the read only record type for this model, a namedtuple of the visible fields. There is one type per
+        set of fields, made the first time it's asked for
+        Args:
+            fields (tuple): only include these fields, see select_fields
 
-        rv = dict()
-        for key in self.get_field_names():
-            rv[key] = getattr(self, key)
-            if isinstance(rv[key], (datetime, date)):
-                rv[key] = rv[key].isoformat()
-        for key in hidden:
-            rv.pop(key, None)
-        return rv
+        Returns:
+            type - subclass of ModelRecord
+        """
+        fields = tuple(fields or cls.json_field_names())
+        classes = cls.__dict__.get('_record_classes')
+        if classes is None:
+            classes = cls._record_classes = {}
+        record = classes.get(fields)
+        if record is None:
+            name = "{}Record".format(cls.__name__)
+            record = classes[fields] = type(name, (namedtuple(name, fields), ModelRecord), {'__slots__': ()})
+        return record
+
+    @classmethod
+    def select_records(cls, criteria=(), fields=None, order_by=None, limit: int = None):
+        """
+        Read only query path for lists. Selects just the columns of the visible fields and builds a record straight
+        from each row, so there's no identity map, change tracking or instance state to pay for. Records encode to
+        the same json as the models
+        Args:
+            criteria (iterable): where clauses
+            fields (tuple): only select these fields, see select_fields
+            order_by: column to order by
+            limit (int): most records to return
+
+        Returns:
+            list - records, see record_class
+        """
+        record = cls.record_class(fields)
+        columns = cls.__mapper__.columns
+        statement = select(*[columns[field] for field in record._fields]).where(*criteria)
+        if order_by is not None:
+            statement = statement.order_by(order_by)
+        if limit:
+            statement = statement.limit(limit)
+        make = record._make
+        return [make(row) for row in db.session.execute(statement)]
+
+
+class ModelRecord(object):
+    """
+    Mixin for the read only namedtuple records made by ModelJsonSerializer.record_class. Records have the json
+    methods of the models, so they can be returned by a resource in place of them
+    """
+    __slots__ = ()
+
+    def json_values(self):
+        """
+        Returns a python dict of the fields with their raw values, see ModelJsonSerializer.json_values
+        Returns:
+            dict
+        """
+        return self._asdict()
+
+    def to_json(self):
+        """
+        Returns a python dict of the fields, see ModelJsonSerializer.to_json
+        Returns:
+            dict
+        """
+        return _isoformat_dates(self._asdict())
+
+
+def _isoformat_dates(values: dict):
+    """
+    Replaces the dates in a dict of field values with their ISO 8601 strings, in place
+    Args:
+        values (dict): field values
+
+    Returns:
+        dict - values
+    """
+    for key, value in values.items():
+        if isinstance(value, (datetime, date)):
+            values[key] = value.isoformat()
+    return values
+
+
+def to_datetime(value):
+    """
+    Cerberus coercer for datetimes sent as json, either an ISO 8601 string or "now"
+    Args:
+        value (any): value to coerce
+
+    Returns:
+        datetime or any - anything we can't coerce is returned for validation to reject
+    """
+    if not isinstance(value, str):
+        return value
+    if value.lower() == "now":
+        return datetime.utcnow()
+    return datetime.fromisoformat(value)
 
 
 class Guest(ModelJsonSerializer, db.Model):
@@ -73,20 +205,24 @@ class Guest(ModelJsonSerializer, db.Model):
     __tablename__ = "guests"
 
     id = db.Column(db.Integer, primary_key=True)
-    name = db.Column(db.String(255))
+    name = db.Column(db.String(255), index=True)
     total_attendees = db.Column(db.Integer, default=1)
-    phone_number = db.Column(db.String(255))
+    phone_number = db.Column(db.String(255), index=True)
     email_address = db.Column(db.String(255))
     physical_address = db.Column(db.String(255))
-    date_saved = db.Column(db.Boolean, default=None)
-    rsvp = db.Column(db.Boolean, default=None)
+    date_saved = db.Column(db.Boolean, default=None, index=True)
+    rsvp = db.Column(db.Boolean, default=None, index=True)
     rsvp_notes = db.Column(db.Text, default=None)
     stop_notifications = db.Column(db.Boolean, default=False)
     last_notified = db.Column(db.DateTime, default=None)
     date_created = db.Column(db.DateTime, default=db.func.current_timestamp())
     date_modified = db.Column(
         db.DateTime, default=db.func.current_timestamp(),
-        onupdate=db.func.current_timestamp())
+        onupdate=db.func.current_timestamp(), index=True)
+    # bumped on every update, an update made from a stale copy of the row raises StaleDataError
+    version = db.Column(db.Integer, nullable=False, default=1, server_default='1')
+
+    __mapper_args__ = {'version_id_col': version}
 
     SCHEMA = {
         'name': {'type': 'string'},
@@ -104,7 +240,20 @@ class Guest(ModelJsonSerializer, db.Model):
         'date_saved': {'type': 'boolean', 'required': False},
         'rsvp': {'type': 'boolean', 'required': False},
         'rsvp_notes':  {'type': 'string', 'required': False},
-        'stop_notifications': {'type': 'boolean', 'required': False}
+        'stop_notifications': {'type': 'boolean', 'required': False},
+        'last_notified': {'type': 'datetime', 'required': False, 'coerce': to_datetime}
+    }
+    # PATCH /api/guests, the guests to update are picked by ids or by one of the guest list filters
+    # guest_filter_value of a write that picks guests by filter, the spellings parse_guest_filter understands
+    FILTER_VALUE_SCHEMA = {'type': ['boolean', 'string'], 'nullable': True,
+                           'regex': '(?i)none|null|yes|true|t|1|no|false|f|0'}
+
+    BULK_UPDATE_SCHEMA = {
+        'ids': {'type': 'list', 'schema': {'type': 'integer'}, 'required': True, 'excludes': 'guest_filter'},
+        'guest_filter': {'type': 'string', 'allowed': ['all', 'all_contacts', 'std', 'savethedate', 'rsvp'],
+                         'required': True, 'excludes': 'ids'},
+        'guest_filter_value': dict(FILTER_VALUE_SCHEMA, dependencies='guest_filter'),
+        'set': {'type': 'dict', 'required': True, 'empty': False, 'schema': PUT_SCHEMA},
     }
 
     def __init__(self, name: str,
@@ -127,21 +276,38 @@ class Guest(ModelJsonSerializer, db.Model):
         self.email_address = email_address
         self.physical_address = physical_address
 
+    @property
+    def etag(self):
+        """
+        Returns the ETag for this version of the guest
+        Returns:
+            str
+        """
+        return quote_etag(str(self.version))
+
     def save(self):
         """
-        Saves any changes to the object
+        Saves any changes to the object. Raises StaleDataError if someone else updated the guest since we loaded it
 
         """
         db.session.add(self)
-        db.session.commit()
+        try:
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
 
     def delete(self):
         """
-        Deletes this guest
+        Deletes this guest. Raises StaleDataError if someone else updated the guest since we loaded it
 
         """
         db.session.delete(self)
-        db.session.commit()
+        try:
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
 
     def __repr__(self):
         """
@@ -151,13 +317,85 @@ class Guest(ModelJsonSerializer, db.Model):
         """
         return "<Guest: id {} name {}>".format(self.id, self.name)
 
+    @staticmethod
+    def filter_criteria(guest_filter: str, status=None):
+        """
+        Returns the where clauses for one of our guest list filters
+        Args:
+            guest_filter (str): all, all_contacts, std or rsvp
+            status (bool, none): What status of guests we want, for std and rsvp
+
+        Returns:
+            list
+        """
+        if guest_filter == "all_contacts":
+            return [Guest.stop_notifications != True]
+        if guest_filter == "std":
+            return [Guest.date_saved == status, Guest.stop_notifications != True]
+        if guest_filter == "rsvp":
+            return [Guest.rsvp == status, Guest.stop_notifications != True]
+        return []
+
+    @staticmethod
+    def get_list(guest_filter: str, status=None):
+        """
+        Returns a list of guests matching one of our guest list filters
+        Args:
+            guest_filter (str): all, all_contacts, std or rsvp
+            status (bool, none): What status of guests we want, for std and rsvp
+
+        Returns:
+            list
+        """
+        return Guest.query.filter(*Guest.filter_criteria(guest_filter, status)).all()
+
+    @staticmethod
+    def get_records(guest_filter: str, status=None, fields=None):
+        """
+        Returns read only records of the guests matching one of our guest list filters. Use this over get_list
+        anywhere the guests are only read, they take a fraction of the memory and time of Guests
+        Args:
+            guest_filter (str): all, all_contacts, std or rsvp
+            status (bool, none): What status of guests we want, for std and rsvp
+            fields (tuple): only select these columns, see select_fields
+
+        Returns:
+            list - GuestRecords
+        """
+        return Guest.select_records(Guest.filter_criteria(guest_filter, status), fields)
+
+    @staticmethod
+    def bulk_update(criteria: list, values: dict):
+        """
+        Updates every guest matching criteria in one UPDATE statement, without loading them. Bumps their version like
+        an update through the session would and records the change for the change feed
+        Args:
+            criteria (list): where clauses picking the guests to update
+            values (dict): field names and the values to set them to
+
+        Returns:
+            int - number of guests updated
+        """
+        from app.changes import record_bulk_guest_changes
+
+        try:
+            # recorded first, the update can change which guests criteria matches
+            record_bulk_guest_changes(criteria, values.keys())
+            count = Guest.query.filter(*criteria).update(dict(values, version=Guest.version + 1),
+                                                         synchronize_session=False)
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        return count
+
     @staticmethod
     def get_all():
         """
         Returns all guests
 
         """
-        return Guest.query.all()
+        return Guest.get_list("all")
 
     @staticmethod
     def get_std_list(status):
@@ -169,7 +407,7 @@ class Guest(ModelJsonSerializer, db.Model):
         Returns:
             list
         """
-        return Guest.query.filter((Guest.date_saved == status) & (Guest.stop_notifications != True)).all()
+        return Guest.get_list("std", status)
 
     @staticmethod
     def get_rsvp_list(status):
@@ -181,7 +419,7 @@ class Guest(ModelJsonSerializer, db.Model):
         Returns:
             list
         """
-        return Guest.query.filter((Guest.rsvp == status) & (Guest.stop_notifications != True)).all()
+        return Guest.get_list("rsvp", status)
 
     @staticmethod
     def get_all_contacts():
@@ -191,4 +429,290 @@ class Guest(ModelJsonSerializer, db.Model):
         Returns:
             list
         """
-        return Guest.query.filter(Guest.stop_notifications != True).all()
+        return Guest.get_list("all_contacts")
+
+
+class GuestChange(db.Model):
+    """
+    This class represents our guest_changes table, one row for every guest written. Its id is the cursor of the change
+    feed, see app.changes
+    """
+
+    __tablename__ = "guest_changes"
+
+    id = db.Column(db.Integer, primary_key=True)
+    # no foreign key, the changes of a deleted guest outlive it
+    guest_id = db.Column(db.Integer, nullable=False)
+    operation = db.Column(db.String(16), nullable=False)
+    # comma separated names of the fields that were written
+    changed_fields = db.Column(db.Text, default="")
+    date_modified = db.Column(db.DateTime, default=db.func.current_timestamp(), index=True)
+
+    def __repr__(self):
+        """
+        Returns a string representation of our change
+        Returns:
+            str
+        """
+        return "<GuestChange: id {} guest {} {}>".format(self.id, self.guest_id, self.operation)
+
+    @staticmethod
+    def prune(before: datetime):
+        """
+        Deletes changes older than before, clients that resume from further back than that just miss them
+        Args:
+            before (datetime): delete changes made before this
+
+        Returns:
+            int - number of changes deleted
+        """
+        deleted = GuestChange.query.filter(GuestChange.date_modified < before).delete(synchronize_session=False)
+        db.session.commit()
+        return deleted
+
+
+class InboundMessage(db.Model):
+    """
+    This class represents our inbound_messages table, every text we've acted on and what we replied. Twilio retries
+    webhooks with the same MessageSid, the unique index is what makes sure we only act on a message once
+    """
+
+    __tablename__ = "inbound_messages"
+
+    id = db.Column(db.Integer, primary_key=True)
+    message_sid = db.Column(db.String(64), nullable=False, unique=True)
+    from_number = db.Column(db.String(255))
+    body = db.Column(db.Text)
+    reply = db.Column(db.Text, default=None)
+    date_created = db.Column(db.DateTime, default=db.func.current_timestamp())
+
+    def __init__(self, message_sid: str, from_number: str, body: str, reply: str = None):
+        """
+        Initializes our InboundMessage
+        Args:
+            message_sid (str): Twilio's id for the message
+            from_number (str): Phone number the message came from
+            body (str): Text of the message
+            reply (str): What we texted back, None if we didn't
+        """
+        self.message_sid = message_sid
+        self.from_number = from_number
+        self.body = body
+        self.reply = reply
+
+    def __repr__(self):
+        """
+        Returns a string representation of our message
+        Returns:
+            str
+        """
+        return "<InboundMessage: id {} sid {}>".format(self.id, self.message_sid)
+
+
+class MessageStatus(db.Model):
+    """
+    This class represents our message_status table, the latest delivery status Twilio reported for each text we
+    sent. Rows are written in batches from the status callbacks, see app.message_status
+    """
+
+    __tablename__ = "message_status"
+
+    # Twilio's statuses in the order a message moves through them. Callbacks can arrive out of order, a status never
+    # replaces one that is further along
+    STATUS_RANKS = {
+        'accepted': 0,
+        'scheduled': 0,
+        'queued': 1,
+        'sending': 2,
+        'sent': 3,
+        'delivered': 4,
+        'undelivered': 4,
+        'failed': 4,
+        'canceled': 4,
+        'read': 5,
+    }
+
+    message_sid = db.Column(db.String(64), primary_key=True)
+    status = db.Column(db.String(16), nullable=False)
+    status_rank = db.Column(db.SmallInteger, nullable=False, default=0)
+    # Twilio's error code, for failed and undelivered messages
+    error_code = db.Column(db.String(16), default=None)
+    to_number = db.Column(db.String(255), default=None)
+    date_updated = db.Column(db.DateTime, default=None)
+
+    @classmethod
+    def rank(cls, status: str):
+        """
+        Returns how far along a status is, statuses we don't know rank first
+        Args:
+            status (str): Twilio's MessageStatus
+
+        Returns:
+            int
+        """
+        return cls.STATUS_RANKS.get(status, 0)
+
+    def __repr__(self):
+        """
+        Returns a string representation of our status
+        Returns:
+            str
+        """
+        return "<MessageStatus: sid {} {}>".format(self.message_sid, self.status)
+
+
+class Campaign(ModelJsonSerializer, db.Model):
+    """
+    This class represents our campaigns table, a text message template to send to a segment of our guests. Campaigns
+    are sent by the campaign worker, see app.campaigns
+    """
+
+    __tablename__ = "campaigns"
+
+    STATUSES = ('pending', 'running', 'done', 'failed')
+
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(255))
+    template = db.Column(db.Text, nullable=False)
+    # the segment uses the same filters as the guest list api, see Guest.filter_criteria
+    guest_filter = db.Column(db.String(32), nullable=False, default="all_contacts")
+    guest_filter_value = db.Column(db.Boolean, default=None)
+    status = db.Column(db.String(16), nullable=False, default="pending", index=True)
+    error = db.Column(db.Text, default=None)
+    date_created = db.Column(db.DateTime, default=db.func.current_timestamp())
+    date_started = db.Column(db.DateTime, default=None)
+    date_finished = db.Column(db.DateTime, default=None)
+    # bumped by the worker after every batch, a running campaign that stops getting it is up for grabs again
+    date_heartbeat = db.Column(db.DateTime, default=None)
+
+    SCHEMA = {
+        'name': {'type': 'string'},
+        'template': {'type': 'string', 'required': True, 'empty': False},
+        'guest_filter': {'type': 'string', 'allowed': ['all', 'all_contacts', 'std', 'savethedate', 'rsvp']},
+        'guest_filter_value': Guest.FILTER_VALUE_SCHEMA,
+    }
+
+    def __init__(self, template: str, name: str = None, guest_filter: str = "all_contacts",
+                 guest_filter_value: bool = None):
+        """
+        Initializes our Campaign
+        Args:
+            template (str): Jinja template of the message, rendered with each guest's fields
+            name (str): Name of the campaign, i.e. Save the date
+            guest_filter (str): Which guests to send to, all, all_contacts, std or rsvp
+            guest_filter_value (bool, none): What status of guests we want, for std and rsvp
+        """
+        self.template = template
+        self.name = name
+        self.guest_filter = guest_filter
+        self.guest_filter_value = guest_filter_value
+
+    def __repr__(self):
+        """
+        Returns a string representation of our campaign
+        Returns:
+            str
+        """
+        return "<Campaign: id {} name {}>".format(self.id, self.name)
+
+    def save(self):
+        """
+        Saves any changes to the object
+
+        """
+        db.session.add(self)
+        db.session.commit()
+
+    def recipient_criteria(self):
+        """
+        Returns the where clauses for the guests this campaign goes to. Guests that asked us to stop texting them or
+        that we have no number for are always left out
+        Returns:
+            list
+        """
+        return Guest.filter_criteria(self.guest_filter, self.guest_filter_value) + [
+            Guest.stop_notifications != True,
+            Guest.phone_number != None,
+            Guest.phone_number != "",
+        ]
+
+    def progress(self):
+        """
+        Returns how many of the campaign's recipients are in each status, in one query
+        Returns:
+            dict
+        """
+        counts = dict.fromkeys(CampaignRecipient.STATUSES, 0)
+        counts.update(db.session.query(CampaignRecipient.status, db.func.count(CampaignRecipient.id)).filter(
+            CampaignRecipient.campaign_id == self.id).group_by(CampaignRecipient.status).all())
+        return counts
+
+
+class CampaignRecipient(db.Model):
+    """
+    This class represents our campaign_recipients table, one row per guest a campaign is sent to, so progress
+    survives a worker restart and no guest gets a campaign twice
+    """
+
+    __tablename__ = "campaign_recipients"
+    __table_args__ = (db.UniqueConstraint('campaign_id', 'guest_id'),)
+
+    STATUSES = ('pending', 'sent', 'failed')
+
+    id = db.Column(db.Integer, primary_key=True)
+    campaign_id = db.Column(db.Integer, db.ForeignKey('campaigns.id'), nullable=False)
+    guest_id = db.Column(db.Integer, nullable=False)
+    phone_number = db.Column(db.String(255))
+    status = db.Column(db.String(16), nullable=False, default="pending")
+    message_sid = db.Column(db.String(64), default=None)
+    error = db.Column(db.Text, default=None)
+    date_sent = db.Column(db.DateTime, default=None)
+
+    def __repr__(self):
+        """
+        Returns a string representation of our recipient
+        Returns:
+            str
+        """
+        return "<CampaignRecipient: campaign {} guest {} {}>".format(self.campaign_id, self.guest_id, self.status)
+
+
+def retry_on_conflict(attempts: int = 3):
+    """
+    Decorator for our own read-modify-write code. When the write loses a race with another writer, the whole function
+    is run again so it reloads the guest and reapplies its change on top of the other write. The function has to do
+    its own loading, and must not have side effects besides the write. Works on coroutine functions too, see
+    app.asgi
+    Args:
+        attempts (int): how many times to try before letting StaleDataError through
+
+    Returns:
+        function
+    """
+    def decorator(f):
+        if iscoroutinefunction(f):
+            @wraps(f)
+            async def decorated_coroutine(*args, **kwargs):
+                for attempt in range(1, attempts + 1):
+                    try:
+                        return await f(*args, **kwargs)
+                    except StaleDataError:
+                        if attempt == attempts:
+                            raise
+            return decorated_coroutine
+
+        @wraps(f)
+        def decorated_function(*args, **kwargs):
+            for attempt in range(1, attempts + 1):
+                try:
+                    return f(*args, **kwargs)
+                except StaleDataError:
+                    # Guest.save has already rolled back, which expires everything we had loaded
+                    if attempt == attempts:
+                        raise
+        return decorated_function
+    return decorator
+
+
+# keep the full text search index alongside the guests table, see app.search
+install_search_ddl(Guest.__table__)
@@ -0,0 +1,128 @@
+import time
+
+from flask import current_app, g, has_app_context, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# how to ask each dialect for a query plan
+EXPLAIN_PREFIXES = {
+    'sqlite': "EXPLAIN QUERY PLAN ",
+    'postgresql': "EXPLAIN ",
+}
+# dialects where a failed statement aborts the whole transaction, the EXPLAIN runs in a savepoint on these so a
+# plan we can't get never breaks the request it was for
+SAVEPOINT_DIALECTS = ('postgresql',)
+
+
+class QueryBudgetExceeded(Exception):
+    """Raised in testing mode when a request runs more sql statements than its budget allows"""
+    pass
+
+
+def _explain(conn, cursor, statement, parameters):
+    """
+    Fetches the query plan for a statement. We use a raw DBAPI cursor so the EXPLAIN does not fire our own
+    event hooks. It runs on the request's own connection, in a savepoint where a failure would abort the transaction
+    Args:
+        conn (sqlalchemy.engine.Connection): connection the statement ran on
+        cursor: DBAPI cursor the statement ran on
+        statement (str): sql statement
+        parameters: bound parameters of the statement
+
+    Returns:
+        str or None
+    """
+    prefix = EXPLAIN_PREFIXES.get(conn.dialect.name)
+    if prefix is None or not statement.lstrip().upper().startswith("SELECT"):
+        return None
+    savepoint = conn.dialect.name in SAVEPOINT_DIALECTS
+    try:
+        explain_cursor = cursor.connection.cursor()
+        try:
+            if savepoint:
+                explain_cursor.execute("SAVEPOINT query_plan")
+            try:
+                explain_cursor.execute(prefix + statement, parameters)
+                plan = "\n".join(" ".join(str(col) for col in row) for row in explain_cursor.fetchall())
+            except Exception:
+                if savepoint:
+                    explain_cursor.execute("ROLLBACK TO SAVEPOINT query_plan")
+                raise
+            if savepoint:
+                explain_cursor.execute("RELEASE SAVEPOINT query_plan")
+            return plan
+        finally:
+            explain_cursor.close()
+    except Exception as exc:
+        return "unavailable ({})".format(exc)
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    """
+    Stores the start time of a statement on the connection so the after hook can time it
+    """
+    conn.info.setdefault('query_start_time', []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    """
+    Adds the statement to the query count and db time of the current request and logs it if it was slow
+    """
+    elapsed = time.perf_counter() - conn.info['query_start_time'].pop()
+    if has_request_context():
+        g.db_query_count = g.get('db_query_count', 0) + 1
+        g.db_time = g.get('db_time', 0.0) + elapsed
+
+    if has_app_context() and elapsed * 1000 >= current_app.config.get('SLOW_QUERY_THRESHOLD_MS', 100):
+        if executemany:
+            # bulk inserts can carry thousands of parameter sets, just log how many there were
+            current_app.logger.warning("Slow query (%.1fms): %s\nParameters: %d parameter sets",
+                                       elapsed * 1000, statement, len(parameters))
+        else:
+            current_app.logger.warning("Slow query (%.1fms): %s\nParameters: %r\nPlan:\n%s",
+                                       elapsed * 1000,
+                                       statement,
+                                       parameters,
+                                       _explain(conn, cursor, statement, parameters))
+
+
+def request_db_stats():
+    """
+    Returns the number of queries and total db time of the current request
+
+    Returns:
+        tuple(int, float)
+    """
+    return g.get('db_query_count', 0), g.get('db_time', 0.0)
+
+
+def _check_query_budget(response):
+    """
+    Flags requests that ran more statements than their endpoint's budget. This is how we catch N+1 query patterns,
+    so in testing mode we raise instead of logging to fail the test
+    """
+    query_count, _ = request_db_stats()
+    budgets = current_app.config['QUERY_BUDGETS']
+    budget = budgets.get("{}:{}".format(request.endpoint, request.method),
+                         budgets.get(request.endpoint, current_app.config['QUERY_BUDGET']))
+    if query_count <= budget:
+        return response
+    message = "{} {} ran {} queries, budget for {} is {}".format(request.method, request.path, query_count,
+                                                                 request.endpoint, budget)
+    if current_app.config['TESTING']:
+        raise QueryBudgetExceeded(message)
+    current_app.logger.warning(message)
+    return response
+
+
+def init_query_tracking(app):
+    """
+    Registers our SQLAlchemy event hooks and the per request query budget check. The hooks are attached to the
+    Engine class so they cover every engine flask-sqlalchemy creates for us
+    Args:
+        app (Flask): app we are tracking queries for
+    """
+    if not event.contains(Engine, 'before_cursor_execute', _before_cursor_execute):
+        event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+        event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+    app.after_request(_check_query_budget)
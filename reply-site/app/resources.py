@@ -1,10 +1,24 @@
 from functools import wraps
 from cerberus import Validator
-from flask import abort, current_app
-from flask import request, Response
+from flask import abort, current_app, g
+from flask import request, Response, stream_with_context
 from flask_restful import Resource
-from twilio.request_validator import RequestValidator
-from twilio.twiml.messaging_response import MessagingResponse
+from jinja2 import TemplateSyntaxError
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import load_only
+from sqlalchemy.orm.exc import StaleDataError
+
+from app import db
+from app.cache import get_guest_cache, get_sms_reply_cache
+from app.campaigns import compile_template
+from app.changes import STREAM_RETRY_AFTER_SECONDS, change_stream, resolve_cursor
+from app.encoding import dumps
+from app.message_status import get_status_buffer
+from app.models import Campaign, InboundMessage, retry_on_conflict
+from app.routing import replica_reads
+from app.search import SEARCH_COUNT_LIMIT, SearchNotSupported, search_guests
+from app.sms import UNKNOWN_NUMBER_REPLY, interpret, messaging_response, parse_webhook, render_reply
+from app.sms_queue import QUEUE_FULL_RETRY_AFTER_SECONDS, QueueFull, get_sms_queue
 
 
 # https://www.twilio.com/docs/guides/how-to-secure-your-flask-app-by-validating-incoming-twilio-requests#disable-request-validation-during-resting
@@ -17,6 +31,8 @@ def validate_twilio_request(f):
         if current_app.config['TESTING']:
             return f(*args, **kwargs)
         # Create an instance of the RequestValidator class
+        # twilio is imported on first use so it doesn't weigh down worker boot
+        from twilio.request_validator import RequestValidator
         validator = RequestValidator(current_app.config['TWILIO_AUTH_TOKEN'])
 
         # Validate the request using its URL, POST data,
@@ -42,6 +58,9 @@ class TwilioResource(Resource):
 
 
 class GuestsResource(Resource):
+    # filters that pick guests by a status, see parse_guest_filter
+    STATUS_FILTERS = ('std', 'savethedate', 'rsvp')
+
     def __init__(self, **kwargs):
         self.Guest = kwargs['guest_object']
 
@@ -49,39 +68,176 @@ class GuestsResource(Resource):
     def str2bool(v):
         return v.lower() in ("yes", "true", "t", "1")
 
+    @classmethod
+    def guest_filter_errors(cls, data):
+        """
+        Checks the guest filter of a write. parse_guest_filter reads a status filter without a value as every guest,
+        which is fine for reading the list but not for picking who a write goes to
+        Args:
+            data (dict): validated request body
+
+        Returns:
+            dict or None - errors, if there are any
+        """
+        if data.get('guest_filter') in cls.STATUS_FILTERS and 'guest_filter_value' not in data:
+            return {"guest_filter_value": ["required with the {} filter".format(data['guest_filter'])]}
+        return None
+
+    @classmethod
+    def parse_guest_filter(cls, args):
+        """
+        Normalizes the guest_filter and guest_filter_value query args, so every spelling of a filter maps to one
+        filter name and value
+        Args:
+            args (dict): request args
+
+        Returns:
+            tuple(str, bool or None) - filter name (all, all_contacts, std or rsvp) and status
+        """
+        try:
+            guest_filter = args['guest_filter'].lower()
+            if guest_filter == "all_contacts":
+                return "all_contacts", None
+            guest_filter_value = args['guest_filter_value'].lower()
+        except KeyError:
+            return "all", None
+
+        if guest_filter_value == "none" or guest_filter_value == "null":
+            guest_filter_value = None
+        else:
+            guest_filter_value = cls.str2bool(guest_filter_value)
+        if guest_filter == "std" or guest_filter == "savethedate":
+            return "std", guest_filter_value
+        if guest_filter == "rsvp":
+            return "rsvp", guest_filter_value
+        return "all", None
+
 
 class GuestsList(GuestsResource):
+    method_decorators = {'get': [replica_reads]}
+
     def get(self):
-        if request.query_string is not None:
-            try:
-                guest_filter = request.args['guest_filter'].lower()
-                if guest_filter == "all_contacts":
-                    our_list = self.Guest.get_all_contacts()
-                else:
-                    guest_filter_value = request.args['guest_filter_value'].lower()
-                    if guest_filter_value == "none" or guest_filter_value == "null":
-                        guest_filter_value = None
-                    else:
-                        guest_filter_value = self.str2bool(guest_filter_value)
-                    if guest_filter == "std" or guest_filter == "savethedate":
-                        our_list = self.Guest.get_std_list(guest_filter_value)
-                    elif guest_filter == "rsvp":
-                        our_list = self.Guest.get_rsvp_list(guest_filter_value)
-                    else:
-                        our_list = self.Guest.get_all()
-            except KeyError:
-                our_list = self.Guest.get_all()
+        guest_filter, guest_filter_value = self.parse_guest_filter(request.args)
+        try:
+            fields = self.Guest.select_fields(request.args.get('fields'))
+        except ValueError as exc:
+            return {"errors": str(exc)}, 400
+        cache = get_guest_cache()
+        # replica and primary reads are cached apart, so a client reading its own writes from the primary never
+        # gets a lagging replica's answer and vice versa
+        cache_key = "{}:{}:{}:{}".format("replica" if g.get('read_replica', False) else "primary",
+                                         guest_filter, guest_filter_value, ",".join(fields or ()))
+        if cache is not None:
+            cached = cache.get(cache_key)
+            if cached is not None:
+                return Response(cached, status=200, mimetype="application/json", headers={'X-Cache': "HIT"})
+
+        our_list = self.Guest.get_records(guest_filter, guest_filter_value, fields)
+        if cache is None or len(our_list) > current_app.config['JSON_STREAM_THRESHOLD']:
+            # the guests are encoded straight from the records by app.encoding.output_json, big lists are streamed
+            # rather than cached
+            return our_list, 200
+
+        body = dumps(our_list)
+        cache.set(cache_key, body)
+        return Response(body, status=200, mimetype="application/json", headers={'X-Cache': "MISS"})
+
+    def patch(self):
+        if not request.is_json:
+            return {"errors": "PATCH takes a json body"}, 400
+        validator = Validator(schema=self.Guest.BULK_UPDATE_SCHEMA)
+        if not validator.validate(request.json or {}):
+            return {"errors": validator.errors}, 400
+        data = validator.document
+        errors = self.guest_filter_errors(data)
+        if errors:
+            return {"errors": errors}, 400
+
+        if 'ids' in data:
+            criteria = [self.Guest.id.in_(data['ids'])]
+        else:
+            criteria = self.Guest.filter_criteria(*self.parse_guest_filter(
+                {key: str(data[key]) for key in ('guest_filter', 'guest_filter_value') if key in data}))
+        return {"updated": self.Guest.bulk_update(criteria, data['set'])}, 200
+
+
+class GuestsSearch(GuestsResource):
+    method_decorators = {'get': [replica_reads]}
+
+    def get(self):
+        query = request.args.get('q', "")
+        try:
+            page = max(int(request.args.get('page', 1)), 1)
+            per_page = min(max(int(request.args.get('per_page', 20)), 1), 100)
+        except ValueError:
+            return {"errors": "page and per_page must be integer numbers"}, 400
+        if not query.strip():
+            return {"errors": "q is required"}, 400
+
+        try:
+            guests, total = search_guests(query, page, per_page)
+        except SearchNotSupported as exc:
+            return {"errors": str(exc)}, 501
+        # we stop counting at SEARCH_COUNT_LIMIT, total_capped tells the client there may be more
+        return {"results": guests, "total": total, "total_capped": total >= SEARCH_COUNT_LIMIT,
+                "page": page, "per_page": per_page}, 200
+
+
+class GuestChanges(GuestsResource):
 
-        to_return = []
-        for guest in our_list:
-            to_return.append(guest.to_json())
-        return to_return, 200
+    def get(self):
+        # every open stream holds a worker thread, past the cap the rest of the api would queue behind them
+        slots = current_app.extensions.get('change_feed_streams')
+        if slots is not None and not slots.acquire(blocking=False):
+            return {"errors": "Too many open change feeds, try again shortly"}, 503, \
+                {'Retry-After': str(STREAM_RETRY_AFTER_SECONDS)}
+        try:
+            cursor = resolve_cursor(request.headers.get('Last-Event-ID', request.args.get('last_event_id')),
+                                    request.args.get('since'))
+        except ValueError:
+            if slots is not None:
+                slots.release()
+            return {"errors": "Last-Event-ID must be an event id and since an ISO 8601 timestamp"}, 400
+
+        stream = change_stream(cursor,
+                               current_app.config['CHANGE_FEED_POLL_SECONDS'],
+                               current_app.config['CHANGE_FEED_MAX_SECONDS'],
+                               current_app.config['CHANGE_FEED_BATCH_SIZE'])
+        # X-Accel-Buffering stops nginx style proxies from holding events back
+        response = Response(stream_with_context(stream), status=200, mimetype="text/event-stream",
+                            headers={'Cache-Control': "no-cache", 'X-Accel-Buffering': "no"})
+        if slots is not None:
+            # the server closes the response when the stream ends or the client goes away
+            response.call_on_close(slots.release)
+        return response
 
 
 class GuestsAPI(GuestsResource):
+    method_decorators = {'get': [replica_reads]}
+
     def get(self, guest_id):
-        guest = self.Guest.query.filter_by(id=guest_id).first_or_404()
-        return guest.to_json(), 200
+        try:
+            fields = self.Guest.select_fields(request.args.get('fields'))
+        except ValueError as exc:
+            return {"errors": str(exc)}, 400
+        query = self.Guest.query
+        if fields is not None:
+            # version is loaded for the ETag
+            query = query.options(load_only(*[getattr(self.Guest, field) for field in fields], self.Guest.version))
+        guest = query.filter_by(id=guest_id).first_or_404()
+        return guest.to_json(fields), 200, {'ETag': guest.etag}
+
+    @staticmethod
+    def conflict(guest_id: int):
+        """
+        Response for a write that lost a race with another writer
+        Args:
+            guest_id (int): id of the guest that was being written
+
+        Returns:
+            tuple
+        """
+        return {"errors": "Guest {} was changed by someone else, fetch it and try again".format(guest_id)}, 409
 
     def post(self):
         # this logic is so the post can handle form posts AND json posts
@@ -108,11 +264,17 @@ class GuestsAPI(GuestsResource):
 
     def delete(self, guest_id):
         guest = self.Guest.query.filter_by(id=guest_id).first_or_404()
-        guest.delete()
+        try:
+            guest.delete()
+        except StaleDataError:
+            return self.conflict(guest_id)
         return 200
 
     def put(self, guest_id):
         guest = self.Guest.query.filter_by(id=guest_id).first_or_404()
+        # If-Match lets a client make sure it is updating the version it last read
+        if request.if_match and not request.if_match.contains(str(guest.version)):
+            return self.conflict(guest_id)
         # this logic is so the post can handle form posts AND json posts
         # form posts everything is a string, so we have to do some interpretation before validating
         if request.headers['Content-Type'].lower() == "application/json":
@@ -146,11 +308,61 @@ class GuestsAPI(GuestsResource):
         if not validator.validate(data):
             return {"errors": validator.errors}, 400
 
-        for key, value in data.items():
+        for key, value in validator.document.items():
             setattr(guest, key, value)
-        guest.save()
+        try:
+            guest.save()
+        except StaleDataError:
+            return self.conflict(guest_id)
+
+        return guest.to_json(), 200, {'ETag': guest.etag}
+
+
+class CampaignsAPI(Resource):
 
-        return guest.to_json(), 200
+    def get(self, campaign_id=None):
+        if campaign_id is None:
+            # the list leaves progress out, it's a query per campaign
+            return [campaign.to_json() for campaign in Campaign.query.order_by(Campaign.id.desc())], 200
+        campaign = Campaign.query.filter_by(id=campaign_id).first_or_404()
+        result = campaign.to_json()
+        result['progress'] = campaign.progress()
+        return result, 200
+
+    def post(self):
+        data = request.json if request.is_json else request.form.to_dict()
+        validator = Validator(schema=Campaign.SCHEMA)
+        if not validator.validate(data or {}):
+            return {"errors": validator.errors}, 400
+        errors = GuestsResource.guest_filter_errors(data)
+        if errors:
+            return {"errors": errors}, 400
+
+        # the segment takes the same filters as /api/guests
+        guest_filter, guest_filter_value = GuestsResource.parse_guest_filter(
+            {key: str(data[key]) for key in ('guest_filter', 'guest_filter_value') if key in data})
+        try:
+            compile_template(data['template'])
+        except TemplateSyntaxError as exc:
+            return {"errors": {"template": [str(exc)]}}, 400
+
+        campaign = Campaign(data['template'], name=data.get('name'), guest_filter=guest_filter,
+                            guest_filter_value=guest_filter_value)
+        campaign.save()
+        return campaign.to_json(), 201, {'Location': "/api/campaigns/{}".format(campaign.id)}
+
+
+class MessageStatusAPI(TwilioResource):
+
+    def post(self):
+        # Twilio's status callback for the texts we send, see app.message_status
+        message_sid = request.values.get('MessageSid')
+        status = request.values.get('MessageStatus')
+        if not message_sid or not status:
+            return {"errors": "MessageSid and MessageStatus are required"}, 400
+        get_status_buffer().add(message_sid, status.lower(), request.values.get('ErrorCode') or None,
+                                request.values.get('To'))
+        return Response(status=204)
 
 
 class TwilioResponseAPI(TwilioResource):
@@ -160,85 +372,96 @@ class TwilioResponseAPI(TwilioResource):
 
     @staticmethod
     def _get_twilio_messager():
-        return MessagingResponse()
+        return messaging_response()
 
     def post(self):
-        rsvp_help_msg = "Sorry, but I couldn't understand that. To RSVP, use RSVP Yes/No #of attendees. " \
-                            "Examples: RSVP yes 2 or RSVP no."
-
-        resp = self._get_twilio_messager()
-
-        from_number = request.values.get('From', None).strip("+1")
-        body = request.values.get('Body', None).lower()
-
+        # Twilio retries webhooks that time out with the same MessageSid. Retries this worker already answered are
+        # served from memory, the rest are caught by the unique MessageSid in inbound_messages
+        message_sid = request.values.get('MessageSid', None)
+        replies = get_sms_reply_cache()
+        if message_sid is not None and replies is not None:
+            twiml = replies.get(message_sid)
+            if twiml is not None:
+                return Response(twiml, status=200, mimetype="application/xml")
+
+        message_sid, from_number, body = parse_webhook(request.values)
+        queue = get_sms_queue()
+        if queue is None:
+            reply = self._reply_to(from_number, body, message_sid)
+        else:
+            try:
+                reply = self._queue_reply(queue, from_number, body, message_sid)
+            except QueueFull:
+                return Response("Too many messages waiting, try again shortly", status=503, mimetype="text/plain",
+                                headers={'Retry-After': str(QUEUE_FULL_RETRY_AFTER_SECONDS)})
+        twiml = render_reply(reply, self._get_twilio_messager())
+        if message_sid is not None and replies is not None:
+            replies.set(message_sid, twiml)
+        return Response(twiml, status=200, mimetype="application/xml")
+
+    @retry_on_conflict()
+    def _reply_to(self, from_number: str, body: str, message_sid: str = None):
+        """
+        Acts on a text from a guest, exactly once per MessageSid. The message is recorded in the same transaction as
+        the guest's update, so a retry of a message we already acted on fails the unique index, rolls back and gets
+        the reply we stored the first time. If another write to the guest beats ours, this is run again against the
+        fresh guest, so an rsvp note is never lost
+        Args:
+            from_number (str): phone number the text came from
+            body (str): lower cased text of the message
+            message_sid (str): Twilio's id for the message, if it sent one
+
+        Returns:
+            str or None - what to text back, if anything
+        """
         guest = self.Guest.query.filter_by(phone_number=from_number).first()
         if guest is None:
-            current_app.logger.debug("Invalid response number {} - body {}".format(from_number, body))
-            resp.message("I don't recognize your number or something is very broken. "
-                         "Please reach out to Andrew or Sarah directly for help")
-            return Response(str(resp), status=200, mimetype="application/xml")
-
-        if body[:3] == "yes":
-            # We have a keeper! Update their confirmation status
-            guest.date_saved = True
-            guest.save()
-            resp.message("Thanks for confirming, we'll be in touch with more info soon!")
-            return Response(str(resp), status=200, mimetype="application/xml")
-
-        if body[:2] == "no":
-            # declined guest
-            guest.date_saved = False
-            guest.save()
-            resp.message("We understand life can be busy. We'll still be thinking of you on our special day")
-            return Response(str(resp), status=200, mimetype="application/xml")
-
-        if body[:4] == "rsvp":
-            # we have an rsvp
-            split_body = body.split()
-            total_attendees = guest.total_attendees
-            if split_body[1].lower()[:3] == "yes":
-                # We gave an rsvp!
-                response = "We're so glad you're joining us on our special day! " \
-                           "Remember to keep up with the wedding site for any updates!"
-                rsvp = True
-                try:
-                    responded_attendees = int(split_body[2])
-                except ValueError:
-                    resp.message(rsvp_help_msg)
-                    return Response(str(resp), status=200, mimetype="application/xml")
-                # check that they're not trying to bring the whole town with them
-                if responded_attendees > total_attendees:
-                    response = "I'm sorry, but we have to keep our wedding small. We ask that you only bring up to " \
-                               "{} people. If you need extra, please reach out to Andrew and Sarah and we can work " \
-                               "with you".format(total_attendees)
-                    resp.message(response)
-                    return Response(str(resp), status=200, mimetype="application/xml")
-                total_attendees = responded_attendees
-                note = " ".join(split_body[3:])
-            elif split_body[1].lower()[:3] == "no":
-                response = "Thank you for responding. We understand life can be busy. We'll be thinking of you on " \
-                           "our special day."
-                rsvp = False
-                total_attendees = 0
-                note = body
-            else:
-                resp.message(rsvp_help_msg)
-                return Response(str(resp), status=200, mimetype="application/xml")
-            resp.message(response)
-            guest.total_attendees = total_attendees
-            guest.rsvp = rsvp
-            if guest.rsvp_notes is None:
-                guest.rsvp_notes = note
-            else:
-                guest.rsvp_notes += "\n" + note
-            guest.save()
-            return Response(str(resp), status=200, mimetype="application/xml")
-
-        if body[:4] == "stop":
-            # they dont want texts
-            resp.message("We're so sorry! We won't text you again about our wedding plans.")
-            guest.stop_notifications = True
-            guest.rsvp_notes = body
-            guest.save()
-            return Response(str(resp), status=200, mimetype="application/xml")
-
+            current_app.logger.debug("Invalid response number %s - body %s", from_number, body)
+            reply = UNKNOWN_NUMBER_REPLY
+        else:
+            reply = self._interpret(guest, body)
+
+        if message_sid is not None:
+            db.session.add(InboundMessage(message_sid, from_number, body, reply))
+        try:
+            db.session.commit()
+        except IntegrityError:
+            db.session.rollback()
+            duplicate = InboundMessage.query.filter_by(message_sid=message_sid).first()
+            if duplicate is None:
+                raise
+            return duplicate.reply
+        except Exception:
+            db.session.rollback()
+            raise
+        return reply
+
+    def _queue_reply(self, queue, from_number: str, body: str, message_sid: str = None):
+        """
+        Works out the reply to a text from the guest as they are now, and queues the text for the sms queue worker
+        to apply, see app.sms_queue
+        Args:
+            queue (SmsQueue): queue to put the text on
+            from_number (str): phone number the text came from
+            body (str): lower cased text of the message
+            message_sid (str): Twilio's id for the message, if it sent one
+
+        Returns:
+            str or None - what to text back, if anything
+
+        Raises:
+            QueueFull: if the queue is full, nothing is queued
+        """
+        # queued first, so a full queue doesn't cost us a read
+        queue.put(message_sid, from_number, body)
+        guest = self.Guest.query.filter_by(phone_number=from_number).first()
+        if guest is None:
+            return UNKNOWN_NUMBER_REPLY
+        try:
+            return self._interpret(guest, body)
+        finally:
+            # the change is the worker's to write
+            db.session.rollback()
+
+    # the command logic is shared with the async webhook, see app.asgi
+    _interpret = staticmethod(interpret)
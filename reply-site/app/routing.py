@@ -0,0 +1,91 @@
+import time
+from functools import wraps
+
+from flask import current_app, g, has_request_context, request
+from flask_sqlalchemy import SignallingSession, SQLAlchemy, get_state
+from sqlalchemy import event, orm
+
+REPLICA_BIND = 'replica'
+# after a client writes, its reads stick to the primary until the time in this cookie so it sees its own writes
+STICKY_COOKIE = 'wm_read_primary_until'
+
+
+class RoutingSession(SignallingSession):
+    """
+    Session that sends reads to the read replica when the current request asked for it. Flushes always go to the
+    primary
+    """
+
+    def get_bind(self, mapper=None, clause=None, **kwargs):
+        # SQLAlchemy 1.4's scoped_session passes extra keyword arguments that SignallingSession does not take
+        if not self._flushing and has_request_context() and g.get('read_replica', False):
+            return get_state(self.app).db.get_engine(self.app, bind=REPLICA_BIND)
+        return super(RoutingSession, self).get_bind(mapper, clause)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    """flask-sqlalchemy that uses our RoutingSession"""
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+
+def replica_enabled():
+    """
+    Returns whether the current app has a read replica configured
+
+    Returns:
+        bool
+    """
+    return REPLICA_BIND in (current_app.config.get('SQLALCHEMY_BINDS') or {})
+
+
+def replica_reads(f):
+    """
+    Resource method decorator that sends the method's queries to the read replica, unless the client wrote something
+    recently and needs to read its own writes from the primary
+    """
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        if replica_enabled():
+            try:
+                primary_until = float(request.cookies.get(STICKY_COOKIE, 0))
+            except ValueError:
+                primary_until = 0
+            g.read_replica = primary_until < time.time()
+        return f(*args, **kwargs)
+    return decorated_function
+
+
+def _mark_write(session, *args):
+    if has_request_context():
+        g.db_wrote = True
+
+
+def _set_sticky_cookie(response):
+    """
+    Tells the client to read from the primary for a little while after a write
+    """
+    if g.get('db_wrote', False):
+        sticky_seconds = current_app.config['READ_REPLICA_STICKY_SECONDS']
+        response.set_cookie(STICKY_COOKIE, str(time.time() + sticky_seconds), max_age=sticky_seconds,
+                            httponly=True)
+    return response
+
+
+def init_read_replica(app):
+    """
+    Adds the read replica as a bind when one is configured and sets up read your writes stickiness
+    Args:
+        app (Flask): app to configure
+    """
+    replica_uri = app.config.get('SQLALCHEMY_READ_REPLICA_URI')
+    if not replica_uri:
+        return
+    binds = dict(app.config.get('SQLALCHEMY_BINDS') or {})
+    binds[REPLICA_BIND] = replica_uri
+    app.config['SQLALCHEMY_BINDS'] = binds
+    for session_event in ('after_flush', 'after_bulk_update', 'after_bulk_delete'):
+        if not event.contains(RoutingSession, session_event, _mark_write):
+            event.listen(RoutingSession, session_event, _mark_write)
+    app.after_request(_set_sticky_cookie)
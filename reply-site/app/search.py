@@ -0,0 +1,139 @@
+import re
+
+from sqlalchemy import DDL, event, text
+
+from app import db
+
+# Postgres keeps a weighted tsvector in a generated column, indexed with GIN
+POSTGRES_DDL = (
+    "ALTER TABLE guests ADD COLUMN search_vector tsvector GENERATED ALWAYS AS ("
+    "setweight(to_tsvector('simple', coalesce(name, '')), 'A') || "
+    "setweight(to_tsvector('simple', coalesce(email_address, '')), 'B') || "
+    "setweight(to_tsvector('simple', coalesce(physical_address, '')), 'C') || "
+    "setweight(to_tsvector('simple', coalesce(rsvp_notes, '')), 'D')) STORED",
+    "CREATE INDEX ix_guests_search_vector ON guests USING GIN (search_vector)",
+)
+
+# SQLite uses an external content FTS5 table over guests, kept in sync by triggers
+SQLITE_DDL = (
+    "CREATE VIRTUAL TABLE IF NOT EXISTS guests_fts USING fts5("
+    "name, email_address, physical_address, rsvp_notes, content='guests', content_rowid='id', "
+    # prefix indexes keep search-as-you-type prefix queries fast
+    "prefix='2 3')",
+    "CREATE TRIGGER IF NOT EXISTS guests_fts_insert AFTER INSERT ON guests BEGIN "
+    "INSERT INTO guests_fts(rowid, name, email_address, physical_address, rsvp_notes) "
+    "VALUES (new.id, new.name, new.email_address, new.physical_address, new.rsvp_notes); END",
+    "CREATE TRIGGER IF NOT EXISTS guests_fts_delete AFTER DELETE ON guests BEGIN "
+    "INSERT INTO guests_fts(guests_fts, rowid, name, email_address, physical_address, rsvp_notes) "
+    "VALUES ('delete', old.id, old.name, old.email_address, old.physical_address, old.rsvp_notes); END",
+    "CREATE TRIGGER IF NOT EXISTS guests_fts_update AFTER UPDATE ON guests BEGIN "
+    "INSERT INTO guests_fts(guests_fts, rowid, name, email_address, physical_address, rsvp_notes) "
+    "VALUES ('delete', old.id, old.name, old.email_address, old.physical_address, old.rsvp_notes); "
+    "INSERT INTO guests_fts(rowid, name, email_address, physical_address, rsvp_notes) "
+    "VALUES (new.id, new.name, new.email_address, new.physical_address, new.rsvp_notes); END",
+    # rank by bm25 with names weighted highest, in the same order as the columns
+    "INSERT INTO guests_fts(guests_fts, rank) VALUES ('rank', 'bm25(10.0, 5.0, 2.0, 1.0)')",
+)
+
+# Every match is ranked, the indexes hand us the matches and the database keeps just the top page while it ranks
+# them (FTS5's ORDER BY rank LIMIT and a top-N sort in postgres). The ranked page is then joined back to guests,
+# rather than joining every match. Counting is what doesn't need to be exact, only the first SEARCH_COUNT_LIMIT
+# matches are counted, a query that matches more guests than that isn't one anybody reads to the end of.
+SEARCH_QUERIES = {
+    'postgresql': (
+        "SELECT guests.* FROM ("
+        "SELECT id, ts_rank(search_vector, to_tsquery('simple', :query)) AS rank FROM guests "
+        "WHERE search_vector @@ to_tsquery('simple', :query) "
+        "ORDER BY rank DESC, id LIMIT :limit OFFSET :offset"
+        ") AS matches JOIN guests ON guests.id = matches.id ORDER BY matches.rank DESC, guests.id",
+        "SELECT count(*) FROM (SELECT 1 FROM guests WHERE search_vector @@ to_tsquery('simple', :query) "
+        "LIMIT :count_limit) AS counted",
+    ),
+    'sqlite': (
+        "SELECT guests.* FROM ("
+        "SELECT rowid, rank FROM guests_fts WHERE guests_fts MATCH :query "
+        "ORDER BY rank LIMIT :limit OFFSET :offset"
+        ") AS matches JOIN guests ON guests.id = matches.rowid ORDER BY matches.rank, guests.id",
+        "SELECT count(*) FROM (SELECT 1 FROM guests_fts WHERE guests_fts MATCH :query LIMIT :count_limit)",
+    ),
+}
+SEARCH_COUNT_LIMIT = 1000
+
+
+class SearchNotSupported(Exception):
+    """Raised when our database has no full text search we know how to use"""
+    pass
+
+
+def optimize_search_index():
+    """
+    Merges the sqlite full text index down to a single segment. Loading lots of guests at once leaves the index in
+    many small segments that every lookup has to walk, so run this after a bulk import. Postgres' GIN index doesn't
+    need it
+    """
+    if db.session.get_bind().dialect.name == 'sqlite':
+        db.session.execute(text("INSERT INTO guests_fts(guests_fts) VALUES ('optimize')"))
+        db.session.commit()
+
+
+def install_search_ddl(table):
+    """
+    Creates the full text index along with the guests table whenever the tables are created outside of our
+    migrations, i.e. db.create_all in tests and benchmarks
+    Args:
+        table (sqlalchemy.Table): the guests table
+    """
+    for statement in POSTGRES_DDL:
+        event.listen(table, 'after_create', DDL(statement).execute_if(dialect='postgresql'))
+    for statement in SQLITE_DDL:
+        event.listen(table, 'after_create', DDL(statement).execute_if(dialect='sqlite'))
+    event.listen(table, 'before_drop', DDL("DROP TABLE IF EXISTS guests_fts").execute_if(dialect='sqlite'))
+
+
+def _search_terms(query: str, dialect: str):
+    """
+    Turns what the user typed into a query matching every word, in the dialect's query syntax. The last word is a
+    prefix match since it's usually the one still being typed. Only word characters make it through, so the user
+    can't inject query operators
+
+    Args:
+        query (str): what the user searched for
+        dialect (str): database dialect name
+
+    Returns:
+        str or None - None if there is nothing to search for
+    """
+    words = re.findall(r"\w+", query.lower())
+    if not words:
+        return None
+    if dialect == 'postgresql':
+        return " & ".join(words[:-1] + ["{}:*".format(words[-1])])
+    return " ".join(['"{}"'.format(word) for word in words[:-1]] + ['"{}"*'.format(words[-1])])
+
+
+def search_guests(query: str, page: int, per_page: int):
+    """
+    Full text search over guest names, emails, addresses and rsvp notes, best matches first
+
+    Args:
+        query (str): what the user searched for
+        page (int): page of results, starting at 1
+        per_page (int): results per page
+
+    Returns:
+        tuple(list, int) - the page of Guests and the total number of matches, up to SEARCH_COUNT_LIMIT
+    """
+    from app.models import Guest
+
+    dialect = db.session.get_bind().dialect.name
+    if dialect not in SEARCH_QUERIES:
+        raise SearchNotSupported("Full text search is not supported on {}".format(dialect))
+    terms = _search_terms(query, dialect)
+    if terms is None:
+        return [], 0
+
+    results_sql, count_sql = SEARCH_QUERIES[dialect]
+    guests = db.session.query(Guest).from_statement(text(results_sql)).params(
+        query=terms, limit=per_page, offset=(page - 1) * per_page).all()
+    total = db.session.execute(text(count_sql), {'query': terms, 'count_limit': SEARCH_COUNT_LIMIT}).scalar()
+    return guests, total
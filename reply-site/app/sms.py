@@ -0,0 +1,114 @@
+"""
+What we do with a text from a guest. Shared by the flask webhook (app.resources.TwilioResponseAPI) and the async
+one (app.asgi), so both parse and answer messages the same way
+"""
+
+UNKNOWN_NUMBER_REPLY = "I don't recognize your number or something is very broken. " \
+                       "Please reach out to Andrew or Sarah directly for help"
+RSVP_HELP_REPLY = "Sorry, but I couldn't understand that. To RSVP, use RSVP Yes/No #of attendees. " \
+                  "Examples: RSVP yes 2 or RSVP no."
+
+
+def parse_webhook(values):
+    """
+    Pulls what we need out of the values Twilio posts to the webhook
+    Args:
+        values (Mapping): the request's form and query args
+
+    Returns:
+        tuple(str, str, str) - message sid (None if Twilio didn't send one), the number the text came from without
+        its country code and the lower cased body
+    """
+    return values.get('MessageSid', None), values.get('From', None).strip("+1"), values.get('Body', None).lower()
+
+
+def interpret(guest, body: str):
+    """
+    Applies the command in a text to the guest, without saving it
+    Args:
+        guest (Guest): guest the text came from
+        body (str): lower cased text of the message
+
+    Returns:
+        str or None - what to text back, if anything
+    """
+    if body[:3] == "yes":
+        # We have a keeper! Update their confirmation status
+        guest.date_saved = True
+        return "Thanks for confirming, we'll be in touch with more info soon!"
+
+    if body[:2] == "no":
+        # declined guest
+        guest.date_saved = False
+        return "We understand life can be busy. We'll still be thinking of you on our special day"
+
+    if body[:4] == "rsvp":
+        # we have an rsvp
+        split_body = body.split()
+        total_attendees = guest.total_attendees
+        if split_body[1].lower()[:3] == "yes":
+            # We gave an rsvp!
+            response = "We're so glad you're joining us on our special day! " \
+                       "Remember to keep up with the wedding site for any updates!"
+            rsvp = True
+            try:
+                responded_attendees = int(split_body[2])
+            except ValueError:
+                return RSVP_HELP_REPLY
+            # check that they're not trying to bring the whole town with them
+            if responded_attendees > total_attendees:
+                return "I'm sorry, but we have to keep our wedding small. We ask that you only bring up to " \
+                       "{} people. If you need extra, please reach out to Andrew and Sarah and we can work " \
+                       "with you".format(total_attendees)
+            total_attendees = responded_attendees
+            note = " ".join(split_body[3:])
+        elif split_body[1].lower()[:3] == "no":
+            response = "Thank you for responding. We understand life can be busy. We'll be thinking of you on " \
+                       "our special day."
+            rsvp = False
+            total_attendees = 0
+            note = body
+        else:
+            return RSVP_HELP_REPLY
+        guest.total_attendees = total_attendees
+        guest.rsvp = rsvp
+        if guest.rsvp_notes is None:
+            guest.rsvp_notes = note
+        else:
+            guest.rsvp_notes += "\n" + note
+        return response
+
+    if body[:4] == "stop":
+        # they dont want texts
+        guest.stop_notifications = True
+        guest.rsvp_notes = body
+        return "We're so sorry! We won't text you again about our wedding plans."
+    return None
+
+
+def messaging_response():
+    """
+    Returns a new TwiML messaging response
+    Returns:
+        twilio.twiml.messaging_response.MessagingResponse
+    """
+    # twilio is imported on first use so it doesn't weigh down worker boot
+    from twilio.twiml.messaging_response import MessagingResponse
+    return MessagingResponse()
+
+
+def render_reply(reply: str, response=None):
+    """
+    Renders the TwiML that answers a text
+    Args:
+        reply (str): what to text back, None to not answer
+        response (MessagingResponse): response to add the reply to, defaults to a new one
+
+    Returns:
+        str
+    """
+    if response is None:
+        response = messaging_response()
+    if reply is not None:
+        response.message(reply)
+    return str(response)
@@ -0,0 +1,218 @@
+"""
+Write-behind for the sms webhook. After a campaign goes out every reply commits before it's answered, so a slow
+database turns into slow webhooks and Twilio timing out on us. With SMS_QUEUE_PATH set the webhook works out its
+reply from the guest as it is, puts the message in a queue kept in a local sqlite file and answers straight away.
+manage.py sms_queue_worker drains the queue in batches, a transaction per batch, applying each message the same way
+the webhook would have (see app.sms.interpret).
+
+Messages are applied in the order they were queued. Only one worker drains a queue, it holds a lock on the queue
+file, so a guest's texts can never be applied out of order. The queue is bounded by SMS_QUEUE_MAX_SIZE, when it's
+full the webhook answers 503 so Twilio backs off instead of us losing messages. Every gunicorn worker on a host
+shares the queue file, so it belongs on local disk, not a network share.
+"""
+import fcntl
+import sqlite3
+import threading
+import time
+from collections import namedtuple
+
+from flask import current_app
+
+from app import db
+from app.models import Guest, InboundMessage, retry_on_conflict
+from app.sms import UNKNOWN_NUMBER_REPLY, interpret
+
+# how long Twilio is asked to wait before trying a message again when the queue is full
+QUEUE_FULL_RETRY_AFTER_SECONDS = 5
+
+QueuedMessage = namedtuple('QueuedMessage', ['id', 'message_sid', 'from_number', 'body'])
+
+
+class QueueFull(Exception):
+    """Raised when a message is put on a queue that is already holding its most messages"""
+    pass
+
+
+class SmsQueue(object):
+    """Durable FIFO queue of inbound text messages, in a sqlite file"""
+
+    def __init__(self, path: str, max_size: int):
+        """
+        Args:
+            path (str): sqlite file to keep the queue in, it's created if it doesn't exist
+            max_size (int): most messages the queue holds before put raises QueueFull
+        """
+        self.path = path
+        self.max_size = max_size
+        # sqlite connections can't be shared between threads, each thread gets its own
+        self._local = threading.local()
+
+    def _connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            # autocommit, we start our own transactions
+            connection = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            # WAL lets the drain read while the webhook writes, synchronous FULL makes a put durable once it returns
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=FULL")
+            connection.execute("CREATE TABLE IF NOT EXISTS sms_queue ("
+                               "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+                               "message_sid TEXT UNIQUE, "
+                               "from_number TEXT NOT NULL, "
+                               "body TEXT NOT NULL, "
+                               "date_queued REAL NOT NULL)")
+            self._local.connection = connection
+        return connection
+
+    def put(self, message_sid: str, from_number: str, body: str):
+        """
+        Queues a message. A MessageSid that is already queued isn't queued again
+        Args:
+            message_sid (str): Twilio's id for the message, if it sent one
+            from_number (str): phone number the text came from
+            body (str): lower cased text of the message
+
+        Returns:
+            int - messages in the queue
+
+        Raises:
+            QueueFull: if the queue already holds max_size messages
+        """
+        connection = self._connection()
+        # IMMEDIATE takes the write lock up front, so the size check and the insert can't interleave with another
+        # worker's, and ids are handed out in the order messages were queued
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            size = connection.execute("SELECT count(*) FROM sms_queue").fetchone()[0]
+            if size >= self.max_size:
+                raise QueueFull("{} messages queued".format(size))
+            inserted = connection.execute(
+                "INSERT OR IGNORE INTO sms_queue (message_sid, from_number, body, date_queued) VALUES (?, ?, ?, ?)",
+                (message_sid, from_number, body, time.time())).rowcount
+            connection.execute("COMMIT")
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        return size + inserted
+
+    def peek(self, limit: int):
+        """
+        Returns the oldest messages in the queue, without taking them off it
+        Args:
+            limit (int): most messages to return
+
+        Returns:
+            list - QueuedMessages, oldest first
+        """
+        return [QueuedMessage(*row) for row in self._connection().execute(
+            "SELECT id, message_sid, from_number, body FROM sms_queue ORDER BY id LIMIT ?", (limit,))]
+
+    def ack(self, last_id: int):
+        """
+        Takes messages off the queue once they're applied
+        Args:
+            last_id (int): id of the newest message applied, it and every message before it are removed
+        """
+        self._connection().execute("DELETE FROM sms_queue WHERE id <= ?", (last_id,))
+
+    def __len__(self):
+        return self._connection().execute("SELECT count(*) FROM sms_queue").fetchone()[0]
+
+
+def init_sms_queue(app):
+    """
+    Sets up the write-behind queue for the sms webhook, if SMS_QUEUE_PATH is set
+    Args:
+        app (Flask): app to add the queue to
+    """
+    path = app.config['SMS_QUEUE_PATH']
+    app.extensions['sms_queue'] = SmsQueue(path, app.config['SMS_QUEUE_MAX_SIZE']) if path else None
+
+
+def get_sms_queue():
+    """
+    Returns the current app's sms queue
+    Returns:
+        SmsQueue or None - None when the webhook writes through
+    """
+    return current_app.extensions.get('sms_queue')
+
+
+@retry_on_conflict()
+def _apply_batch(messages: list):
+    """
+    Applies a batch of queued messages in one transaction, in queue order. Messages whose MessageSid was already
+    applied, i.e. before a drain was interrupted between committing and acking, are skipped
+    Args:
+        messages (list): QueuedMessages
+    """
+    sids = [message.message_sid for message in messages if message.message_sid is not None]
+    applied = {sid for sid, in db.session.query(InboundMessage.message_sid).filter(
+        InboundMessage.message_sid.in_(sids))} if sids else set()
+    guests = {}
+    # the webhook answers for the first guest with a number, so do we
+    for guest in Guest.query.filter(Guest.phone_number.in_({message.from_number for message in messages})).order_by(
+            Guest.id.desc()):
+        guests[guest.phone_number] = guest
+
+    for message in messages:
+        if message.message_sid in applied:
+            continue
+        guest = guests.get(message.from_number)
+        reply = interpret(guest, message.body) if guest is not None else UNKNOWN_NUMBER_REPLY
+        if message.message_sid is not None:
+            db.session.add(InboundMessage(message.message_sid, message.from_number, message.body, reply))
+            applied.add(message.message_sid)
+    try:
+        db.session.commit()
+    except Exception:
+        # retry_on_conflict runs us again from a clean session
+        db.session.rollback()
+        raise
+
+
+def drain(queue: SmsQueue, batch_size: int):
+    """
+    Applies the oldest batch of messages in the queue and takes them off it
+    Args:
+        queue (SmsQueue): queue to drain
+        batch_size (int): most messages to apply in the transaction
+
+    Returns:
+        int - messages applied, 0 once the queue is empty
+    """
+    messages = queue.peek(batch_size)
+    if not messages:
+        return 0
+    _apply_batch(messages)
+    queue.ack(messages[-1].id)
+    return len(messages)
+
+
+def run_queue_worker(once: bool = False):
+    """
+    Drains the sms queue until stopped. Run one of these per queue file, in its own process with an app context, see
+    manage.py sms_queue_worker
+    Args:
+        once (bool): stop when the queue is empty, instead of polling for more
+
+    Raises:
+        RuntimeError: if the app has no queue, or another worker is already draining it
+    """
+    config = current_app.config
+    queue = get_sms_queue()
+    if queue is None:
+        raise RuntimeError("SMS_QUEUE_PATH isn't set, there is no queue to drain")
+    with open(queue.path + ".lock", "w") as lock_file:
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            raise RuntimeError("Another worker is already draining {}".format(queue.path))
+        while True:
+            applied = drain(queue, config['SMS_QUEUE_BATCH_SIZE'])
+            if applied:
+                current_app.logger.info("Applied {} queued messages".format(applied))
+                continue
+            if once:
+                return
+            time.sleep(config['SMS_QUEUE_POLL_SECONDS'])
@@ -0,0 +1,9 @@
+"""
+Async entry point for the sms webhook, served alongside the flask app in run.py. Point Twilio's webhook, or your
+proxy's /api/sms route, at it
+
+    uvicorn asgi:app --host 0.0.0.0 --port 8001
+"""
+from app.asgi import create_asgi_app
+
+app = create_asgi_app()
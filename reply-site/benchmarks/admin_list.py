@@ -0,0 +1,60 @@
+"""
+Admin guest list benchmark
+
+Loads a synthetic guest list and times the admin list page with a stock flask-admin ModelView against our
+GuestAdminView, for the first page, a deep page, a sorted page and a filtered page.
+
+    python -m benchmarks.admin_list --guests 100000
+"""
+import os
+import statistics
+import tempfile
+import time
+
+import click
+
+from benchmarks.harness import configure_environment
+
+PAGES = {
+    'first page': "",
+    'page 1000': "?page=1000",
+    'sorted by name': "?sort=0",
+    'filtered on rsvp': "?flt1_0=1",
+}
+
+
+@click.command()
+@click.option('--guests', default=100000, type=int, help="Number of synthetic guests to load")
+@click.option('--repeat', default=5, type=int, help="Requests per page, we report the median")
+def main(guests: int, repeat: int):
+    configure_environment("sqlite:///{}".format(os.path.join(tempfile.mkdtemp(), "admin.db")))
+
+    from flask_admin.contrib.sqla import ModelView
+    from app import create_app, db
+    from app.models import Guest
+    from benchmarks.datasets import load_guests
+
+    app = create_app('admin')
+    # register the stock view next to ours so both run against the same data
+    app.extensions['admin'][0].add_view(ModelView(Guest, db.session, endpoint="stockguest",
+                                                  url="/admin/stockguest"))
+    with app.app_context():
+        db.create_all()
+        click.echo("Loading {} guests".format(guests))
+        load_guests(db, guests)
+
+    client = app.test_client()
+    for view_url in ("/admin/stockguest/", "/admin/guest/"):
+        click.echo(view_url)
+        for name, query in PAGES.items():
+            timings = []
+            for _ in range(repeat):
+                start = time.perf_counter()
+                res = client.get(view_url + query)
+                timings.append(time.perf_counter() - start)
+                assert res.status_code == 200, res.status_code
+            click.echo("  {:<18} {:>8.1f}ms".format(name, statistics.median(timings) * 1000))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,108 @@
+import random
+from datetime import datetime, timedelta
+
+FIRST_NAMES = ["John", "Jane", "Steve", "Dora", "Sarah", "Andrew", "Maria", "Luis", "Priya", "Chen", "Fatima",
+               "Olga", "Kwame", "Aiko", "Liam", "Emma", "Noah", "Ava", "Mateo", "Zoe"]
+LAST_NAMES = ["Doe", "Testerson", "Explora", "Smith", "Garcia", "Nguyen", "Patel", "Kim", "Okafor", "Rossi",
+              "Muller", "Silva", "Cohen", "Haddad", "Ivanova", "Brown", "Tanaka", "Lopez", "Walker", "Young"]
+STREETS = ["Main St", "Oak Ave", "Pine Rd", "Elm St", "Maple Dr", "Cedar Ln", "Lakeview Blvd", "Hill St"]
+CITIES = ["San Antonio, TX", "Columbus, OH", "Austin, TX", "Denver, CO", "Portland, OR", "Chicago, IL"]
+NOTES = ["so happy for you", "can't wait!", "vegetarian please", "we'll be a little late", "congrats!!",
+         "bringing the kids", "no shellfish", "see you there"]
+
+# Roughly what our real guest list looked like a month out from the wedding. date_saved is None until a guest
+# answers the save the date, and most guests only RSVP after saying yes to the save the date.
+DATE_SAVED_WEIGHTS = ((None, 0.25), (True, 0.6), (False, 0.15))
+RSVP_AFTER_SAVED_WEIGHTS = ((None, 0.45), (True, 0.45), (False, 0.1))
+STOP_NOTIFICATIONS_RATE = 0.03
+NOTES_RATE = 0.3
+
+
+def _weighted_choice(rng: random.Random, weights: tuple):
+    """
+    Picks a value from a tuple of (value, weight) pairs
+    Args:
+        rng (random.Random): random number generator to use
+        weights (tuple): (value, weight) pairs
+
+    Returns:
+        any
+    """
+    roll = rng.random()
+    for value, weight in weights:
+        if roll < weight:
+            return value
+        roll -= weight
+    return weights[-1][0]
+
+
+def generate_guests(count: int, seed: int = 2018):
+    """
+    Generator that yields synthetic guest rows, suitable for a bulk insert into the guests table
+
+    Args:
+        count (int): How many guests to generate
+        seed (int): Seed for the random generator, so datasets are repeatable between runs
+
+    Yields:
+        dict
+    """
+    rng = random.Random(seed)
+    created = datetime(2018, 1, 1)
+    for i in range(count):
+        first = rng.choice(FIRST_NAMES)
+        last = rng.choice(LAST_NAMES)
+        if rng.random() < 0.5:
+            name = "{} and {} {}".format(first, rng.choice(FIRST_NAMES), last)
+            total_attendees = rng.randint(2, 5)
+        else:
+            name = "{} {}".format(first, last)
+            total_attendees = 1
+
+        date_saved = _weighted_choice(rng, DATE_SAVED_WEIGHTS)
+        rsvp = _weighted_choice(rng, RSVP_AFTER_SAVED_WEIGHTS) if date_saved else None
+        if date_saved is False:
+            rsvp = False if rng.random() < 0.5 else None
+        rsvp_notes = rng.choice(NOTES) if rsvp is not None and rng.random() < NOTES_RATE else None
+        modified = created + timedelta(minutes=rng.randint(0, 60 * 24 * 90))
+
+        yield {
+            'id': i + 1,
+            'name': name,
+            'total_attendees': total_attendees,
+            # ids are unique, so are the phone numbers. This lets the sms scenario look up any guest
+            'phone_number': "{:010d}".format(2000000000 + i),
+            'email_address': "{}.{}{}@example.com".format(first, last, i).lower(),
+            'physical_address': "{} {}, {}".format(rng.randint(1, 9999), rng.choice(STREETS), rng.choice(CITIES)),
+            'date_saved': date_saved,
+            'rsvp': rsvp,
+            'rsvp_notes': rsvp_notes,
+            'stop_notifications': rng.random() < STOP_NOTIFICATIONS_RATE,
+            'last_notified': None,
+            'date_created': created,
+            'date_modified': modified,
+        }
+
+
+def load_guests(db, count: int, batch_size: int = 10000, seed: int = 2018):
+    """
+    Bulk inserts synthetic guests with core inserts, skipping the ORM so loading a million rows stays fast.
+    Must be called inside an app context
+
+    Args:
+        db (flask_sqlalchemy.SQLAlchemy): our db
+        count (int): How many guests to insert
+        batch_size (int): Rows per insert statement
+        seed (int): Seed for the random generator
+    """
+    from app.models import Guest
+
+    batch = []
+    for guest in generate_guests(count, seed):
+        batch.append(guest)
+        if len(batch) >= batch_size:
+            db.session.execute(Guest.__table__.insert(), batch)
+            batch = []
+    if batch:
+        db.session.execute(Guest.__table__.insert(), batch)
+    db.session.commit()
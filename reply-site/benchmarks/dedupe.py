@@ -0,0 +1,110 @@
+"""
+Duplicate guest detection benchmark
+
+Builds a synthetic guest list with near duplicates mixed in, the same household with its names reordered, its phone
+number formatted another way or its email address in capitals, and runs app.dedupe.find_duplicates over it. Reports
+the time taken, how many pairs were compared against comparing every pair, and how many of the planted duplicates
+were found. No database is needed, the guests are records like the admin's duplicates view reads.
+
+    python -m benchmarks.dedupe --guests 100000 --duplicate_rate 0.02
+"""
+import random
+import time
+from collections import namedtuple
+
+import click
+
+from app.dedupe import DEDUPE_FIELDS, find_duplicates
+from benchmarks.datasets import generate_guests
+
+GuestRecord = namedtuple('GuestRecord', DEDUPE_FIELDS)
+
+
+def _reformat_phone(phone_number: str, rng: random.Random):
+    """
+    Returns a phone number written another way
+
+    Args:
+        phone_number (str): ten digit phone number
+        rng (random.Random): random number generator to use
+
+    Returns:
+        str
+    """
+    return rng.choice(["({}) {}-{}".format(phone_number[:3], phone_number[3:6], phone_number[6:]),
+                       "+1{}".format(phone_number),
+                       "{}.{}.{}".format(phone_number[:3], phone_number[3:6], phone_number[6:])])
+
+
+def _reorder_name(name: str):
+    """
+    Returns a name with its first names swapped, i.e. John and Jane Doe becomes Jane & John Doe
+
+    Args:
+        name (str): name of the guest group
+
+    Returns:
+        str
+    """
+    words = name.split()
+    if len(words) == 4:
+        return "{} & {} {}".format(words[2], words[0], words[3])
+    return "{} {}".format(words[-1], " ".join(words[:-1]))
+
+
+def build_guests(count: int, duplicate_rate: float, seed: int = 2018):
+    """
+    Returns synthetic guests with near duplicates of some of them added
+
+    Args:
+        count (int): guests to generate, before the duplicates
+        duplicate_rate (float): share of guests that get a duplicate
+        seed (int): seed for the random generator, so runs are repeatable
+
+    Returns:
+        tuple(list, set) - GuestRecords, and the planted duplicates as (original id, duplicate id) pairs
+    """
+    rng = random.Random(seed)
+    guests = [GuestRecord(*[row[field] for field in DEDUPE_FIELDS]) for row in generate_guests(count, seed)]
+    planted = set()
+    next_id = count + 1
+    for original in rng.sample(guests, int(count * duplicate_rate)):
+        # each duplicate keeps at least the phone number or the email address, changes the rest
+        change = rng.choice(['phone', 'email', 'both'])
+        guests.append(GuestRecord(
+            id=next_id,
+            name=_reorder_name(original.name),
+            phone_number=_reformat_phone(original.phone_number, rng) if change != 'email' else None,
+            email_address=original.email_address.upper() if change != 'phone' else None,
+            date_saved=None,
+            rsvp=None))
+        planted.add((original.id, next_id))
+        next_id += 1
+    rng.shuffle(guests)
+    return guests, planted
+
+
+@click.command()
+@click.option('--guests', default=100000, type=int, help="Number of synthetic guests to generate")
+@click.option('--duplicate_rate', default=0.02, type=float, help="Share of guests to plant a duplicate of")
+def main(guests: int, duplicate_rate: float):
+    records, planted = build_guests(guests, duplicate_rate)
+    click.echo("Deduping {} guests, {} planted duplicates".format(len(records), len(planted)))
+
+    start = time.perf_counter()
+    suggestions, stats = find_duplicates(records)
+    elapsed = time.perf_counter() - start
+
+    found = {tuple(sorted((suggestion.keep.id, suggestion.duplicate.id))) for suggestion in suggestions}
+    every_pair = len(records) * (len(records) - 1) // 2
+    click.echo("  {:.2f}s, {} blocks, {} skipped".format(elapsed, stats['blocks'], stats['skipped_blocks']))
+    click.echo("  compared {} pairs, {:.5f}% of all {} pairs".format(stats['compared'],
+                                                                    100.0 * stats['compared'] / every_pair,
+                                                                    every_pair))
+    click.echo("  {} suggestions, found {} of {} planted ({:.1%} recall, {:.1%} precision)".format(
+        len(suggestions), len(found & planted), len(planted), len(found & planted) / max(len(planted), 1),
+        len(found & planted) / max(len(found), 1)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,81 @@
+"""
+List response encoding benchmark
+
+Times encoding a guest list the way flask-restful used to (to_json per guest then the stdlib encoder) against
+app.encoding, with and without orjson.
+
+    python -m benchmarks.encoding --guests 10000 --guests 100000
+"""
+import json
+import time
+from unittest.mock import patch
+
+import click
+
+from benchmarks.harness import configure_environment
+
+
+def _time(func, repeat: int):
+    """
+    Returns the best wall clock time of repeat calls to func, in milliseconds
+
+    Args:
+        func (callable): function to time
+        repeat (int): number of calls
+
+    Returns:
+        float
+    """
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return round(best * 1000, 2)
+
+
+@click.command()
+@click.option('--guests', 'sizes', multiple=True, type=int, default=[10000, 100000], help="List sizes to encode")
+@click.option('--repeat', default=3, type=int, help="Runs per measurement, we report the best")
+def main(sizes: tuple, repeat: int):
+    configure_environment("sqlite://")
+
+    from app import create_app, db, encoding
+    from app.models import Guest
+    from benchmarks.datasets import load_guests
+
+    app = create_app('api')
+    with app.app_context():
+        db.create_all()
+        load_guests(db, max(sizes))
+        all_guests = Guest.query.all()
+
+        for size in sizes:
+            guests = all_guests[:size]
+
+            def stdlib_to_json():
+                return json.dumps([guest.to_json() for guest in guests]).encode()
+
+            def stream(items):
+                return b"".join(encoding._stream_array(items, app.config['JSON_STREAM_CHUNK_SIZE']))
+
+            results = {
+                'to_json + stdlib (before)': _time(stdlib_to_json, repeat),
+                'app.encoding stdlib fallback': None,
+                'app.encoding orjson': None,
+                'app.encoding orjson streamed': None,
+            }
+            with patch.object(encoding, 'orjson', None):
+                results['app.encoding stdlib fallback'] = _time(lambda: encoding.dumps(guests), repeat)
+            if encoding.orjson is not None:
+                results['app.encoding orjson'] = _time(lambda: encoding.dumps(guests), repeat)
+                results['app.encoding orjson streamed'] = _time(lambda: stream(guests), repeat)
+
+            click.echo("{} guests".format(size))
+            for name, result in results.items():
+                click.echo("  {:<32} {}".format(name, "{}ms".format(result) if result is not None else "n/a"))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,224 @@
+import json
+import logging
+import math
+import os
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+
+def configure_environment(database_uri: str, **overrides):
+    """
+    Sets the environment our Config reads from. instance.config reads the environment when it is imported, so this
+    has to run before anything from app is imported
+
+    Args:
+        database_uri (str): Database the app should use
+        **overrides: Any other environment variables to set
+    """
+    os.environ['DATABASE_URI'] = database_uri
+    os.environ.setdefault('FLASK_SECRET', "benchmark")
+    os.environ.setdefault('TWILIO_AUTH_TOKEN', "benchmark")
+    os.environ.setdefault('DEBUG_MODE', "False")
+    os.environ.setdefault('TESTING_MODE', "False")
+    for key, value in overrides.items():
+        os.environ[key] = str(value)
+
+
+@contextmanager
+def serve(app):
+    """
+    Serves an app with a threaded werkzeug WSGI server on a free local port for the duration of the context
+
+    Args:
+        app (Flask): app to serve
+
+    Yields:
+        str - base url of the server
+    """
+    from werkzeug.serving import make_server
+
+    # werkzeug logs a line per request, which would drown out our results and slow down the server
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    server = make_server("127.0.0.1", 0, app, threaded=True)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield "http://127.0.0.1:{}".format(server.server_port)
+    finally:
+        server.shutdown()
+        thread.join()
+
+
+def request(method: str, url: str, data: dict = None, headers: dict = None, form: bool = False):
+    """
+    Makes a single http request
+
+    Args:
+        method (str): http method
+        url (str): url to call
+        data (dict): body to send, json encoded unless form is set
+        headers (dict): extra headers to send
+        form (bool): send data as a url encoded form
+
+    Returns:
+        int - status code
+    """
+    headers = dict(headers or {})
+    body = None
+    if data is not None:
+        if form:
+            body = urllib.parse.urlencode(data).encode()
+            headers['Content-Type'] = "application/x-www-form-urlencoded"
+        else:
+            body = json.dumps(data).encode()
+            headers['Content-Type'] = "application/json"
+    req = urllib.request.Request(url, data=body, headers=headers, method=method)
+    try:
+        with urllib.request.urlopen(req) as response:
+            response.read()
+            return response.status
+    except urllib.error.HTTPError as exc:
+        return exc.code
+
+
+def percentile(sorted_values: list, pct: float):
+    """
+    Nearest rank percentile of an already sorted list
+
+    Args:
+        sorted_values (list): sorted samples
+        pct (float): percentile, 0-100
+
+    Returns:
+        float
+    """
+    if not sorted_values:
+        return 0.0
+    rank = max(math.ceil(pct / 100.0 * len(sorted_values)) - 1, 0)
+    return sorted_values[min(rank, len(sorted_values) - 1)]
+
+
+def summarize(latencies: list, errors: int, elapsed: float):
+    """
+    Turns raw latency samples into the stats we record for a scenario
+
+    Args:
+        latencies (list): request latencies in seconds
+        errors (int): number of failed requests
+        elapsed (float): wall clock time of the scenario in seconds
+
+    Returns:
+        dict
+    """
+    ordered = sorted(latencies)
+    return {
+        'requests': len(ordered),
+        'errors': errors,
+        'throughput_rps': round(len(ordered) / elapsed, 2) if elapsed else 0.0,
+        'latency_ms': {
+            'p50': round(percentile(ordered, 50) * 1000, 3),
+            'p90': round(percentile(ordered, 90) * 1000, 3),
+            'p95': round(percentile(ordered, 95) * 1000, 3),
+            'p99': round(percentile(ordered, 99) * 1000, 3),
+            'max': round(ordered[-1] * 1000, 3) if ordered else 0.0,
+        }
+    }
+
+
+def run_concurrent(action, concurrency: int, duration: float = None, requests: int = None):
+    """
+    Calls action from concurrency threads, either until duration seconds pass or requests calls have been made
+
+    Args:
+        action (callable): Takes the worker number and call number, returns a status code
+        concurrency (int): Number of client threads
+        duration (float): How long to run for, in seconds
+        requests (int): Total calls to make across all threads
+
+    Returns:
+        dict - see summarize
+    """
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+    counter = iter(range(requests)) if requests is not None else None
+    start = time.perf_counter()
+    deadline = start + duration if duration is not None else None
+
+    def worker(worker_number):
+        local_latencies = []
+        local_errors = 0
+        call_number = 0
+        while True:
+            if deadline is not None and time.perf_counter() >= deadline:
+                break
+            if counter is not None:
+                with lock:
+                    if next(counter, None) is None:
+                        break
+            call_start = time.perf_counter()
+            try:
+                status = action(worker_number, call_number)
+            except Exception:
+                status = None
+            local_latencies.append(time.perf_counter() - call_start)
+            if status is None or status >= 400:
+                local_errors += 1
+            call_number += 1
+        with lock:
+            latencies.extend(local_latencies)
+            errors[0] += local_errors
+
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(worker, range(concurrency)))
+    return summarize(latencies, errors[0], time.perf_counter() - start)
+
+
+def _error_rate(stats: dict):
+    """
+    Fraction of a scenario's requests that failed
+
+    Args:
+        stats (dict): scenario stats, see summarize
+
+    Returns:
+        float
+    """
+    return stats['errors'] / stats['requests'] if stats.get('requests') else 0.0
+
+
+def compare_to_baseline(results: dict, baseline: dict, threshold: float):
+    """
+    Compares scenario results to a stored baseline
+
+    Args:
+        results (dict): this run's results
+        baseline (dict): previous results to compare against
+        threshold (float): allowed relative regression, i.e. 0.2 lets throughput drop 20%
+
+    Returns:
+        list[str] - one message per regression found
+    """
+    regressions = []
+    for name, current in results['scenarios'].items():
+        previous = baseline.get('scenarios', {}).get(name)
+        if previous is None:
+            continue
+        if current['throughput_rps'] < previous['throughput_rps'] * (1 - threshold):
+            regressions.append("{}: throughput {} rps is below baseline {} rps".format(
+                name, current['throughput_rps'], previous['throughput_rps']))
+        # fast failures would otherwise look like a throughput win
+        current_rate, previous_rate = _error_rate(current), _error_rate(previous)
+        if current_rate > previous_rate * (1 + threshold):
+            regressions.append("{}: error rate {:.2%} is above baseline {:.2%}".format(
+                name, current_rate, previous_rate))
+        for pct in ('p50', 'p95', 'p99'):
+            if current['latency_ms'][pct] > previous['latency_ms'][pct] * (1 + threshold):
+                regressions.append("{}: {} latency {}ms is above baseline {}ms".format(
+                    name, pct, current['latency_ms'][pct], previous['latency_ms'][pct]))
+    return regressions
@@ -0,0 +1,140 @@
+"""
+Load test for the reply site
+
+Loads a synthetic guest list into a fresh database, serves the real app through a threaded WSGI server and drives
+each endpoint with concurrent clients. Results are written to json and compared against a stored baseline.
+
+    python -m benchmarks.loadtest --guests 10000 --concurrency 8 --duration 10
+"""
+import json
+import os
+import platform
+import random
+import sys
+import tempfile
+from datetime import datetime
+
+import click
+
+from benchmarks.harness import compare_to_baseline, configure_environment, request, run_concurrent, serve
+
+DEFAULT_BASELINE = os.path.join(os.path.dirname(__file__), "baseline.json")
+SCENARIOS = ["list", "list_filtered", "get", "post", "put", "sms"]
+
+
+def _scenario_action(name: str, base_url: str, guest_count: int):
+    """
+    Builds the client call for a scenario
+
+    Args:
+        name (str): scenario name
+        base_url (str): url of the server under test
+        guest_count (int): number of guests in the dataset
+
+    Returns:
+        callable
+    """
+    rng = random.Random(name)
+
+    def random_id():
+        return rng.randint(1, guest_count)
+
+    if name == "list":
+        return lambda worker, call: request("GET", "{}/api/guests".format(base_url))
+    if name == "list_filtered":
+        return lambda worker, call: request(
+            "GET", "{}/api/guests?guest_filter=rsvp&guest_filter_value=None".format(base_url))
+    if name == "get":
+        return lambda worker, call: request("GET", "{}/api/guest/{}".format(base_url, random_id()))
+    if name == "post":
+        return lambda worker, call: request("POST", "{}/api/guest".format(base_url),
+                                            data={'name': "Load Test {}-{}".format(worker, call),
+                                                  'total_attendees': 2,
+                                                  'phone_number': "1{:03d}{:06d}".format(worker, call)})
+    if name == "put":
+        return lambda worker, call: request("PUT", "{}/api/guest/{}".format(base_url, random_id()),
+                                            data={'rsvp': True, 'rsvp_notes': "load test"})
+    if name == "sms":
+        # phone numbers in the synthetic dataset are 2000000000 + (id - 1)
+        return lambda worker, call: request("POST", "{}/api/sms".format(base_url), form=True,
+                                            data={'From': "+1{:010d}".format(2000000000 + random_id() - 1),
+                                                  'Body': "yes"})
+    raise click.BadParameter("Unknown scenario {}".format(name))
+
+
+@click.command()
+@click.option('--guests', default=1000, type=int, help="Number of synthetic guests to load, 1k to 1M")
+@click.option('--concurrency', default=8, type=int, help="Concurrent clients per scenario")
+@click.option('--duration', default=10.0, type=float, help="Seconds to run each scenario for")
+@click.option('--scenario', 'scenarios', multiple=True, type=click.Choice(SCENARIOS),
+              help="Scenarios to run, defaults to all of them")
+@click.option('--database_uri', default=None, help="Database to load into, defaults to a temporary sqlite file")
+@click.option('--output', default="loadtest-results.json", help="Where to write the results")
+@click.option('--baseline', default=DEFAULT_BASELINE, help="Results to compare against")
+@click.option('--threshold', default=0.2, type=float, help="Allowed relative regression against the baseline")
+@click.option('--update_baseline', is_flag=True, default=False, help="Store these results as the new baseline")
+def main(guests: int,
+         concurrency: int,
+         duration: float,
+         scenarios: tuple,
+         database_uri: str,
+         output: str,
+         baseline: str,
+         threshold: float,
+         update_baseline: bool):
+    if database_uri is None:
+        database_uri = "sqlite:///{}".format(os.path.join(tempfile.mkdtemp(), "loadtest.db"))
+    configure_environment(database_uri)
+
+    from app import create_app, db
+    from benchmarks.datasets import load_guests
+
+    app = create_app()
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        click.echo("Loading {} guests into {}".format(guests, database_uri))
+        load_guests(db, guests)
+
+    results = {
+        'meta': {
+            'guests': guests,
+            'concurrency': concurrency,
+            'duration': duration,
+            'database': database_uri.split(":")[0],
+            'python': platform.python_version(),
+            'date': datetime.now().isoformat(),
+        },
+        'scenarios': {}
+    }
+    with serve(app) as base_url:
+        for name in scenarios or SCENARIOS:
+            click.echo("Running {} for {}s with {} clients".format(name, duration, concurrency))
+            stats = run_concurrent(_scenario_action(name, base_url, guests), concurrency, duration=duration)
+            results['scenarios'][name] = stats
+            click.echo("  {throughput_rps} rps, p50 {p50}ms, p99 {p99}ms, {errors} errors".format(
+                throughput_rps=stats['throughput_rps'], errors=stats['errors'], **stats['latency_ms']))
+
+    with open(output, 'w') as file_handler:
+        json.dump(results, file_handler, indent=2)
+    click.echo("Wrote results to {}".format(output))
+
+    if update_baseline:
+        with open(baseline, 'w') as file_handler:
+            json.dump(results, file_handler, indent=2)
+        click.echo("Updated baseline {}".format(baseline))
+        return
+
+    if not os.path.exists(baseline):
+        click.echo("No baseline at {}, skipping regression check".format(baseline))
+        return
+    with open(baseline) as file_handler:
+        regressions = compare_to_baseline(results, json.load(file_handler), threshold)
+    for regression in regressions:
+        click.echo("REGRESSION {}".format(regression), err=True)
+    if regressions:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
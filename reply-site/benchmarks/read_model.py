@@ -0,0 +1,102 @@
+"""
+Guest list read model benchmark
+
+Loads a synthetic guest list and compares fetching it as Guest models (Guest.get_list) against read only records
+(Guest.get_records), for throughput and peak memory, with and without encoding the list for the api.
+
+    python -m benchmarks.read_model --guests 100000
+"""
+import gc
+import time
+import tracemalloc
+
+import click
+
+from benchmarks.harness import configure_environment
+
+
+def _best_time(func, repeat: int):
+    """
+    Returns the best wall clock time of repeat calls to func, in seconds
+
+    Args:
+        func (callable): function to time
+        repeat (int): number of calls
+
+    Returns:
+        float
+    """
+    best = None
+    for _ in range(repeat):
+        gc.collect()
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def _peak_memory(func):
+    """
+    Returns the peak memory python allocated while calling func, in bytes
+
+    Args:
+        func (callable): function to measure
+
+    Returns:
+        int
+    """
+    gc.collect()
+    tracemalloc.start()
+    try:
+        func()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+@click.command()
+@click.option('--guests', default=100000, type=int, help="Number of synthetic guests to load")
+@click.option('--repeat', default=3, type=int, help="Runs per measurement, we report the best")
+def main(guests: int, repeat: int):
+    configure_environment("sqlite://", SLOW_QUERY_THRESHOLD_MS=100000)
+
+    from app import create_app, db
+    from app.encoding import dumps
+    from app.models import Guest
+    from benchmarks.datasets import load_guests
+
+    app = create_app('api')
+    with app.app_context():
+        db.create_all()
+        load_guests(db, guests)
+
+        def fetch(method):
+            def run():
+                try:
+                    return method("all")
+                finally:
+                    # don't let the identity map carry models from one run to the next
+                    db.session.remove()
+            return run
+
+        def fetch_and_encode(method):
+            def run():
+                try:
+                    return dumps(method("all"))
+                finally:
+                    db.session.remove()
+            return run
+
+        click.echo("{} guests".format(guests))
+        click.echo("  {:<22} {:>12} {:>16} {:>12}".format("", "fetch", "fetch + encode", "peak memory"))
+        for name, method in (('Guest models', Guest.get_list), ('records', Guest.get_records)):
+            fetch_time = _best_time(fetch(method), repeat)
+            encode_time = _best_time(fetch_and_encode(method), repeat)
+            peak = _peak_memory(fetch(method))
+            click.echo("  {:<22} {:>10.0f}/s {:>14.0f}/s {:>10.1f}MB".format(
+                name, guests / fetch_time, guests / encode_time, peak / 1024 / 1024))
+
+
+if __name__ == '__main__':
+    main()
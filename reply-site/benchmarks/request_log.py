@@ -0,0 +1,144 @@
+"""
+Request log overhead benchmark
+
+Serves a guest through the flask test client with the request log off, queued (how the app runs, see app.logs) and
+written straight from the request thread, and reports the time per request and what logging adds to it at a given
+request rate. The modes take turns over several rounds and each keeps its best round, so drift on the machine
+doesn't land on one mode. A request costs milliseconds and logging microseconds, so the log line's cost on the
+request thread is also timed on its own. Log lines go to a temporary file instead of stdout, so the numbers include
+real writes. --write_delay_ms makes each write that much slower, like a stdout piped to a log shipper that has
+fallen behind, which is what the queue keeps off the request thread. The encoding still shares the GIL with the
+requests either way.
+
+    python -m benchmarks.request_log --requests 5000 --rounds 5 --rate 1000 --write_delay_ms 0.5
+"""
+import logging
+import os
+import tempfile
+import time
+
+import click
+
+from benchmarks.harness import configure_environment
+
+
+class SlowStream(object):
+    """File that takes a while to write to"""
+
+    def __init__(self, stream, delay: float):
+        """
+        Args:
+            stream: file to write to
+            delay (float): seconds each write takes
+        """
+        self.stream = stream
+        self.delay = delay
+
+    def write(self, data):
+        time.sleep(self.delay)
+        return self.stream.write(data)
+
+    def flush(self):
+        self.stream.flush()
+
+
+def _time_requests(client, url: str, count: int):
+    """
+    Returns the mean time count requests to url took, in seconds
+
+    Args:
+        client (FlaskClient): client to send the requests with
+        url (str): url to GET
+        count (int): number of requests
+
+    Returns:
+        float
+    """
+    start = time.perf_counter()
+    for _ in range(count):
+        client.get(url)
+    return (time.perf_counter() - start) / count
+
+
+def _time_log_lines(app, count: int):
+    """
+    Returns the mean time logging a request's line takes on the request thread, in seconds
+
+    Args:
+        app (Flask): app to log for
+        count (int): number of lines
+
+    Returns:
+        float
+    """
+    from flask import g
+    from app.logs import _log_request
+
+    with app.test_request_context("/api/guest/1"):
+        g.request_log_start = time.perf_counter()
+        start = time.perf_counter()
+        for _ in range(count):
+            _log_request(200)
+        return (time.perf_counter() - start) / count
+
+
+@click.command()
+@click.option('--requests', 'count', default=5000, type=int, help="Requests per mode per round")
+@click.option('--rounds', default=5, type=int, help="Rounds, each mode keeps its best")
+@click.option('--rate', default=1000, type=int, help="Requests per second to work the overhead out at")
+@click.option('--guests', default=10, type=int, help="Number of synthetic guests to load")
+@click.option('--write_delay_ms', default=0.0, type=float, help="How much slower to make each log write")
+def main(count: int, rounds: int, rate: int, guests: int, write_delay_ms: float):
+    configure_environment("sqlite:///{}".format(os.path.join(tempfile.mkdtemp(), "log.db")),
+                          APP_ROLE="api", SLOW_QUERY_THRESHOLD_MS=100000, GUEST_CACHE_TTL=0)
+
+    from app import create_app, db
+    from app.logs import REQUEST_LOGGER, get_queue_handler
+    from benchmarks.datasets import load_guests
+
+    app = create_app('api')
+    with app.app_context():
+        db.create_all()
+        load_guests(db, guests)
+
+    logger = logging.getLogger(REQUEST_LOGGER)
+    queued = get_queue_handler(REQUEST_LOGGER)
+    log_file = tempfile.NamedTemporaryFile("w", suffix=".log", delete=False)
+    stream = SlowStream(log_file, write_delay_ms / 1000) if write_delay_ms else log_file
+    for target in queued.targets:
+        target.setStream(stream)
+    direct = logging.StreamHandler(stream)
+    direct.setFormatter(queued.targets[0].formatter)
+
+    client = app.test_client()
+    url = "/api/guest/1"
+    # warm up the app, the connection pool and the listener thread
+    _time_requests(client, url, 200)
+
+    modes = (('off', [], True), ('queued', [queued], False), ('direct', [direct], False))
+    requests = {name: [] for name, _, _ in modes}
+    lines = {name: [] for name, _, _ in modes}
+    for _ in range(rounds):
+        for name, handlers, disabled in modes:
+            logger.handlers = handlers
+            logger.disabled = disabled
+            requests[name].append(_time_requests(client, url, count))
+            lines[name].append(_time_log_lines(app, count))
+            # lines left in the queue would be written during the next mode
+            queued.flush()
+    logger.handlers = [queued]
+    logger.disabled = False
+
+    baseline = min(requests['off'])
+    for name, _, _ in modes:
+        request_time, line_time = min(requests[name]), min(lines[name])
+        click.echo("{:<7} {:.1f}us a request, {:+.1f}us on the request thread, {:.1f}us a log line".format(
+            name, request_time * 1e6, (request_time - baseline) * 1e6, line_time * 1e6))
+        # at rate requests a second, the share of each second request threads spend logging instead of serving
+        click.echo("        log lines hold request threads {:.2%} of the time at {} req/s".format(line_time * rate,
+                                                                                       rate))
+    click.echo("{} lines dropped, written to {}".format(queued.dropped, log_file.name))
+
+
+if __name__ == '__main__':
+    main()
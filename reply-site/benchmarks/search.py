@@ -0,0 +1,52 @@
+"""
+Guest search benchmark
+
+Loads a synthetic guest list and times app.search.search_guests for a few typical queries, straight against the
+database so the numbers are the lookup cost without http overhead.
+
+    python -m benchmarks.search --guests 100000
+"""
+import os
+import statistics
+import tempfile
+import time
+
+import click
+
+from benchmarks.harness import configure_environment
+
+QUERIES = ["doe", "garcia", "maria smith", "vegetarian", "elm st", "example.com", "zzz"]
+
+
+@click.command()
+@click.option('--guests', default=100000, type=int, help="Number of synthetic guests to load")
+@click.option('--repeat', default=20, type=int, help="Searches per query, we report the median and max")
+@click.option('--database_uri', default=None, help="Database to load into, defaults to a temporary sqlite file")
+def main(guests: int, repeat: int, database_uri: str):
+    configure_environment(database_uri or "sqlite:///{}".format(os.path.join(tempfile.mkdtemp(), "search.db")),
+                          SLOW_QUERY_THRESHOLD_MS=100000)
+
+    from app import create_app, db
+    from app.search import optimize_search_index, search_guests
+    from benchmarks.datasets import load_guests
+
+    app = create_app('api')
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        click.echo("Loading {} guests".format(guests))
+        load_guests(db, guests)
+        optimize_search_index()
+
+        for query in QUERIES:
+            timings = []
+            for _ in range(repeat):
+                start = time.perf_counter()
+                results, total = search_guests(query, 1, 20)
+                timings.append(time.perf_counter() - start)
+            click.echo("  {:<14} {:>7} matches  median {:>7.2f}ms  max {:>7.2f}ms".format(
+                query, total, statistics.median(timings) * 1000, max(timings) * 1000))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,158 @@
+"""
+SMS webhook benchmark, WSGI against ASGI
+
+Loads a synthetic guest list and drives /api/sms with concurrent clients, first against run:app under gunicorn's
+sync workers and then against asgi:app under uvicorn, so the two entry points can be compared under a reply storm.
+Both servers run in their own processes with the same number of processes and the same database.
+
+    python -m benchmarks.sms_webhook --guests 10000 --concurrency 200 --duration 10
+"""
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.error
+import urllib.request
+
+import click
+
+from benchmarks.harness import configure_environment, request, run_concurrent
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def _free_port():
+    """
+    Returns a local port nothing is listening on
+
+    Returns:
+        int
+    """
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def _wait_until_up(base_url: str, process, timeout: float = 30):
+    """
+    Waits for a server to answer http requests
+
+    Args:
+        base_url (str): url of the server
+        process (subprocess.Popen): the server process, so we notice if it dies on boot
+        timeout (float): seconds to wait
+
+    Raises:
+        click.ClickException: if the server dies or doesn't come up in time
+    """
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise click.ClickException("Server exited with {}".format(process.returncode))
+        try:
+            urllib.request.urlopen(base_url + "/api/sms", timeout=1)
+            return
+        except urllib.error.HTTPError:
+            # a 405 for the GET is fine, the server is up
+            return
+        except OSError:
+            time.sleep(0.2)
+    raise click.ClickException("Server at {} didn't come up".format(base_url))
+
+
+def _server_commands(port: int, workers: int, threads: int):
+    """
+    Returns the command line for each server under test
+
+    Args:
+        port (int): port to listen on
+        workers (int): server processes
+        threads (int): threads per gunicorn worker
+
+    Returns:
+        dict - name: argv
+    """
+    bind = "127.0.0.1:{}".format(port)
+    return {
+        'wsgi (gunicorn run:app)': ["gunicorn", "--bind", bind, "--workers", str(workers), "--threads", str(threads),
+                                    "--log-level", "warning", "run:app"],
+        'asgi (uvicorn asgi:app)': [sys.executable, "-m", "uvicorn", "--host", "127.0.0.1", "--port", str(port),
+                                    "--workers", str(workers), "--log-level", "warning", "--no-access-log",
+                                    "asgi:app"],
+    }
+
+
+def _sms_action(base_url: str, guest_count: int, auth_token: str):
+    """
+    Builds the client call for the webhook, texts from random guests signed the way Twilio signs them
+
+    Args:
+        base_url (str): url of the server under test
+        guest_count (int): number of guests in the dataset
+        auth_token (str): Twilio auth token the servers validate signatures with
+
+    Returns:
+        callable
+    """
+    from twilio.request_validator import RequestValidator
+
+    rng = random.Random("sms")
+    validator = RequestValidator(auth_token)
+    url = base_url + "/api/sms"
+
+    def action(worker, call):
+        # phone numbers in the synthetic dataset are 2000000000 + (id - 1)
+        data = {'From': "+1{:010d}".format(2000000000 + rng.randint(0, guest_count - 1)), 'Body': "yes",
+                'MessageSid': "SMBENCH{:06d}{:09d}".format(worker, call)}
+        return request("POST", url, data=data, form=True,
+                       headers={'X-Twilio-Signature': validator.compute_signature(url, data)})
+    return action
+
+
+@click.command()
+@click.option('--guests', default=10000, type=int, help="Number of synthetic guests to load")
+@click.option('--concurrency', default=200, type=int, help="Concurrent webhook clients")
+@click.option('--duration', default=10.0, type=float, help="Seconds to drive each server for")
+@click.option('--workers', default=1, type=int, help="Server processes for both servers")
+@click.option('--threads', default=4, type=int, help="Threads per gunicorn worker, see gunicorn.conf.py")
+@click.option('--database_uri', default=None, help="Database to load into, defaults to a temporary sqlite file")
+def main(guests: int, concurrency: int, duration: float, workers: int, threads: int, database_uri: str):
+    if database_uri is None:
+        database_uri = "sqlite:///{}".format(os.path.join(tempfile.mkdtemp(), "sms.db"))
+    # the servers inherit our environment, so they use the same database. gunicorn.conf.py needs somewhere to keep
+    # prometheus' worker files
+    configure_environment(database_uri, SLOW_QUERY_THRESHOLD_MS=100000, APP_ROLE="api",
+                          PROMETHEUS_MULTIPROC_DIR=tempfile.mkdtemp())
+
+    from app import create_app, db
+    from benchmarks.datasets import load_guests
+
+    app = create_app('api')
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        click.echo("Loading {} guests into {}".format(guests, database_uri))
+        load_guests(db, guests)
+        db.engine.dispose()
+
+    port = _free_port()
+    base_url = "http://127.0.0.1:{}".format(port)
+    for name, command in _server_commands(port, workers, threads).items():
+        process = subprocess.Popen(command, cwd=ROOT)
+        try:
+            _wait_until_up(base_url, process)
+            click.echo("Running {} for {}s with {} clients".format(name, duration, concurrency))
+            stats = run_concurrent(_sms_action(base_url, guests, app.config['TWILIO_AUTH_TOKEN']), concurrency,
+                                   duration=duration)
+            click.echo("  {throughput_rps} rps, p50 {p50}ms, p99 {p99}ms, {errors} errors".format(
+                throughput_rps=stats['throughput_rps'], errors=stats['errors'], **stats['latency_ms']))
+        finally:
+            process.terminate()
+            process.wait()
+
+
+if __name__ == '__main__':
+    main()
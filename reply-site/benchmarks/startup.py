@@ -0,0 +1,84 @@
+"""
+Worker boot benchmark
+
+Boots the app in a fresh interpreter for each role, the same way a new gunicorn worker would, and records how long
+imports plus create_app take and the resulting RSS of the process.
+
+    python -m benchmarks.startup --runs 5
+"""
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+import click
+
+from benchmarks.harness import configure_environment
+
+# runs in the child interpreter, prints one json line of measurements
+BOOT_SCRIPT = """
+import json, resource, sys, time
+start = time.perf_counter()
+from app import create_app
+app = create_app({role!r})
+boot_time = time.perf_counter() - start
+with open('/proc/self/statm') as statm:
+    rss_pages = int(statm.read().split()[1])
+print(json.dumps({{
+    'boot_ms': boot_time * 1000,
+    'rss_kb': rss_pages * resource.getpagesize() // 1024,
+    'max_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    'modules': len(sys.modules),
+    'twilio_loaded': 'twilio' in sys.modules,
+    'flask_admin_loaded': 'flask_admin' in sys.modules,
+}}))
+"""
+
+
+def _boot(role: str, env: dict):
+    """
+    Boots the app once in a child interpreter
+
+    Args:
+        role (str): role to boot
+        env (dict): environment for the child
+
+    Returns:
+        dict
+    """
+    output = subprocess.check_output([sys.executable, "-c", BOOT_SCRIPT.format(role=role)], env=env,
+                                     cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    return json.loads(output.decode().strip().splitlines()[-1])
+
+
+@click.command()
+@click.option('--runs', default=5, type=int, help="Boots per role, we report the median")
+@click.option('--output', default=None, help="Write the results to this json file")
+def main(runs: int, output: str):
+    configure_environment(os.environ.get('DATABASE_URI', "sqlite://"))
+    env = dict(os.environ)
+
+    from app import APP_ROLES
+
+    results = {}
+    for role in APP_ROLES:
+        boots = [_boot(role, env) for _ in range(runs)]
+        results[role] = {
+            'boot_ms': round(statistics.median(boot['boot_ms'] for boot in boots), 2),
+            'rss_kb': int(statistics.median(boot['rss_kb'] for boot in boots)),
+            'max_rss_kb': int(statistics.median(boot['max_rss_kb'] for boot in boots)),
+            'modules': boots[-1]['modules'],
+            'twilio_loaded': boots[-1]['twilio_loaded'],
+            'flask_admin_loaded': boots[-1]['flask_admin_loaded'],
+        }
+        click.echo("{role:>6}: boot {boot_ms}ms, rss {rss_kb}KB, {modules} modules, twilio loaded {twilio_loaded}, "
+                   "flask-admin loaded {flask_admin_loaded}".format(role=role, **results[role]))
+
+    if output:
+        with open(output, 'w') as file_handler:
+            json.dump(results, file_handler, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,2 +1,6 @@
 #!/bin/bash
-gunicorn --bind 0.0.0.0:8000 run:app
\ No newline at end of file
+# prometheus_client shares metrics between gunicorn workers through this directory. Clear it on boot so we don't
+# aggregate in files left behind by a previous container run
+export PROMETHEUS_MULTIPROC_DIR=${PROMETHEUS_MULTIPROC_DIR:-/tmp/reply-site-metrics}
+rm -rf "$PROMETHEUS_MULTIPROC_DIR" && mkdir -p "$PROMETHEUS_MULTIPROC_DIR"
+gunicorn --config gunicorn.conf.py run:app
@@ -0,0 +1,16 @@
+import os
+
+from prometheus_client import multiprocess
+
+bind = "0.0.0.0:8000"
+workers = int(os.environ.get("GUNICORN_WORKERS", 2))
+# change feed streams hold a thread each for as long as they are open, so workers get a few. Each worker holds at
+# most CHANGE_FEED_MAX_STREAMS streams, the rest of its threads are left for the api and the sms webhook
+threads = int(os.environ.get("GUNICORN_THREADS", 8))
+
+
+def child_exit(server, worker):
+    """
+    Cleans up a dead worker's live gauge files so /metrics stops counting its in flight requests
+    """
+    multiprocess.mark_process_dead(worker.pid)
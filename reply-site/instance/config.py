@@ -10,10 +10,105 @@ class Config(object):
     PRODUCTION = config("TESTING_MODE", cast=bool, default=False)
     CSRF_ENABLED = True
     SECRET = config('FLASK_SECRET', cast=str)
+    # flask signs the session with this, flask-admin needs the session for its flash messages
+    SECRET_KEY = SECRET
     SQLALCHEMY_TRACK_MODIFICATIONS = config('SQLALCHEMY_TRACK_MODIFICATIONS', cast=bool, default=False)
     SQLALCHEMY_DATABASE_URI = config('DATABASE_URI')
+    # optional read replica, GET endpoints read from it when set
+    SQLALCHEMY_READ_REPLICA_URI = config('READ_REPLICA_URI', default=None)
+    # how long a client reads from the primary after it writes, so it always sees its own writes
+    READ_REPLICA_STICKY_SECONDS = config('READ_REPLICA_STICKY_SECONDS', cast=int, default=5)
+    # api, admin or all. api workers skip flask-admin entirely
+    APP_ROLE = config('APP_ROLE', cast=str, default='all')
     # Twilio config
     TWILIO_AUTH_TOKEN = config('TWILIO_AUTH_TOKEN', cast=str)
+    TWILIO_ACCOUNT_SID = config('TWILIO_ACCOUNT_SID', cast=str, default=None)
+    TWILIO_FROM_NUMBER = config('TWILIO_FROM_NUMBER', cast=str, default=None)
+
+    # Campaigns, sent by manage.py campaign_worker
+    # twilio, or fake to only pretend to send
+    SMS_SENDER = config('SMS_SENDER', cast=str, default='twilio')
+    # guests loaded and sent per batch
+    CAMPAIGN_BATCH_SIZE = config('CAMPAIGN_BATCH_SIZE', cast=int, default=100)
+    # messages sent in parallel
+    CAMPAIGN_POOL_SIZE = config('CAMPAIGN_POOL_SIZE', cast=int, default=4)
+    # most messages sent per second, twilio queues anything over a number's limit. 0 for no limit
+    CAMPAIGN_SEND_RATE = config('CAMPAIGN_SEND_RATE', cast=float, default=1.0)
+    # how often an idle worker checks for new campaigns
+    CAMPAIGN_POLL_SECONDS = config('CAMPAIGN_POLL_SECONDS', cast=float, default=5.0)
+    # a running campaign that hasn't finished a batch in this long is taken over by another worker, keep it well over
+    # CAMPAIGN_BATCH_SIZE / CAMPAIGN_SEND_RATE. 0 to never take one over
+    CAMPAIGN_STALE_SECONDS = config('CAMPAIGN_STALE_SECONDS', cast=float, default=600.0)
+
+    # Guest list response cache
+    # memory keeps a cache per worker, redis (needs the redis package) shares one between workers, none turns
+    # caching off
+    GUEST_CACHE_BACKEND = config('GUEST_CACHE_BACKEND', cast=str, default='memory')
+    GUEST_CACHE_TTL = config('GUEST_CACHE_TTL', cast=int, default=30)
+    GUEST_CACHE_SIZE = config('GUEST_CACHE_SIZE', cast=int, default=128)
+    GUEST_CACHE_REDIS_URL = config('GUEST_CACHE_REDIS_URL', cast=str, default='redis://localhost:6379/0')
+
+    # Replies to recent texts kept in memory by MessageSid, so Twilio's webhook retries are answered without touching
+    # the database. 0 turns it off
+    SMS_REPLY_CACHE_SIZE = config('SMS_REPLY_CACHE_SIZE', cast=int, default=1024)
+    SMS_REPLY_CACHE_TTL = config('SMS_REPLY_CACHE_TTL', cast=int, default=3600)
+    # Twilio's delivery status callbacks are buffered and written this many at a time, see app.message_status
+    MESSAGE_STATUS_BATCH_SIZE = config('MESSAGE_STATUS_BATCH_SIZE', cast=int, default=500)
+    # longest a status waits in the buffer before it's written
+    MESSAGE_STATUS_FLUSH_SECONDS = config('MESSAGE_STATUS_FLUSH_SECONDS', cast=float, default=2.0)
+    # Write-behind for the sms webhook, see app.sms_queue. Set to a sqlite file on local disk to answer texts
+    # straight away and leave the writes to manage.py sms_queue_worker, leave empty to write before answering
+    SMS_QUEUE_PATH = config('SMS_QUEUE_PATH', cast=str, default='')
+    # most texts waiting to be applied, past it the webhook answers 503 so Twilio backs off
+    SMS_QUEUE_MAX_SIZE = config('SMS_QUEUE_MAX_SIZE', cast=int, default=10000)
+    # texts applied per transaction
+    SMS_QUEUE_BATCH_SIZE = config('SMS_QUEUE_BATCH_SIZE', cast=int, default=200)
+    # how often an idle worker checks the queue
+    SMS_QUEUE_POLL_SECONDS = config('SMS_QUEUE_POLL_SECONDS', cast=float, default=0.5)
+
+    # Async sms webhook, see app.asgi. Connections its pool keeps open and how many more it may open under load
+    ASGI_DB_POOL_SIZE = config('ASGI_DB_POOL_SIZE', cast=int, default=10)
+    ASGI_DB_MAX_OVERFLOW = config('ASGI_DB_MAX_OVERFLOW', cast=int, default=20)
+
+    # Admin
+    # the admin guest list shows an estimated count instead of running COUNT(*) once the table is this big
+    ADMIN_ESTIMATED_COUNT_THRESHOLD = config('ADMIN_ESTIMATED_COUNT_THRESHOLD', cast=int, default=10000)
+
+    # JSON responses
+    # lists longer than this are streamed to the client in chunks
+    JSON_STREAM_THRESHOLD = config('JSON_STREAM_THRESHOLD', cast=int, default=1000)
+    JSON_STREAM_CHUNK_SIZE = config('JSON_STREAM_CHUNK_SIZE', cast=int, default=500)
+
+    # Guest change feed
+    # how often open change feed streams check for new changes
+    CHANGE_FEED_POLL_SECONDS = config('CHANGE_FEED_POLL_SECONDS', cast=float, default=1.0)
+    # streams are closed after this long so they don't hold a worker thread forever, clients reconnect and resume
+    CHANGE_FEED_MAX_SECONDS = config('CHANGE_FEED_MAX_SECONDS', cast=float, default=300)
+    CHANGE_FEED_BATCH_SIZE = config('CHANGE_FEED_BATCH_SIZE', cast=int, default=500)
+    # most streams a worker holds open, keep it well under gunicorn's threads so the rest of the api always has
+    # some. Past it clients get a 503. 0 for no limit
+    CHANGE_FEED_MAX_STREAMS = config('CHANGE_FEED_MAX_STREAMS', cast=int, default=2)
+    # manage.py prune_changes deletes changes older than this
+    CHANGE_FEED_RETENTION_DAYS = config('CHANGE_FEED_RETENTION_DAYS', cast=int, default=7)
+
+    # Query instrumentation config
+    # statements slower than this are logged along with their parameters and query plan
+    SLOW_QUERY_THRESHOLD_MS = config('SLOW_QUERY_THRESHOLD_MS', cast=int, default=100)
+    # max number of sql statements a request may run. Going over is logged, or raised in testing mode
+    QUERY_BUDGET = config('QUERY_BUDGET', cast=int, default=10)
+    # per endpoint budgets, these override QUERY_BUDGET. endpoint:METHOD keys override the endpoint's budget
+    QUERY_BUDGETS = {
+        'guest-list': 1,
+        # the change feed insert and the update
+        'guest-list:PATCH': 2,
+        'guest-search': 2,
+        'guest-changes': 1,
+        'guest-api': 4,
+        'sms': 4,
+        # the batch upsert, when a callback fills the buffer
+        'sms-status': 1,
+        'campaigns': 2,
+    }
 
     _log_level = config('LOG_LEVEL', default='error', cast=str).lower()
 
@@ -23,12 +118,18 @@ class Config(object):
     if _log_level == 'critical':
         LOG_LEVEL = logging.CRITICAL
     if _log_level == 'warning':
-        LOG_LEVEL = logging.warning
+        LOG_LEVEL = logging.WARNING
     if _log_level == 'info':
         LOG_LEVEL = logging.INFO
     if _log_level == 'debug':
         LOG_LEVEL = logging.DEBUG
 
+    # one JSON line per request on the app.requests logger, see app.logs
+    REQUEST_LOG = config('REQUEST_LOG', cast=bool, default=True)
+    # most log records waiting to be written before new ones are dropped
+    LOG_QUEUE_SIZE = config('LOG_QUEUE_SIZE', cast=int, default=10000)
+
+    # applied by app.logs.init_logging, each logger's handlers run on a queue listener thread
     LOGGING_CONFIG = {
         'version': 1,
         'disable_existing_loggers': False,
@@ -37,20 +138,35 @@ class Config(object):
                 'format': '%(asctime)s - %(levelname)s %(module)s '
                           'P%(process)d T%(thread)d %(message)s'
             },
+            'json': {
+                '()': 'app.logs.JsonFormatter',
+            },
         },
         'handlers': {
             'stdout': {
                 'class': 'logging.StreamHandler',
                 'stream': sys.stdout,
                 'formatter': 'verbose',
-            }
+            },
+            'requests': {
+                'class': 'logging.StreamHandler',
+                'stream': sys.stdout,
+                'formatter': 'json',
+            },
         },
         'loggers': {
-            'reply_site': {
+            # flask's app.logger
+            'app': {
                 'handlers': ['stdout'],
                 'level': LOG_LEVEL,
                 'propagate': True,
             },
+            # request lines are wanted whatever LOG_LEVEL is, REQUEST_LOG turns them off
+            'app.requests': {
+                'handlers': ['requests'],
+                'level': logging.INFO,
+                'propagate': False,
+            },
         }
     }
 
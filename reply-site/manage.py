@@ -1,3 +1,5 @@
+from datetime import datetime, timedelta
+
 from decouple import config
 from flask_script import Manager  # class for handling a set of commands
 from flask_migrate import Migrate, MigrateCommand
@@ -10,5 +12,27 @@ manager = Manager(app)
 
 manager.add_command('db', MigrateCommand)
 
+
+@manager.command
+def prune_changes():
+    """Deletes guest changes older than CHANGE_FEED_RETENTION_DAYS from the change feed"""
+    before = datetime.utcnow() - timedelta(days=app.config['CHANGE_FEED_RETENTION_DAYS'])
+    print("Deleted {} guest changes".format(models.GuestChange.prune(before)))
+
+
+@manager.command
+def campaign_worker(once=False):
+    """Sends pending campaigns. Keeps polling for new ones unless --once is given"""
+    from app.campaigns import run_worker
+    run_worker(once=once)
+
+
+@manager.command
+def sms_queue_worker(once=False):
+    """Applies texts the webhook queued, see SMS_QUEUE_PATH. Keeps polling for more unless --once is given"""
+    from app.sms_queue import run_queue_worker
+    run_queue_worker(once=once)
+
+
 if __name__ == '__main__':
     manager.run()
@@ -0,0 +1,74 @@
+"""full text search index over guests
+
+Revision ID: 9e3d4a6b2f81
+Revises: 5c1f0e7b9a2d
+Create Date: 2026-10-19 14:21:37.902114
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '9e3d4a6b2f81'
+down_revision = '5c1f0e7b9a2d'
+branch_labels = None
+depends_on = None
+
+# copied from app.search so this migration keeps working if that module changes
+POSTGRES_UPGRADE = (
+    "ALTER TABLE guests ADD COLUMN search_vector tsvector GENERATED ALWAYS AS ("
+    "setweight(to_tsvector('simple', coalesce(name, '')), 'A') || "
+    "setweight(to_tsvector('simple', coalesce(email_address, '')), 'B') || "
+    "setweight(to_tsvector('simple', coalesce(physical_address, '')), 'C') || "
+    "setweight(to_tsvector('simple', coalesce(rsvp_notes, '')), 'D')) STORED",
+    "CREATE INDEX ix_guests_search_vector ON guests USING GIN (search_vector)",
+)
+POSTGRES_DOWNGRADE = (
+    "DROP INDEX ix_guests_search_vector",
+    "ALTER TABLE guests DROP COLUMN search_vector",
+)
+
+SQLITE_UPGRADE = (
+    "CREATE VIRTUAL TABLE guests_fts USING fts5("
+    "name, email_address, physical_address, rsvp_notes, content='guests', content_rowid='id', "
+    # prefix indexes keep search-as-you-type prefix queries fast
+    "prefix='2 3')",
+    "CREATE TRIGGER guests_fts_insert AFTER INSERT ON guests BEGIN "
+    "INSERT INTO guests_fts(rowid, name, email_address, physical_address, rsvp_notes) "
+    "VALUES (new.id, new.name, new.email_address, new.physical_address, new.rsvp_notes); END",
+    "CREATE TRIGGER guests_fts_delete AFTER DELETE ON guests BEGIN "
+    "INSERT INTO guests_fts(guests_fts, rowid, name, email_address, physical_address, rsvp_notes) "
+    "VALUES ('delete', old.id, old.name, old.email_address, old.physical_address, old.rsvp_notes); END",
+    "CREATE TRIGGER guests_fts_update AFTER UPDATE ON guests BEGIN "
+    "INSERT INTO guests_fts(guests_fts, rowid, name, email_address, physical_address, rsvp_notes) "
+    "VALUES ('delete', old.id, old.name, old.email_address, old.physical_address, old.rsvp_notes); "
+    "INSERT INTO guests_fts(rowid, name, email_address, physical_address, rsvp_notes) "
+    "VALUES (new.id, new.name, new.email_address, new.physical_address, new.rsvp_notes); END",
+    # rank by bm25 with names weighted highest, in the same order as the columns
+    "INSERT INTO guests_fts(guests_fts, rank) VALUES ('rank', 'bm25(10.0, 5.0, 2.0, 1.0)')",
+    # index the guests we already have
+    "INSERT INTO guests_fts(guests_fts) VALUES ('rebuild')",
+    # and merge it down to a single segment, which roughly halves lookup times on a big list
+    "INSERT INTO guests_fts(guests_fts) VALUES ('optimize')",
+)
+SQLITE_DOWNGRADE = (
+    "DROP TRIGGER guests_fts_update",
+    "DROP TRIGGER guests_fts_delete",
+    "DROP TRIGGER guests_fts_insert",
+    "DROP TABLE guests_fts",
+)
+
+
+def upgrade():
+    dialect = op.get_bind().dialect.name
+    statements = {'postgresql': POSTGRES_UPGRADE, 'sqlite': SQLITE_UPGRADE}.get(dialect, ())
+    for statement in statements:
+        op.execute(statement)
+
+
+def downgrade():
+    dialect = op.get_bind().dialect.name
+    statements = {'postgresql': POSTGRES_DOWNGRADE, 'sqlite': SQLITE_DOWNGRADE}.get(dialect, ())
+    for statement in statements:
+        op.execute(statement)
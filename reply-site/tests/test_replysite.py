@@ -1,10 +1,35 @@
+import asyncio
+import csv
+import io
+import logging
+import queue
+import importlib.util
 import os
+import shutil
+import tempfile
+import threading
 import unittest
 import json
+from datetime import datetime, timedelta
 from unittest.mock import MagicMock, patch
+from urllib.parse import urlencode
+from twilio.request_validator import RequestValidator
+from sqlalchemy import event
 from app import create_app, db
+from app.asgi import async_database_uri, create_asgi_app
 from app.resources import TwilioResponseAPI
-from app.models import Guest
+from app.message_status import StatusBuffer
+from app.models import Campaign, Guest, InboundMessage, MessageStatus
+from app import changes, dedupe, encoding, logs
+from app.cache import InProcessCache, RedisCache
+from app.campaigns import FakeSender, claim_next_campaign, run_worker
+from app.query_tracking import QueryBudgetExceeded, _explain
+from app.routing import REPLICA_BIND
+from app.sms import UNKNOWN_NUMBER_REPLY, render_reply
+from app.sms_queue import SmsQueue, drain, run_queue_worker
+from instance.config import Config
+from benchmarks.datasets import generate_guests, load_guests
+from benchmarks.harness import compare_to_baseline, summarize
 
 
 class ReplySiteTestCase(unittest.TestCase):
@@ -415,9 +440,8 @@ class TwilioTestCase(ReplySiteTestCase):
         self.assertEqual(res.status_code, 201)
 
         message_mock = MagicMock()
-        response = self.client().post('/api/sms', data={'From': "5555555555", 'Body': "Stop"})str
         with patch.object(TwilioResponseAPI, '_get_twilio_messager', return_value=message_mock) as local_mock:
-
+            response = self.client().post('/api/sms', data={'From': "5555555555", 'Body': "Stop"})
             self.assertEqual(response.status_code, 200)
             local_mock.assert_called()
             message_mock.message.assert_called_with("We're so sorry! We won't text you again about our wedding plans.")
@@ -458,6 +482,1269 @@ class TwilioTestCase(ReplySiteTestCase):
             message_mock.message.assert_called_once()
 
 
+class MetricsTestCase(ReplySiteTestCase):
+    """This class tests our prometheus metrics endpoint"""
+
+    def test_metrics_endpoint(self):
+        """Tests that requests show up in /metrics with their latency and db usage"""
+        res = self.client().post('/api/guest', data=self.guest)
+        self.assertEqual(res.status_code, 201)
+        res = self.client().get('/api/guests')
+        self.assertEqual(res.status_code, 200)
+
+        res = self.client().get('/metrics')
+        self.assertEqual(res.status_code, 200)
+        self.assertIn('text/plain', res.headers['Content-Type'])
+        metrics = res.data.decode()
+        self.assertIn('reply_site_request_latency_seconds_count{endpoint="guest-list",method="GET"}', metrics)
+        self.assertIn('reply_site_requests_total{endpoint="guest-api",method="POST",status="201"}', metrics)
+        self.assertIn('reply_site_db_queries_per_request_count{endpoint="guest-list"}', metrics)
+        self.assertIn('reply_site_requests_in_flight', metrics)
+
+    def test_unmatched_urls_share_a_label(self):
+        """Tests that 404s for unknown urls are grouped under one endpoint label"""
+        res = self.client().get('/not/a/real/url')
+        self.assertEqual(res.status_code, 404)
+        metrics = self.client().get('/metrics').data.decode()
+        self.assertIn('reply_site_requests_total{endpoint="unmatched",method="GET",status="404"}', metrics)
+
+
+class RequestLogTestCase(ReplySiteTestCase):
+    """This class tests our logging setup and the per request log line"""
+
+    def test_request_line(self):
+        """Tests that a request logs one line with its endpoint, status, latency and db usage"""
+        with self.assertLogs(logs.REQUEST_LOGGER, 'INFO') as captured:
+            res = self.client().get('/api/guests')
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(len(captured.records), 1)
+        line = json.loads(logs.JsonFormatter().format(captured.records[0]))
+        self.assertEqual(line['message'], "GET /api/guests 200")
+        self.assertEqual((line['endpoint'], line['method'], line['status'], line['db_queries']),
+                         ('guest-list', 'GET', 200, 1))
+        self.assertGreater(line['latency_ms'], 0)
+        self.assertIn('db_ms', line)
+
+    def test_unmatched_url(self):
+        """Tests that 404s for unknown urls are logged too"""
+        with self.assertLogs(logs.REQUEST_LOGGER, 'INFO') as captured:
+            self.client().get('/not/a/real/url')
+        self.assertEqual(captured.records[0].fields['endpoint'], "unmatched")
+        self.assertEqual(captured.records[0].fields['status'], 404)
+
+    def test_handlers_queued(self):
+        """Tests that the configured loggers write through a queue"""
+        for name in ('app', logs.REQUEST_LOGGER):
+            self.assertIsInstance(logging.getLogger(name).handlers[0], logs.BoundedQueueHandler)
+        self.assertIs(self.app.logger.handlers[0], logs.get_queue_handler('app'))
+
+    def test_queue_handler(self):
+        """Tests that queued records reach the real handlers and records past the queue size are dropped"""
+        records = []
+        target = logging.Handler()
+        target.emit = records.append
+        handler = logs.BoundedQueueHandler([target], 2)
+        logger = logging.getLogger('app.tests.queue')
+        logger.propagate = False
+        logger.addHandler(handler)
+        try:
+            # fill the queue before the listener can drain it
+            handler.queue.put_nowait(None)
+            handler.queue.put_nowait(None)
+            with patch.object(handler, '_start'):
+                logger.error("dropped")
+            self.assertEqual(handler.dropped, 1)
+            handler.queue = queue.Queue(2)
+            logger.error("Invalid response number %s", "5555555555")
+            handler.flush()
+            self.assertEqual([record.getMessage() for record in records], ["Invalid response number 5555555555"])
+        finally:
+            logger.removeHandler(handler)
+            handler.close()
+
+    def test_log_level(self):
+        """Tests that LOG_LEVEL names map to logging's levels"""
+        import instance.config
+        # a copy of the config module, Config reads the environment when it's defined
+        spec = importlib.util.spec_from_file_location('log_level_config', instance.config.__file__)
+        config = importlib.util.module_from_spec(spec)
+        with patch.dict(os.environ, {'LOG_LEVEL': "warning"}):
+            spec.loader.exec_module(config)
+        self.assertEqual(config.Config.LOG_LEVEL, logging.WARNING)
+
+
+class QueryBudgetTestCase(ReplySiteTestCase):
+    """This class tests our slow query logging and per request query budgets"""
+
+    def _add_guests(self, count):
+        for i in range(count):
+            res = self.client().post('/api/guest', data={'name': 'Guest {}'.format(i),
+                                                         'total_attendees': 1,
+                                                         'phone_number': '55555500{:02d}'.format(i)})
+            self.assertEqual(res.status_code, 201)
+
+    def test_guest_list_is_one_query(self):
+        """Tests that listing guests does not issue a query per guest"""
+        self._add_guests(10)
+        for url in ['/api/guests', '/api/guests?guest_filter=all_contacts',
+                    '/api/guests?guest_filter=rsvp&guest_filter_value=None']:
+            res = self.client().get(url)
+            self.assertEqual(res.status_code, 200)
+            self.assertEqual(len(json.loads(res.data)), 10)
+
+    def test_guest_api_and_sms_within_budget(self):
+        """Tests that the guest and sms endpoints stay within their budgets"""
+        self._add_guests(1)
+        res = self.client().put('/api/guest/1', data={"rsvp": True})
+        self.assertEqual(res.status_code, 200)
+        res = self.client().get('/api/guest/1')
+        self.assertEqual(res.status_code, 200)
+        res = self.client().post('/api/sms', data={'From': "5555550000", 'Body': "RSVP Yes 1 see you there"})
+        self.assertEqual(res.status_code, 200)
+
+    def test_budget_exceeded_fails_in_testing(self):
+        """Tests that going over an endpoint's query budget raises in testing mode"""
+        self._add_guests(2)
+        self.app.config['QUERY_BUDGETS'] = {'guest-list': 0}
+        with self.assertRaises(QueryBudgetExceeded):
+            self.client().get('/api/guests')
+
+    def test_slow_query_logged_with_plan(self):
+        """Tests that slow queries are logged with their parameters and query plan"""
+        self._add_guests(1)
+        self.app.config['SLOW_QUERY_THRESHOLD_MS'] = 0
+        with self.assertLogs(self.app.logger, level='WARNING') as logs:
+            res = self.client().get('/api/guest/1')
+            self.assertEqual(res.status_code, 200)
+        output = "\n".join(logs.output)
+        self.assertIn("Slow query", output)
+        self.assertIn("Parameters: (1,", output)
+        self.assertIn("Plan:", output)
+        self.assertIn("SEARCH guests", output)
+
+
+    def test_failed_plan_rolled_back_to_savepoint(self):
+        """Tests that an EXPLAIN that fails on postgres is rolled back so the request's transaction carries on"""
+        executed = []
+
+        def execute(sql, parameters=None):
+            executed.append(sql)
+            if sql.startswith("EXPLAIN"):
+                raise RuntimeError("syntax error")
+
+        explain_cursor = MagicMock(execute=execute)
+        cursor = MagicMock()
+        cursor.connection.cursor.return_value = explain_cursor
+        conn = MagicMock()
+        conn.dialect.name = 'postgresql'
+        plan = _explain(conn, cursor, "SELECT 1", ())
+        self.assertEqual(plan, "unavailable (syntax error)")
+        self.assertEqual(executed, ["SAVEPOINT query_plan", "EXPLAIN SELECT 1", "ROLLBACK TO SAVEPOINT query_plan"])
+        explain_cursor.close.assert_called_once()
+
+
+class BenchmarkTestCase(ReplySiteTestCase):
+    """This class tests the pieces of our benchmark suite that decide pass or fail"""
+
+    def test_generated_guests_are_realistic(self):
+        """Tests that synthetic guests have a mix of null and set statuses and load into the db"""
+        guests = list(generate_guests(2000))
+        self.assertEqual(len({guest['phone_number'] for guest in guests}), 2000)
+        for field in ('date_saved', 'rsvp'):
+            values = {guest[field] for guest in guests}
+            self.assertEqual(values, {None, True, False})
+        # nobody rsvps without answering the save the date first
+        self.assertFalse([guest for guest in guests if guest['date_saved'] is None and guest['rsvp'] is not None])
+        self.assertEqual(guests, list(generate_guests(2000)))
+
+        with self.app.app_context():
+            load_guests(db, 250, batch_size=100)
+            self.assertEqual(Guest.query.count(), 250)
+
+    def test_baseline_regressions(self):
+        """Tests that results are only flagged when they regress past the threshold"""
+        baseline = {'scenarios': {'get': summarize([0.010] * 100, 0, 1.0)}}
+        slightly_slower = {'scenarios': {'get': summarize([0.011] * 95, 0, 1.0)}}
+        self.assertEqual(compare_to_baseline(slightly_slower, baseline, 0.2), [])
+
+        much_slower = {'scenarios': {'get': summarize([0.020] * 50, 0, 1.0)}}
+        regressions = compare_to_baseline(much_slower, baseline, 0.2)
+        self.assertTrue(any("throughput" in regression for regression in regressions))
+        self.assertTrue(any("p99" in regression for regression in regressions))
+
+        failing_fast = {'scenarios': {'get': summarize([0.001] * 500, 100, 1.0)}}
+        regressions = compare_to_baseline(failing_fast, baseline, 0.2)
+        self.assertEqual(len(regressions), 1)
+        self.assertIn("error rate 20.00%", regressions[0])
+
+
+class AppRoleTestCase(unittest.TestCase):
+    """This class tests that each app role only serves what it should"""
+
+    def test_api_role_skips_admin(self):
+        """Tests that api workers serve the api but not the admin"""
+        app = create_app('api')
+        with app.app_context():
+            db.create_all()
+        client = app.test_client()
+        self.assertEqual(client.get('/admin/').status_code, 404)
+        self.assertEqual(client.get('/api/guests').status_code, 200)
+
+    def test_admin_role_skips_api(self):
+        """Tests that admin workers serve the admin but not the api"""
+        app = create_app('admin')
+        with app.app_context():
+            db.create_all()
+        client = app.test_client()
+        self.assertEqual(client.get('/admin/').status_code, 200)
+        self.assertEqual(client.get('/api/guests').status_code, 404)
+
+    def test_unknown_role(self):
+        """Tests that a typo in the role fails loudly"""
+        with self.assertRaises(ValueError):
+            create_app('apii')
+
+
+class EncodingTestCase(ReplySiteTestCase):
+    """This class tests our json response encoder"""
+
+    def _add_guests(self, count):
+        for i in range(count):
+            res = self.client().post('/api/guest', data={'name': 'Guest {}'.format(i), 'total_attendees': 1})
+            self.assertEqual(res.status_code, 201)
+
+    def test_flask_json_encodes_models(self):
+        """Tests that flask's own json, i.e. jsonify, encodes models the same way as the api"""
+        self._add_guests(1)
+        with self.app.app_context():
+            guest = Guest.query.get(1)
+            self.assertEqual(json.loads(self.app.json.dumps(guest)), json.loads(encoding.dumps(guest)))
+
+    def test_list_matches_to_json(self):
+        """Tests that list responses have the same shape as Guest.to_json, with or without orjson"""
+        self._add_guests(3)
+        with self.app.app_context():
+            expected = [guest.to_json() for guest in Guest.query.order_by(Guest.id).all()]
+        res = self.client().get('/api/guests')
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(json.loads(res.data), expected)
+        with patch.object(encoding, 'orjson', None):
+            res = self.client().get('/api/guests')
+        self.assertEqual(json.loads(res.data), expected)
+
+    def test_large_lists_are_streamed(self):
+        """Tests that lists over the threshold are streamed as one valid json array"""
+        self._add_guests(5)
+        self.app.config['JSON_STREAM_THRESHOLD'] = 2
+        self.app.config['JSON_STREAM_CHUNK_SIZE'] = 2
+        res = self.client().get('/api/guests')
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(res.is_streamed)
+        self.assertEqual([guest['name'] for guest in json.loads(res.data)],
+                         ['Guest {}'.format(i) for i in range(5)])
+
+
+class ReadReplicaTestCase(unittest.TestCase):
+    """This class tests that reads go to the replica and writes go to the primary"""
+
+    def setUp(self):
+        self.db_dir = tempfile.mkdtemp()
+        primary = "sqlite:///{}".format(os.path.join(self.db_dir, "primary.db"))
+        replica = "sqlite:///{}".format(os.path.join(self.db_dir, "replica.db"))
+        with patch.object(Config, 'SQLALCHEMY_DATABASE_URI', primary), \
+                patch.object(Config, 'SQLALCHEMY_READ_REPLICA_URI', replica):
+            self.app = create_app()
+        self.client = self.app.test_client()
+        with self.app.app_context():
+            db.create_all()
+            db.metadata.create_all(db.get_engine(self.app, bind=REPLICA_BIND))
+            # only the replica knows about this guest, so we can tell which database answered
+            db.get_engine(self.app, bind=REPLICA_BIND).execute(
+                Guest.__table__.insert(), {'id': 100, 'name': "Replica Only Guest"})
+
+    def tearDown(self):
+        with self.app.app_context():
+            db.session.remove()
+            db.engine.dispose()
+            db.get_engine(self.app, bind=REPLICA_BIND).dispose()
+        shutil.rmtree(self.db_dir)
+
+    def test_reads_use_replica(self):
+        """Tests that GET requests are answered by the replica"""
+        res = self.client.get('/api/guests')
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual([guest['name'] for guest in json.loads(res.data)], ["Replica Only Guest"])
+        res = self.client.get('/api/guest/100')
+        self.assertEqual(res.status_code, 200)
+
+    def test_writes_use_primary_and_stick(self):
+        """Tests that writes hit the primary and the writer reads from the primary afterwards"""
+        res = self.client.post('/api/guest', data={'name': "Primary Guest", 'total_attendees': 1})
+        self.assertEqual(res.status_code, 201)
+        with self.app.app_context():
+            self.assertEqual([guest.name for guest in Guest.query.all()], ["Primary Guest"])
+
+        # the writer reads its own write from the primary
+        res = self.client.get('/api/guests')
+        self.assertEqual([guest['name'] for guest in json.loads(res.data)], ["Primary Guest"])
+
+        # a different client without the sticky cookie reads from the replica
+        res = self.app.test_client().get('/api/guests')
+        self.assertEqual([guest['name'] for guest in json.loads(res.data)], ["Replica Only Guest"])
+
+
+class FakeRedis(object):
+    """Just enough of a redis client for RedisCache, so we can test it without a server"""
+
+    def __init__(self):
+        self.data = {}
+
+    def get(self, key):
+        return self.data.get(key)
+
+    def set(self, key, value, ex=None):
+        self.data[key] = value
+
+    def incr(self, key):
+        self.data[key] = str(int(self.data.get(key, 0)) + 1).encode()
+        return int(self.data[key])
+
+
+class GuestCacheTestCase(ReplySiteTestCase):
+    """This class tests the guest list response cache and its invalidation"""
+
+    def test_cache_hit_and_invalidation(self):
+        """Tests that repeat list requests are cached and any guest write invalidates them"""
+        res = self.client().post('/api/guest', data=self.guest)
+        self.assertEqual(res.status_code, 201)
+        url = '/api/guests?guest_filter=rsvp&guest_filter_value=None'
+        self.assertEqual(self.client().get(url).headers['X-Cache'], "MISS")
+        res = self.client().get('/api/guests?guest_filter=RSVP&guest_filter_value=null')
+        self.assertEqual(res.headers['X-Cache'], "HIT")
+        self.assertIn("John and Jane Doe", str(res.data))
+
+        # api writes
+        put_result = self.client().put('/api/guest/1', data={"rsvp": True})
+        self.assertEqual(put_result.status_code, 200)
+        res = self.client().get(url)
+        self.assertEqual(res.headers['X-Cache'], "MISS")
+        self.assertNotIn("John and Jane Doe", str(res.data))
+
+        # bulk writes straight through the session
+        with self.app.app_context():
+            Guest.query.filter_by(id=1).update({'rsvp': None}, synchronize_session=False)
+            db.session.commit()
+        res = self.client().get(url)
+        self.assertEqual(res.headers['X-Cache'], "MISS")
+        self.assertIn("John and Jane Doe", str(res.data))
+
+    def test_rollback_keeps_cache(self):
+        """Tests that writes that are rolled back don't invalidate the cache"""
+        self.client().post('/api/guest', data=self.guest)
+        self.client().get('/api/guests')
+        with self.app.app_context():
+            Guest.query.get(1).name = "Rolled Back"
+            db.session.flush()
+            db.session.rollback()
+        self.assertEqual(self.client().get('/api/guests').headers['X-Cache'], "HIT")
+
+    def test_redis_backend(self):
+        """Tests that the shared redis backend caches and invalidates"""
+        self.app.extensions['guest_cache'] = RedisCache(FakeRedis(), ttl=30)
+        self.client().post('/api/guest', data=self.guest)
+        self.assertEqual(self.client().get('/api/guests').headers['X-Cache'], "MISS")
+        self.assertEqual(self.client().get('/api/guests').headers['X-Cache'], "HIT")
+        self.client().delete('/api/guest/1')
+        res = self.client().get('/api/guests')
+        self.assertEqual(res.headers['X-Cache'], "MISS")
+        self.assertEqual(json.loads(res.data), [])
+
+    def test_admin_writes_clear_shared_cache(self):
+        """Tests that admin workers invalidate the redis cache they share with the api workers"""
+        shared = RedisCache(FakeRedis(), ttl=30)
+        admin = create_app('admin')
+        self.assertIsInstance(admin.extensions['guest_cache'], InProcessCache)
+        admin.extensions['guest_cache'] = shared
+        with admin.app_context():
+            db.create_all()
+        res = admin.test_client().post('/admin/guest/new/', data={'name': "Admin Guest", 'total_attendees': "2"})
+        self.assertEqual(res.status_code, 302)
+        self.assertEqual(shared.client.get(shared.prefix + "generation"), b"1")
+        with admin.app_context():
+            db.drop_all()
+
+    def test_in_process_lru_and_ttl(self):
+        """Tests that the in process cache evicts the least recently used entry and expires old ones"""
+        cache = InProcessCache(ttl=30, max_size=2)
+        cache.set("a", b"1")
+        cache.set("b", b"2")
+        cache.get("a")
+        cache.set("c", b"3")
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.get("a"), b"1")
+        self.assertEqual(cache.get("c"), b"3")
+
+        cache.ttl = -1
+        cache.set("d", b"4")
+        self.assertIsNone(cache.get("d"))
+
+
+class GuestAdminTestCase(ReplySiteTestCase):
+    """This class tests the guest admin list view"""
+
+    def test_list_page(self):
+        """Tests that the list page renders, pages, filters and leaves out rsvp notes"""
+        with self.app.app_context():
+            load_guests(db, 120)
+        res = self.client().get('/admin/guest/')
+        self.assertEqual(res.status_code, 200)
+        self.assertNotIn(b"Rsvp Notes", res.data)
+        self.assertEqual(res.data.count(b'name="rowid"'), 50)
+
+        res = self.client().get('/admin/guest/?flt1_0=1&sort=1&desc=1&page=1')
+        self.assertEqual(res.status_code, 200)
+
+    def test_estimated_count(self):
+        """Tests that big tables get an estimated count and filtered lists an exact one"""
+        with self.app.app_context():
+            load_guests(db, 30)
+            Guest.query.filter(Guest.id <= 10).delete()
+            db.session.commit()
+        self.app.config['ADMIN_ESTIMATED_COUNT_THRESHOLD'] = 10
+        view = [view for view in self.app.extensions['admin'][0]._views if view.endpoint == 'guest'][0]
+        with self.app.test_request_context('/admin/guest/'):
+            count, guests = view.get_list(0, None, False, None, [])
+            # max(id) estimate still counts the deleted guests
+            self.assertEqual(count, 30)
+            self.assertEqual(len(guests), 20)
+            count, _ = view.get_list(0, None, False, None, [(0, 'date_saved', '1')])
+            self.assertEqual(count, Guest.query.filter(Guest.date_saved == True).count())
+
+
+class GuestSearchTestCase(ReplySiteTestCase):
+    """This class tests full text search over guests"""
+
+    def setUp(self):
+        super(GuestSearchTestCase, self).setUp()
+        for guest in [{'name': 'John and Jane Doe', 'total_attendees': 2, 'email_address': 'doe@example.com'},
+                      {'name': 'Steve Testerson', 'total_attendees': 1, 'physical_address': '12 Doe Lane'},
+                      {'name': 'Dora Explora', 'total_attendees': 1, 'email_address': 'dora@example.com'}]:
+            res = self.client().post('/api/guest', json=guest)
+            self.assertEqual(res.status_code, 201)
+
+    def _search(self, query, **params):
+        params['q'] = query
+        res = self.client().get('/api/guests/search', query_string=params)
+        self.assertEqual(res.status_code, 200)
+        return json.loads(res.data)
+
+    def test_ranked_search(self):
+        """Tests that matches on the name rank above matches on the address, and words match by prefix"""
+        results = self._search("doe")
+        self.assertEqual(results['total'], 2)
+        self.assertEqual([guest['name'] for guest in results['results']], ['John and Jane Doe', 'Steve Testerson'])
+        self.assertEqual(self._search("explo")['results'][0]['name'], 'Dora Explora')
+        self.assertEqual(self._search("jane doe")['total'], 1)
+        self.assertEqual(self._search("nobody")['total'], 0)
+
+    def test_index_follows_writes(self):
+        """Tests that updates and deletes are reflected in search results"""
+        res = self.client().put('/api/guest/3', data={'rsvp_notes': "bringing a casserole"})
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(self._search("casserole")['results'][0]['id'], 3)
+        self.client().delete('/api/guest/3')
+        self.assertEqual(self._search("casserole")['total'], 0)
+        self.assertEqual(self._search("dora")['total'], 0)
+
+    def test_pagination_and_bad_input(self):
+        """Tests paging through results and rejecting bad queries"""
+        results = self._search("doe", page=2, per_page=1)
+        self.assertEqual(results['total'], 2)
+        self.assertEqual([guest['name'] for guest in results['results']], ['Steve Testerson'])
+        # query operators are stripped rather than passed to the database
+        self.assertEqual(self._search('"doe*')['total'], 2)
+        self.assertEqual(self.client().get('/api/guests/search').status_code, 400)
+        self.assertEqual(self.client().get('/api/guests/search?q=doe&page=x').status_code, 400)
+
+    def test_every_match_ranked(self):
+        """Tests that the best match wins even when there are more matches than we count"""
+        # inserted ahead of the best match, so it's not among the first rows the index hands back
+        with self.app.app_context():
+            db.session.execute(Guest.__table__.delete())
+            db.session.execute(Guest.__table__.insert(), [
+                {'id': i, 'name': "Guest {}".format(i), 'total_attendees': 1,
+                 'physical_address': "{} Doe Lane".format(i)}
+                for i in range(1, 6)] + [{'id': 6, 'name': "John and Jane Doe", 'total_attendees': 2,
+                                          'physical_address': None}])
+            db.session.commit()
+        with patch('app.resources.SEARCH_COUNT_LIMIT', 3), patch('app.search.SEARCH_COUNT_LIMIT', 3):
+            results = self._search("doe", per_page=2)
+            self.assertEqual((results['total'], results['total_capped']), (3, True))
+            self.assertEqual(results['results'][0]['name'], "John and Jane Doe")
+            # matches past the count can still be paged to
+            self.assertEqual(len(self._search("doe", page=3, per_page=2)['results']), 2)
+
+
+class GuestVersioningTestCase(ReplySiteTestCase):
+    """This class tests optimistic concurrency control on guest updates"""
+
+    def setUp(self):
+        # a file database, so a second connection can race our writes
+        self.db_dir = tempfile.mkdtemp()
+        with patch.object(Config, 'SQLALCHEMY_DATABASE_URI',
+                          "sqlite:///{}".format(os.path.join(self.db_dir, "guests.db"))):
+            super(GuestVersioningTestCase, self).setUp()
+        res = self.client().post('/api/guest', data=self.guest)
+        self.assertEqual(res.status_code, 201)
+
+    def tearDown(self):
+        super(GuestVersioningTestCase, self).tearDown()
+        with self.app.app_context():
+            db.engine.dispose()
+        shutil.rmtree(self.db_dir)
+
+    def _concurrent_update(self, **values):
+        """Updates guest 1 from another connection, like another worker would"""
+        with db.get_engine(self.app).begin() as conn:
+            conn.execute(Guest.__table__.update().where(Guest.__table__.c.id == 1).values(
+                version=Guest.__table__.c.version + 1, **values))
+
+    def test_etag_and_if_match(self):
+        """Tests that GET returns an ETag and a PUT with a stale If-Match is refused"""
+        res = self.client().get('/api/guest/1')
+        self.assertEqual(res.headers['ETag'], '"1"')
+        res = self.client().put('/api/guest/1', data={'name': "John Doe"}, headers={'If-Match': '"1"'})
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.headers['ETag'], '"2"')
+        res = self.client().put('/api/guest/1', data={'name': "Jane Doe"}, headers={'If-Match': '"1"'})
+        self.assertEqual(res.status_code, 409)
+        self.assertEqual(json.loads(self.client().get('/api/guest/1').data)['name'], "John Doe")
+
+    def test_stale_write_conflicts(self):
+        """Tests that a PUT racing another writer gets a 409 instead of overwriting it"""
+        real_save = Guest.save
+
+        def racing_save(guest):
+            self._concurrent_update(name="Someone Else")
+            real_save(guest)
+
+        with patch.object(Guest, 'save', racing_save):
+            res = self.client().put('/api/guest/1', data={'name': "John Doe"})
+        self.assertEqual(res.status_code, 409)
+        guest = json.loads(self.client().get('/api/guest/1').data)
+        self.assertEqual((guest['name'], guest['version']), ("Someone Else", 2))
+
+    def test_webhook_retries_conflicts(self):
+        """Tests that an rsvp racing another writer is retried on top of the other write"""
+        real_interpret = TwilioResponseAPI._interpret
+        saves = []
+
+        def racing_interpret(guest, body):
+            if not saves:
+                self._concurrent_update(rsvp_notes="called to say yes")
+            saves.append(guest.version)
+            return real_interpret(guest, body)
+
+        message_mock = MagicMock()
+        # the retry loads and writes the guest a second time
+        with patch.object(TwilioResponseAPI, '_interpret', staticmethod(racing_interpret)), \
+                patch.dict(self.app.config['QUERY_BUDGETS'], {'sms': 6}), \
+                patch.object(TwilioResponseAPI, '_get_twilio_messager', return_value=message_mock):
+            res = self.client().post('/api/sms', data={'From': "5555555555", 'Body': "RSVP Yes 2 Can't wait"})
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(saves, [1, 2])
+        message_mock.message.assert_called_once()
+        with self.app.app_context():
+            guest = Guest.query.get(1)
+            self.assertEqual(guest.rsvp_notes, "called to say yes\ncan't wait")
+            self.assertEqual(guest.version, 3)
+
+    def test_admin_refuses_stale_form(self):
+        """Tests that saving an admin edit form someone else has changed since it was rendered is refused"""
+        res = self.client().get('/admin/guest/edit/?id=1')
+        self.assertIn(b'name="expected_version" type="hidden" value="1"', res.data)
+        self._concurrent_update(name="Someone Else")
+        form = {'name': "John Doe", 'total_attendees': "2", 'expected_version': "1"}
+        res = self.client().post('/admin/guest/edit/?id=1', data=form, follow_redirects=True)
+        self.assertIn(b"Someone else changed this guest", res.data)
+        with self.app.app_context():
+            self.assertEqual(Guest.query.get(1).name, "Someone Else")
+        form['expected_version'] = "2"
+        self.client().post('/admin/guest/edit/?id=1', data=form)
+        with self.app.app_context():
+            self.assertEqual(Guest.query.get(1).name, "John Doe")
+
+
+class GuestChangeFeedTestCase(ReplySiteTestCase):
+    """This class tests the server sent events guest change feed"""
+
+    def setUp(self):
+        super(GuestChangeFeedTestCase, self).setUp()
+        # poll once and end the stream, instead of holding it open
+        self.app.config['CHANGE_FEED_MAX_SECONDS'] = 0
+        res = self.client().post('/api/guest', data=self.guest)
+        self.assertEqual(res.status_code, 201)
+
+    def _events(self, **kwargs):
+        """Reads the change feed and returns its events as (id, data) tuples"""
+        # buffered reads the whole stream and closes it, like the server does when a stream ends
+        res = self.client().get('/api/guests/changes', buffered=True, **kwargs)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.mimetype, "text/event-stream")
+        events = []
+        for block in res.get_data(as_text=True).split("\n\n"):
+            fields = dict(line.split(": ", 1) for line in block.splitlines() if not line.startswith(":"))
+            if 'data' in fields:
+                events.append((int(fields['id']), json.loads(fields['data'])))
+        return events
+
+    def test_changes_are_streamed(self):
+        """Tests that api and webhook writes show up in the feed with the fields they changed"""
+        self.client().put('/api/guest/1', data={"rsvp": True})
+        with patch.object(TwilioResponseAPI, '_get_twilio_messager', return_value=MagicMock()):
+            self.client().post('/api/sms', data={'From': "5555555555", 'Body': "Stop"})
+        self.client().delete('/api/guest/1')
+
+        events = self._events(headers={'Last-Event-ID': "0"})
+        self.assertEqual([(data['id'], data['op']) for _, data in events],
+                         [(1, 'insert'), (1, 'update'), (1, 'update'), (1, 'delete')])
+        self.assertIn('name', events[0][1]['fields'])
+        self.assertEqual(events[1][1]['fields'], ['rsvp'])
+        self.assertEqual(sorted(events[2][1]['fields']), ['rsvp_notes', 'stop_notifications'])
+        self.assertEqual(events[3][1]['fields'], [])
+        self.assertIsNotNone(events[1][1]['date_modified'])
+
+        # resuming only sends what came after the last event seen
+        resumed = self._events(headers={'Last-Event-ID': str(events[1][0])})
+        self.assertEqual([event_id for event_id, _ in resumed], [event_id for event_id, _ in events[2:]])
+
+    def test_stream_start(self):
+        """Tests where streams start without a Last-Event-ID, and that bad cursors are rejected"""
+        self.assertEqual(self._events(), [])
+        self.assertEqual(len(self._events(query_string={'since': "2000-01-01T00:00:00"})), 1)
+        self.assertEqual(len(self._events(query_string={'last_event_id': "0"})), 1)
+        self.assertEqual(self.client().get('/api/guests/changes', headers={'Last-Event-ID': "x"}).status_code, 400)
+
+    def test_open_streams_capped(self):
+        """Tests that a worker turns streams away once it holds its cap, and takes them again as they close"""
+        self.app.extensions['change_feed_streams'] = threading.BoundedSemaphore(1)
+        client = self.client()
+        first = client.get('/api/guests/changes', buffered=False)
+        self.assertEqual(first.status_code, 200)
+        turned_away = client.get('/api/guests/changes')
+        self.assertEqual(turned_away.status_code, 503)
+        self.assertEqual(turned_away.headers['Retry-After'], "5")
+        first.close()
+        self.assertEqual(client.get('/api/guests/changes').status_code, 200)
+
+    def test_change_ids_follow_commit_order(self):
+        """
+        Tests that on postgres a writer takes the change id lock before it's handed any ids, so a writer that commits
+        later can never get a lower id than a change a stream has already sent
+        """
+        calls = MagicMock()
+        session = MagicMock(new=[Guest("Late Writer", 1)], dirty=[], deleted=[])
+        session.connection.return_value = calls.connection
+        session.execute = calls.session_execute
+        calls.connection.dialect.name = 'postgresql'
+        changes._record_guest_changes(session, None)
+        self.assertEqual([name for name, _, _ in calls.mock_calls], ['connection.execute', 'session_execute'])
+        lock = calls.mock_calls[0][1]
+        self.assertIn("pg_advisory_xact_lock", str(lock[0]))
+        self.assertEqual(lock[1], {'key': changes.CHANGE_ID_LOCK})
+
+        # sqlite already serializes writers
+        calls.reset_mock()
+        calls.connection.dialect.name = 'sqlite'
+        changes._record_guest_changes(session, None)
+        self.assertEqual([name for name, _, _ in calls.mock_calls], ['session_execute'])
+
+    def test_admin_writes_are_streamed(self):
+        """Tests that edits made in the admin show up in the feed"""
+        self.client().post('/admin/guest/edit/?id=1', data={'name': "John Doe", 'total_attendees': "2"})
+        events = self._events(headers={'Last-Event-ID': "1"})
+        self.assertEqual([data['op'] for _, data in events], ['update'])
+        self.assertIn('name', events[0][1]['fields'])
+
+
+class SmsIdempotencyTestCase(ReplySiteTestCase):
+    """This class tests that Twilio's webhook retries are only acted on once"""
+
+    def setUp(self):
+        super(SmsIdempotencyTestCase, self).setUp()
+        res = self.client().post('/api/guest', data=self.guest)
+        self.assertEqual(res.status_code, 201)
+        self.message = {'From': "5555555555", 'Body': "RSVP Yes 2 See you there", 'MessageSid': "SM0123456789"}
+
+    def test_retry_answered_from_memory(self):
+        """Tests that a retry on the same worker gets the same reply without touching the database"""
+        first = self.client().post('/api/sms', data=self.message)
+        self.assertEqual(first.status_code, 200)
+        self.assertIn(b"glad you're joining us", first.data)
+        with patch.dict(self.app.config['QUERY_BUDGETS'], {'sms': 0}):
+            retry = self.client().post('/api/sms', data=self.message)
+        self.assertEqual(retry.data, first.data)
+        with self.app.app_context():
+            self.assertEqual(Guest.query.get(1).rsvp_notes, "see you there")
+
+    def test_retry_answered_from_database(self):
+        """Tests that a retry another worker answered is not applied again and gets the stored reply"""
+        first = self.client().post('/api/sms', data=self.message)
+        self.app.extensions['sms_reply_cache'].clear()
+        # the retry's write is rolled back and the stored reply read
+        with patch.dict(self.app.config['QUERY_BUDGETS'], {'sms': 6}):
+            retry = self.client().post('/api/sms', data=self.message)
+        self.assertEqual(retry.status_code, 200)
+        self.assertEqual(retry.data, first.data)
+        with self.app.app_context():
+            guest = Guest.query.get(1)
+            self.assertEqual((guest.rsvp_notes, guest.version), ("see you there", 2))
+            self.assertEqual(InboundMessage.query.filter_by(message_sid="SM0123456789").count(), 1)
+
+        # a new message from the same guest is still acted on
+        self.message.update({'MessageSid': "SM9876543210", 'Body': "RSVP Yes 1 one of us is sick"})
+        self.client().post('/api/sms', data=self.message)
+        with self.app.app_context():
+            self.assertEqual(Guest.query.get(1).rsvp_notes, "see you there\none of us is sick")
+
+
+class SmsQueueTestCase(ReplySiteTestCase):
+    """This class tests answering texts straight away and applying them later with the sms queue"""
+
+    def setUp(self):
+        super(SmsQueueTestCase, self).setUp()
+        res = self.client().post('/api/guest', data=self.guest)
+        self.assertEqual(res.status_code, 201)
+        self.queue_dir = tempfile.mkdtemp()
+        self.queue = SmsQueue(os.path.join(self.queue_dir, "sms.db"), 3)
+        self.app.extensions['sms_queue'] = self.queue
+
+    def tearDown(self):
+        super(SmsQueueTestCase, self).tearDown()
+        shutil.rmtree(self.queue_dir)
+
+    def _text(self, body, sid):
+        return self.client().post('/api/sms', data={'From': "5555555555", 'Body': body, 'MessageSid': sid})
+
+    def _guest(self):
+        return json.loads(self.client().get('/api/guest/1').data)
+
+    def test_answered_before_applied(self):
+        """Tests that a text is answered straight away and applied when the worker drains the queue"""
+        res = self._text("Yes", "SM1")
+        self.assertEqual(res.status_code, 200)
+        self.assertIn(b"Thanks for confirming", res.data)
+        self.assertIsNone(self._guest()['date_saved'])
+        self.assertEqual(len(self.queue), 1)
+
+        with self.app.app_context():
+            run_queue_worker(once=True)
+            self.assertEqual(InboundMessage.query.filter_by(message_sid="SM1").one().reply,
+                             "Thanks for confirming, we'll be in touch with more info soon!")
+        self.assertTrue(self._guest()['date_saved'])
+        self.assertEqual(len(self.queue), 0)
+
+    def test_texts_applied_in_order(self):
+        """Tests that a guest's texts are applied in the order they came in, once each, a batch at a time"""
+        self._text("Yes", "SM1")
+        self._text("RSVP Yes 2 first", "SM2")
+        # a retry of a text that is already queued isn't queued again
+        self._text("Yes", "SM1")
+        self._text("RSVP No", "SM3")
+        with self.app.app_context():
+            self.assertEqual(drain(self.queue, 2), 2)
+            # a drain that committed but died before acking applies nothing twice
+            self.queue.put("SM2", "5555555555", "rsvp yes 2 first")
+            self.assertEqual(drain(self.queue, 2), 2)
+            self.assertEqual(drain(self.queue, 2), 0)
+        guest = self._guest()
+        self.assertEqual((guest['date_saved'], guest['rsvp'], guest['total_attendees']), (True, False, 0))
+        self.assertEqual(guest['rsvp_notes'], "first\nrsvp no")
+
+    def test_full_queue_pushes_back(self):
+        """Tests that texts are turned away with a 503 once the queue is full, without being queued"""
+        for i in range(3):
+            self.assertEqual(self._text("Yes", "SM{}".format(i)).status_code, 200)
+        res = self._text("No", "SM3")
+        self.assertEqual(res.status_code, 503)
+        self.assertEqual(res.headers['Retry-After'], "5")
+        self.assertEqual([message.message_sid for message in self.queue.peek(10)], ["SM0", "SM1", "SM2"])
+
+
+class MessageStatusTestCase(ReplySiteTestCase):
+    """This class tests recording the delivery statuses Twilio reports for the texts we send"""
+
+    def setUp(self):
+        super(MessageStatusTestCase, self).setUp()
+        # only written when the buffer fills or we flush it
+        self.buffer = StatusBuffer(self.app, 3, 3600)
+        self.app.extensions['message_status_buffer'] = self.buffer
+
+    def _callback(self, sid, status, **values):
+        values.update({'MessageSid': sid, 'MessageStatus': status, 'To': "+15555555555"})
+        res = self.client().post('/api/sms/status', data=values)
+        self.assertEqual(res.status_code, 204)
+
+    def _statuses(self):
+        with self.app.app_context():
+            return {row.message_sid: (row.status, row.error_code) for row in MessageStatus.query}
+
+    def test_statuses_written_in_batches(self):
+        """Tests that callbacks are buffered and a full buffer is written in one statement"""
+        statements = []
+        with self.app.app_context():
+            engine = db.get_engine(self.app)
+        event.listen(engine, 'before_cursor_execute', lambda *args: statements.append(args[2]))
+        self._callback("SM1", "queued")
+        self._callback("SM1", "sent")
+        self._callback("SM2", "queued")
+        self.assertEqual(self._statuses(), {})
+        statements.clear()
+        # the third message fills the buffer
+        self._callback("SM3", "failed", ErrorCode="30003")
+        self.assertEqual(len([statement for statement in statements if "message_status" in statement]), 1)
+        self.assertEqual(self._statuses(), {'SM1': ("sent", None), 'SM2': ("queued", None),
+                                            'SM3': ("failed", "30003")})
+        self.assertEqual(len(self.buffer), 0)
+
+    def test_late_callbacks_dont_go_backwards(self):
+        """Tests that a callback that arrives after a later status, in or across batches, is ignored"""
+        self._callback("SM1", "delivered")
+        self._callback("SM1", "sent")
+        with self.app.app_context():
+            self.assertEqual(self.buffer.flush(), 1)
+        self._callback("SM1", "queued")
+        self._callback("SM2", "sending")
+        with self.app.app_context():
+            self.assertEqual(self.buffer.flush(), 2)
+        self.assertEqual(self._statuses(), {'SM1': ("delivered", None), 'SM2': ("sending", None)})
+
+    def test_bad_callbacks_rejected(self):
+        """Tests that a callback needs a MessageSid and a status"""
+        self.assertEqual(self.client().post('/api/sms/status', data={'MessageSid': "SM1"}).status_code, 400)
+        self.assertEqual(len(self.buffer), 0)
+
+
+class DedupeTestCase(ReplySiteTestCase):
+    """This class tests finding duplicate guests"""
+
+    def setUp(self):
+        super(DedupeTestCase, self).setUp()
+        with self.app.app_context():
+            db.session.add_all([
+                Guest("John & Jane Doe", 2, "(555) 555-5555", "john.doe@example.com"),
+                Guest("Jane and John Doe", 2, "+15555555555", None),
+                Guest("Steve and Dora Explora", 2, "5555555556", "STEVE@example.com"),
+                Guest("Dora & Steve Explora", 2, None, "steve@example.com "),
+                # same name, nothing else in common
+                Guest("John Doe", 1, "5555555557", "jd@example.com"),
+                Guest("John Doe", 1, "5555555558", "john@example.com"),
+            ])
+            db.session.commit()
+
+    def test_normalize(self):
+        """Tests that phone numbers, email addresses and names are compared however they're written"""
+        self.assertEqual(dedupe.normalize_phone("+1 (555) 555-5555"), "5555555555")
+        self.assertEqual(dedupe.normalize_phone("555"), "")
+        self.assertEqual(dedupe.normalize_email(" John.Doe@Example.com"), "john.doe@example.com")
+        self.assertEqual(dedupe.name_tokens("Mr. John & Jane Doe"), dedupe.name_tokens("Jane and John Doe"))
+
+    def test_find_duplicates(self):
+        """Tests that likely duplicates are suggested and guests that only share a name aren't"""
+        with self.app.app_context():
+            suggestions, stats = dedupe.find_duplicates(Guest.query.all())
+        pairs = [(suggestion.keep.id, suggestion.duplicate.id) for suggestion in suggestions]
+        self.assertEqual(pairs, [(1, 2), (3, 4)])
+        self.assertEqual(suggestions[0].matched_on, ['name', 'phone'])
+        self.assertEqual(stats['guests'], 6)
+
+    def test_keeps_guest_that_answered(self):
+        """Tests that the guest who has answered is the one kept"""
+        with self.app.app_context():
+            Guest.query.get(2).date_saved = True
+            db.session.commit()
+            suggestions, _ = dedupe.find_duplicates(Guest.query.all())
+        self.assertEqual((suggestions[0].keep.id, suggestions[0].duplicate.id), (2, 1))
+
+    def test_big_blocks_skipped(self):
+        """Tests that blocks bigger than the cap aren't compared"""
+        with self.app.app_context():
+            suggestions, stats = dedupe.find_duplicates(Guest.query.all(), max_block_size=1)
+        self.assertEqual(suggestions, [])
+        self.assertEqual(stats['compared'], 0)
+        self.assertGreater(stats['skipped_blocks'], 0)
+
+    def test_admin_csv(self):
+        """Tests that the admin hands out the suggestions as a CSV to review"""
+        res = self.client().get('/admin/duplicates/')
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.mimetype, 'text/csv')
+        rows = list(csv.reader(io.StringIO(res.get_data(as_text=True))))
+        self.assertEqual(rows[0], dedupe.REVIEW_CSV_HEADER)
+        self.assertEqual(len(rows), 3)
+        self.assertEqual(rows[1][2], "1")
+        self.assertEqual(rows[1][6], "2")
+        self.assertEqual(rows[1][-1], "")
+
+
+class CampaignTestCase(ReplySiteTestCase):
+    """This class tests creating campaigns and sending them with the campaign worker"""
+
+    def setUp(self):
+        super(CampaignTestCase, self).setUp()
+        for i, name in enumerate(["John Doe", "Jane Doe", "Steve Testerson", "Dora Explora"]):
+            res = self.client().post('/api/guest', data={'name': name, 'phone_number': "555555000{}".format(i)})
+            self.assertEqual(res.status_code, 201)
+        self.client().put('/api/guest/3', data={'stop_notifications': True})
+        self.sender = FakeSender(fail_numbers={"5555550001"})
+        self.app.extensions['sms_sender'] = self.sender
+        self.app.config.update(CAMPAIGN_SEND_RATE=0, CAMPAIGN_BATCH_SIZE=2)
+
+    def _run_worker(self):
+        with self.app.app_context():
+            run_worker(once=True)
+
+    def test_campaign_is_sent(self):
+        """Tests that a campaign is sent to its segment by the worker and its progress reported"""
+        res = self.client().post('/api/campaigns', json={'name': "Save the date", 'template': "Hi {{ name }}!",
+                                                         'guest_filter': "all_contacts"})
+        self.assertEqual(res.status_code, 201)
+        campaign = json.loads(res.data)
+        self.assertEqual(res.headers['Location'], "/api/campaigns/{}".format(campaign['id']))
+        self.assertEqual(campaign['status'], "pending")
+
+        self._run_worker()
+        res = self.client().get('/api/campaigns/{}'.format(campaign['id']))
+        self.assertEqual(res.status_code, 200)
+        campaign = json.loads(res.data)
+        self.assertEqual(campaign['status'], "done")
+        self.assertEqual(campaign['progress'], {'pending': 0, 'sent': 2, 'failed': 1})
+        # guest 3 asked us to stop texting them
+        self.assertEqual(sorted(self.sender.sent), [("5555550000", "Hi John Doe!"), ("5555550003", "Hi Dora Explora!")])
+
+    def test_rerun_only_sends_unsent(self):
+        """Tests that running a campaign again retries its failures and skips guests it already reached"""
+        res = self.client().post('/api/campaigns', data={'template': "RSVP soon {{ name }}"})
+        campaign_id = json.loads(res.data)['id']
+        self._run_worker()
+        self.sender.fail_numbers = set()
+        with self.app.app_context():
+            campaign = Campaign.query.get(campaign_id)
+            campaign.status = "pending"
+            campaign.save()
+        self._run_worker()
+        self.assertEqual(len(self.sender.sent), 3)
+        self.assertEqual(self.sender.sent[-1], ("5555550001", "RSVP soon Jane Doe"))
+        progress = json.loads(self.client().get('/api/campaigns/{}'.format(campaign_id)).data)['progress']
+        self.assertEqual(progress, {'pending': 0, 'sent': 3, 'failed': 0})
+
+    def test_bad_campaigns_rejected(self):
+        """Tests that campaigns without a valid template or segment are rejected"""
+        self.assertEqual(self.client().post('/api/campaigns', json={'name': "No template"}).status_code, 400)
+        self.assertEqual(self.client().post('/api/campaigns', json={'template': "Hi {{ name"}).status_code, 400)
+        self.assertEqual(self.client().post('/api/campaigns', json={'template': "Hi",
+                                                                    'guest_filter': "everyone"}).status_code, 400)
+        self.assertEqual(self.client().get('/api/campaigns/1').status_code, 404)
+
+    def test_status_filter_needs_value(self):
+        """Tests that a campaign for a status filter has to say which status, instead of going to every guest"""
+        for body in [{'template': "Hi", 'guest_filter': "rsvp"},
+                     {'template': "Hi", 'guest_filter': "std", 'guest_filter_value': "maybe"}]:
+            self.assertEqual(self.client().post('/api/campaigns', json=body).status_code, 400, body)
+        res = self.client().post('/api/campaigns', json={'template': "Hi", 'guest_filter': "rsvp",
+                                                         'guest_filter_value': None})
+        self.assertEqual(res.status_code, 201)
+        self.assertEqual(json.loads(res.data)['guest_filter'], "rsvp")
+
+    def test_campaigns_listed(self):
+        """Tests that the campaigns are listed newest first"""
+        self.assertEqual(json.loads(self.client().get('/api/campaigns').data), [])
+        for name in ["First", "Second"]:
+            self.client().post('/api/campaigns', json={'name': name, 'template': "Hi"})
+        res = self.client().get('/api/campaigns')
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual([campaign['name'] for campaign in json.loads(res.data)], ["Second", "First"])
+
+    def test_stale_campaign_reclaimed(self):
+        """Tests that a running campaign whose worker stopped checking in is picked up by another worker"""
+        for name in ["Abandoned", "Busy"]:
+            self.client().post('/api/campaigns', json={'name': name, 'template': "Hi {{ name }}"})
+        with self.app.app_context():
+            for campaign_id, minutes in [(1, 30), (2, 1)]:
+                campaign = Campaign.query.get(campaign_id)
+                campaign.status = "running"
+                campaign.date_started = datetime.utcnow() - timedelta(hours=1)
+                campaign.date_heartbeat = datetime.utcnow() - timedelta(minutes=minutes)
+                campaign.save()
+            self.assertIsNone(claim_next_campaign())
+            self.assertIsNone(claim_next_campaign(3600))
+            self.assertEqual(claim_next_campaign(600).id, 1)
+            # the claim is a fresh heartbeat, so nobody else takes it
+            self.assertIsNone(claim_next_campaign(600))
+
+        self.app.config['CAMPAIGN_STALE_SECONDS'] = 600
+        with self.app.app_context():
+            Campaign.query.filter_by(id=1).update({'date_heartbeat': datetime.utcnow() - timedelta(hours=1)})
+            db.session.commit()
+        self._run_worker()
+        progress = json.loads(self.client().get('/api/campaigns/1').data)
+        self.assertEqual(progress['status'], "done")
+        self.assertEqual(json.loads(self.client().get('/api/campaigns/2').data)['status'], "running")
+
+
+class BulkUpdateTestCase(ReplySiteTestCase):
+    """This class tests updating many guests at once with PATCH /api/guests"""
+
+    def setUp(self):
+        super(BulkUpdateTestCase, self).setUp()
+        # start the change feed after the inserts
+        self.app.config['CHANGE_FEED_MAX_SECONDS'] = 0
+        for i in range(4):
+            res = self.client().post('/api/guest', data={'name': "Guest {}".format(i),
+                                                         'phone_number': "555555000{}".format(i)})
+            self.assertEqual(res.status_code, 201)
+
+    def _patch(self, body):
+        return self.client().patch('/api/guests', json=body)
+
+    def test_update_by_ids(self):
+        """Tests that guests picked by id are updated in one go, versioned and sent to the change feed"""
+        self.assertEqual(self.client().get('/api/guests').headers['X-Cache'], "MISS")
+        res = self._patch({'ids': [1, 2], 'set': {'date_saved': True, 'last_notified': "2026-10-01T12:30:00"}})
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(json.loads(res.data), {'updated': 2})
+
+        res = self.client().get('/api/guests')
+        self.assertEqual(res.headers['X-Cache'], "MISS")
+        guests = {guest['id']: guest for guest in json.loads(res.data)}
+        self.assertEqual([guests[i]['date_saved'] for i in range(1, 5)], [True, True, None, None])
+        self.assertEqual(guests[1]['last_notified'], "2026-10-01T12:30:00")
+        self.assertEqual([guests[i]['version'] for i in range(1, 5)], [2, 2, 1, 1])
+
+        changes = self.client().get('/api/guests/changes', headers={'Last-Event-ID': "4"}).get_data(as_text=True)
+        self.assertEqual(changes.count('"fields":["date_saved","last_notified"]'), 2)
+
+    def test_update_by_filter(self):
+        """Tests that guests picked by a guest list filter are updated and "now" sets last_notified"""
+        self._patch({'ids': [1], 'set': {'date_saved': False}})
+        res = self._patch({'guest_filter': "savethedate", 'guest_filter_value': None,
+                           'set': {'last_notified': "now"}})
+        self.assertEqual(json.loads(res.data), {'updated': 3})
+        with self.app.app_context():
+            self.assertEqual([guest.last_notified is None for guest in Guest.query.order_by(Guest.id)],
+                             [True, False, False, False])
+
+    def test_bad_bulk_updates_rejected(self):
+        """Tests that bulk updates need exactly one way of picking guests and valid fields"""
+        for body in [{'set': {'rsvp': True}},
+                     {'ids': [1], 'guest_filter': "all", 'set': {'rsvp': True}},
+                     {'ids': [1], 'set': {}},
+                     {'ids': [1], 'set': {'version': 10}},
+                     {'ids': [1], 'set': {'last_notified': "last tuesday"}},
+                     # a status filter without a status would pick every guest
+                     {'guest_filter': "rsvp", 'set': {'rsvp': True}},
+                     {'guest_filter': "savethedate", 'guest_filter_value': "maybe", 'set': {'rsvp': True}}]:
+            self.assertEqual(self._patch(body).status_code, 400, body)
+        self.assertEqual(self.client().patch('/api/guests', data={'ids': 1}).status_code, 400)
+        with self.app.app_context():
+            self.assertEqual(Guest.query.filter(Guest.rsvp != None).count(), 0)
+
+
+class SparseFieldsTestCase(ReplySiteTestCase):
+    """This class tests ?fields= projections on the guest endpoints"""
+
+    def setUp(self):
+        super(SparseFieldsTestCase, self).setUp()
+        res = self.client().post('/api/guest', data=self.guest)
+        self.assertEqual(res.status_code, 201)
+        self.client().put('/api/guest/1', data={'rsvp_notes': "a very long note"})
+
+    def _selects(self, url):
+        """Requests url and returns the response along with the SELECT statements it ran"""
+        statements = []
+
+        def capture(conn, cursor, statement, parameters, context, executemany):
+            if statement.lstrip().upper().startswith("SELECT"):
+                statements.append(statement)
+
+        with self.app.app_context():
+            event.listen(db.engine, 'before_cursor_execute', capture)
+            try:
+                res = self.client().get(url)
+            finally:
+                event.remove(db.engine, 'before_cursor_execute', capture)
+        return res, statements
+
+    def test_list_fields(self):
+        """Tests that the guest list only selects and returns the fields asked for"""
+        self.assertEqual(self.client().get('/api/guests').headers['X-Cache'], "MISS")
+        res, statements = self._selects('/api/guests?fields=phone_number,name')
+        self.assertEqual(res.status_code, 200)
+        # the full list is cached under another key
+        self.assertEqual(res.headers['X-Cache'], "MISS")
+        self.assertEqual(json.loads(res.data), [{'name': "John and Jane Doe", 'phone_number': "5555555555"}])
+        self.assertEqual(len(statements), 1)
+        self.assertNotIn("rsvp_notes", statements[0])
+        self.assertEqual(self.client().get('/api/guests?fields=name,phone_number').headers['X-Cache'], "HIT")
+
+    def test_detail_fields(self):
+        """Tests that a single guest only loads and returns the fields asked for"""
+        res, statements = self._selects('/api/guest/1?fields=rsvp,name')
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(json.loads(res.data), {'name': "John and Jane Doe", 'rsvp': None})
+        self.assertEqual(res.headers['ETag'], '"2"')
+        self.assertNotIn("rsvp_notes", statements[0])
+
+    def test_unknown_fields_rejected(self):
+        """Tests that fields that aren't guest fields are rejected"""
+        self.assertEqual(self.client().get('/api/guests?fields=name,password').status_code, 400)
+        self.assertEqual(self.client().get('/api/guest/1?fields=__class__').status_code, 400)
+
+
+class ReadModelTestCase(ReplySiteTestCase):
+    """This class tests the read only guest records"""
+
+    def setUp(self):
+        super(ReadModelTestCase, self).setUp()
+        res = self.client().post('/api/guest', data=self.guest)
+        self.assertEqual(res.status_code, 201)
+        self.client().put('/api/guest/1', data={'rsvp': True, 'last_notified': "now"})
+
+    def test_records_match_models(self):
+        """Tests that records hold the same values and encode to the same json as the models"""
+        with self.app.app_context():
+            guest = Guest.query.get(1)
+            record, = Guest.get_records("all")
+            self.assertEqual(record.json_values(), guest.json_values())
+            self.assertEqual(record.to_json(), guest.to_json())
+            self.assertEqual(encoding.dumps([record]), encoding.dumps([guest]))
+            with patch.object(encoding, 'orjson', None):
+                self.assertEqual(json.loads(encoding.dumps([record])), json.loads(encoding.dumps([guest])))
+
+    def test_records_are_slotted(self):
+        """Tests that records don't carry a __dict__ and are only made once per set of fields"""
+        with self.app.app_context():
+            record, = Guest.get_records("rsvp", True, ('name', 'rsvp'))
+            self.assertFalse(hasattr(record, '__dict__'))
+            self.assertEqual(record.to_json(), {'name': "John and Jane Doe", 'rsvp': True})
+            self.assertIs(type(record), Guest.record_class(('name', 'rsvp')))
+            self.assertEqual(Guest.get_records("rsvp", False), [])
+
+    def test_list_unchanged(self):
+        """Tests that the guest list returns the same json it did when it was built from models"""
+        res = self.client().get('/api/guests')
+        self.assertEqual(res.status_code, 200)
+        with self.app.app_context():
+            self.assertEqual(json.loads(res.data), [json.loads(encoding.dumps(Guest.query.get(1)))])
+
+
+@unittest.skipUnless(importlib.util.find_spec('aiosqlite'), "the async webhook needs aiosqlite to run on sqlite")
+class AsgiWebhookTestCase(ReplySiteTestCase):
+    """This class tests the async sms webhook"""
+
+    def setUp(self):
+        # a file database, so the flask app and the async app see the same guests
+        self.db_dir = tempfile.mkdtemp()
+        with patch.object(Config, 'SQLALCHEMY_DATABASE_URI',
+                          "sqlite:///{}".format(os.path.join(self.db_dir, "guests.db"))):
+            super(AsgiWebhookTestCase, self).setUp()
+            self.asgi_app = create_asgi_app()
+        # close change feed streams as soon as they've caught up
+        self.app.config['CHANGE_FEED_MAX_SECONDS'] = 0
+        res = self.client().post('/api/guest', data=self.guest)
+        self.assertEqual(res.status_code, 201)
+
+    def tearDown(self):
+        asyncio.run(self.asgi_app.engine.dispose())
+        super(AsgiWebhookTestCase, self).tearDown()
+        with self.app.app_context():
+            db.engine.dispose()
+        shutil.rmtree(self.db_dir)
+
+    def _request(self, path, data=None, method="POST", headers=None):
+        """Sends a request straight to the ASGI app and returns its status and body"""
+        messages = []
+
+        async def receive():
+            return {'type': 'http.request', 'body': urlencode(data or {}).encode(), 'more_body': False}
+
+        async def send(message):
+            messages.append(message)
+
+        asyncio.run(self.asgi_app({'type': 'http', 'method': method, 'path': path, 'query_string': b"",
+                                   'scheme': "http", 'headers': headers or []}, receive, send))
+        return messages[0]['status'], messages[1]['body']
+
+    def test_replies_like_flask(self):
+        """Tests that the async webhook updates the guest and replies the same way the flask one does"""
+        status, body = self._request('/api/sms', {'From': "+15555555555", 'Body': "RSVP Yes 2 See you there"})
+        self.assertEqual(status, 200)
+        self.assertEqual(body, render_reply("We're so glad you're joining us on our special day! "
+                                            "Remember to keep up with the wedding site for any updates!").encode())
+        guest = json.loads(self.client().get('/api/guest/1').data)
+        self.assertEqual((guest['rsvp'], guest['rsvp_notes'], guest['version']), (True, "see you there", 2))
+        changes = self.client().get('/api/guests/changes?last_event_id=0').get_data(as_text=True)
+        self.assertIn('"op":"update"', changes)
+
+        status, body = self._request('/api/sms', {'From': "1234567890", 'Body': "yes"})
+        self.assertEqual(body, render_reply(UNKNOWN_NUMBER_REPLY).encode())
+
+    def test_message_sid_idempotent(self):
+        """Tests that a retried message is only acted on once, from memory or from the database"""
+        message = {'From': "5555555555", 'Body': "RSVP Yes 2 See you there", 'MessageSid': "SM0123456789"}
+        first = self._request('/api/sms', message)
+        self.assertEqual(self._request('/api/sms', message), first)
+        self.asgi_app.replies.clear()
+        self.assertEqual(self._request('/api/sms', message), first)
+        with self.app.app_context():
+            guest = Guest.query.get(1)
+            self.assertEqual((guest.rsvp_notes, guest.version), ("see you there", 2))
+
+    def test_clears_shared_guest_cache(self):
+        """Tests that webhook writes clear the redis guest cache the flask workers share"""
+        shared = RedisCache(FakeRedis(), ttl=30)
+        self.app.extensions['guest_cache'] = shared
+        asyncio.run(self.asgi_app.engine.dispose())
+        with patch.object(Config, 'SQLALCHEMY_DATABASE_URI', self.app.config['SQLALCHEMY_DATABASE_URI']), \
+                patch.object(Config, 'GUEST_CACHE_BACKEND', 'redis'), \
+                patch('app.asgi.create_guest_cache', return_value=shared):
+            self.asgi_app = create_asgi_app()
+        self.assertEqual(self.client().get('/api/guests').headers['X-Cache'], "MISS")
+        self.assertEqual(self.client().get('/api/guests').headers['X-Cache'], "HIT")
+        self._request('/api/sms', {'From': "5555555555", 'Body': "yes"})
+        res = self.client().get('/api/guests')
+        self.assertEqual(res.headers['X-Cache'], "MISS")
+        self.assertTrue(json.loads(res.data)[0]['date_saved'])
+
+    def test_signature_validated(self):
+        """Tests that requests Twilio didn't sign are refused outside of testing and debug"""
+        asyncio.run(self.asgi_app.engine.dispose())
+        with patch.object(Config, 'SQLALCHEMY_DATABASE_URI', self.app.config['SQLALCHEMY_DATABASE_URI']), \
+                patch.object(Config, 'TESTING', False), patch.object(Config, 'DEBUG', False):
+            self.asgi_app = create_asgi_app()
+        message = {'From': "5555555555", 'Body': "yes"}
+        self.assertEqual(self._request('/api/sms', message)[0], 403)
+        signature = RequestValidator(Config.TWILIO_AUTH_TOKEN).compute_signature(
+            "https://example.com/api/sms", message)
+        headers = [(b"host", b"example.com"), (b"x-forwarded-proto", b"https"),
+                   (b"x-twilio-signature", signature.encode())]
+        self.assertEqual(self._request('/api/sms', message, headers=headers)[0], 200)
+
+    def test_only_serves_the_webhook(self):
+        """Tests that anything but a POST to /api/sms is refused"""
+        self.assertEqual(self._request('/api/guests', method="GET")[0], 404)
+        self.assertEqual(self._request('/api/sms', method="GET")[0], 405)
+
+    def test_async_database_uri(self):
+        """Tests that database uris get the async driver for their database"""
+        self.assertEqual(async_database_uri("postgresql://user:pass@db/wedding"),
+                         "postgresql+asyncpg://user:pass@db/wedding")
+        self.assertEqual(async_database_uri("postgresql+psycopg2://db/wedding"), "postgresql+asyncpg://db/wedding")
+        self.assertEqual(async_database_uri("sqlite:////tmp/guests.db"), "sqlite+aiosqlite:////tmp/guests.db")
+        with self.assertRaises(ValueError):
+            async_database_uri("mysql://db/wedding")
+
+
 # Make the tests conveniently executable
 if __name__ == "__main__":
     unittest.main()